@@ -0,0 +1,1050 @@
+#!/usr/bin/env python3
+'''Benchmarks for corpus construction.'''
+
+
+from build import TokenizationError
+from build import _enumerate_source_files
+from build import _get_comment_tokens_from_source_file
+from build import _get_token_span
+from build import _get_token_text
+from build import _validate_source_file
+from build import download_repos
+from build import extract_data
+from build import classify_comments_as_code
+from build import get_candidate_languages
+from build import is_comment_code
+from build import main as build_main
+from build import trim_comment_as_code
+from build import validate_source_text_language
+from corpus import get_corpus_file_paths
+from defines import ClangParseMode
+from defines import CodeVerdict
+from defines import CommentBackend
+from defines import Language
+from defines import NoteType
+from defines import CORPUSDIR_PATH
+from defines import REPOLIST_PATH
+from repo import RepoManager
+
+from argparse import ArgumentParser
+from collections import Counter
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from xml.etree import ElementTree
+
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+
+parser = ArgumentParser(description=__doc__)
+
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+lexer_agreement_parser = subparsers.add_parser(
+    'lexer-agreement',
+    help=(
+        "Compare comments found in C/C++ files by the libclang and lexer backends, on"
+        " downloaded repositories from repolist.txt."
+    ),
+)
+
+lexer_agreement_parser.add_argument(
+    '--repos',
+    nargs='+',
+    help="Only benchmark these repositories (default: all downloaded repositories).",
+)
+
+lexer_agreement_parser.add_argument(
+    '--max-files',
+    type=int,
+    help="Benchmark at most this many C/C++ files per repository.",
+)
+
+clang_parse_parser = subparsers.add_parser(
+    'clang-parse',
+    help=(
+        "Compare libclang parse modes on C/C++ files of downloaded repositories from"
+        " repolist.txt: parse time, validated language, and comments found."
+    ),
+)
+
+clang_parse_parser.add_argument(
+    '--repos',
+    nargs='+',
+    help="Only benchmark these repositories (default: all downloaded repositories).",
+)
+
+clang_parse_parser.add_argument(
+    '--max-files',
+    type=int,
+    help="Benchmark at most this many C/C++ files per repository.",
+)
+
+clang_parse_parser.add_argument(
+    '--modes',
+    nargs=2,
+    choices=tuple(ClangParseMode),
+    default=(ClangParseMode.FULL, ClangParseMode.FAST),
+    metavar=('BASELINE', 'MODE'),
+    help="Parse modes to compare (default: full fast).",
+)
+
+comment_code_parser = subparsers.add_parser(
+    'comment-code',
+    help=(
+        "Compare code classification of comments by `classify_comments_as_code()` with"
+        " the per-comment checks it replaces, on extracted comment corpus files."
+    ),
+)
+
+comment_code_parser.add_argument(
+    '--repos',
+    nargs='+',
+    help="Only benchmark these repositories (default: all repositories in repolist.txt).",
+)
+
+synthetic_parser = subparsers.add_parser(
+    'synthetic',
+    help=(
+        "Measure build throughput on a generated git repository: comment extraction,"
+        " changelog extraction, and the full build pipeline."
+    ),
+)
+
+synthetic_parser.add_argument(
+    '--files',
+    type=int,
+    default=200,
+    help="Number of source files in the repository (default: 200).",
+)
+
+synthetic_parser.add_argument(
+    '--languages',
+    metavar='MIX',
+    help=(
+        "Relative number of files per language, e.g. 'python=2,c=1,c++=1' (default: an"
+        " equal mix of every language)."
+    ),
+)
+
+synthetic_parser.add_argument(
+    '--comment-density',
+    type=float,
+    default=0.5,
+    help="Fraction of functions preceded by a comment, from 0 to 1 (default: 0.5).",
+)
+
+synthetic_parser.add_argument(
+    '--functions-per-file',
+    type=int,
+    default=20,
+    help="Number of functions in each source file (default: 20).",
+)
+
+synthetic_parser.add_argument(
+    '--commits',
+    type=int,
+    default=50,
+    help="Depth of the repository's history, in commits (default: 50).",
+)
+
+synthetic_parser.add_argument(
+    '--authors',
+    type=int,
+    default=5,
+    help="Number of distinct commit authors (default: 5).",
+)
+
+synthetic_parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help="Seed for generating the repository (default: 0).",
+)
+
+synthetic_parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of worker processes to build with (default: number of CPUs).",
+)
+
+synthetic_parser.add_argument(
+    '--benchmarks',
+    nargs='+',
+    choices=('end-to-end', 'comments', 'changelogs'),
+    default=('end-to-end', 'comments', 'changelogs'),
+    help="Benchmarks to run (default: all).",
+)
+
+synthetic_parser.add_argument(
+    '--workdir',
+    type=Path,
+    help=(
+        "Empty directory to generate the repository and build in. It is kept afterwards"
+        " (default: a temporary directory)."
+    ),
+)
+
+compare_parser = subparsers.add_parser(
+    'compare',
+    help="Compare two results files written by 'benchmark.py --output FILE synthetic'.",
+)
+
+compare_parser.add_argument(
+    'baseline',
+    type=Path,
+    help="Results to compare against, e.g. from the previous commit.",
+)
+
+compare_parser.add_argument(
+    'results',
+    type=Path,
+    help="Results to compare.",
+)
+
+parser.add_argument(
+    '--output',
+    type=Path,
+    help="Also write results to this file as JSON.",
+)
+
+
+def _get_comment_records(path, language, translation=None, c_backend=CommentBackend.LIBCLANG):
+    '''Get (span, text) records for every comment in a file, as extraction sees them.
+
+    Return: List of (start line, start column, end line, end column, text) tuples, or
+            `None` if the comments could not be read.
+
+    '''
+    records = []
+    try:
+        for token in _get_comment_tokens_from_source_file(path, language, translation, c_backend):
+            start, end = _get_token_span(token, language)
+            records.append((*start, *end, _get_token_text(token, language)))
+
+    except TokenizationError:
+        return None
+
+    return records
+
+
+def _get_c_family_paths(repo):
+    '''Get the paths of the C/C++ files a build extracts comments from, in path order.'''
+    paths = []
+    for source_file in sorted(_enumerate_source_files(repo), key=lambda f: f.path):
+        path = repo.dir / Path(source_file.path)
+        candidate_languages = get_candidate_languages(path)
+        if candidate_languages and candidate_languages[0] in (Language.C, Language.CPP):
+            paths.append(path)
+
+    return paths
+
+
+def lexer_agreement(repo_names=None, max_files=None):
+    '''Measure agreement between the libclang and lexer comment backends.
+
+    For each C/C++ file that the build would extract comments from (see
+    `_enumerate_source_files()`), libclang validates the file and extracts its comments,
+    and the lexer extracts comments from the same file. Files libclang accepts are lexed
+    as the language libclang validated them as, so that comment records can be compared
+    directly; files libclang rejects are counted, since the lexer backend would include
+    them.
+
+    `repo_names`: Names of repositories to benchmark. If `None` (default), benchmark every
+                  downloaded repository in repolist.txt.
+    `max_files`: Maximum number of files to benchmark per repository. If `None` (default),
+                 benchmark every C/C++ file.
+
+    Return: Dict of (repository name -> dict of results).
+
+    '''
+    results = {}
+
+    for repo in RepoManager.get_repolist():
+        if repo_names is not None and repo.name not in repo_names:
+            continue
+
+        if not repo.is_available():
+            logging.warning(f"{repo.name}: Not downloaded; skipping.")
+            continue
+
+        logging.info(f"{repo.name}")
+
+        repo_results = {
+            'files': 0,
+            'files-rejected-by-libclang': 0,
+            'files-unreadable': 0,
+            'files-agreeing': 0,
+            'libclang-comments': 0,
+            'lexer-comments': 0,
+            'matching-comments': 0,
+            'libclang-seconds': 0.0,
+            'lexer-seconds': 0.0,
+            'disagreeing-files': [],
+        }
+
+        for path in _get_c_family_paths(repo):
+            if max_files is not None and repo_results['files'] >= max_files:
+                break
+
+            candidate_languages = get_candidate_languages(path)
+            repo_results['files'] += 1
+
+            start_time = time.perf_counter()
+            language, translation = _validate_source_file(path)
+            if language:
+                libclang_records = _get_comment_records(path, language, translation)
+            repo_results['libclang-seconds'] += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            lexer_records = _get_comment_records(
+                path,
+                language or candidate_languages[0],
+                c_backend=CommentBackend.LEXER,
+            )
+            repo_results['lexer-seconds'] += time.perf_counter() - start_time
+
+            if not language:
+                repo_results['files-rejected-by-libclang'] += 1
+                continue
+
+            if libclang_records is None or lexer_records is None:
+                repo_results['files-unreadable'] += 1
+                continue
+
+            matching = sum((Counter(libclang_records) & Counter(lexer_records)).values())
+            repo_results['libclang-comments'] += len(libclang_records)
+            repo_results['lexer-comments'] += len(lexer_records)
+            repo_results['matching-comments'] += matching
+
+            if matching == len(libclang_records) == len(lexer_records):
+                repo_results['files-agreeing'] += 1
+            else:
+                repo_results['disagreeing-files'].append(
+                    str(path.relative_to(repo.dir))
+                )
+
+        results[repo.name] = repo_results
+
+        compared_files = (
+            repo_results['files']
+            - repo_results['files-rejected-by-libclang']
+            - repo_results['files-unreadable']
+        )
+        print(f"{repo.name} files: {repo_results['files']}")
+        print(f"{repo.name} files rejected by libclang: {repo_results['files-rejected-by-libclang']}")
+        print(f"{repo.name} files agreeing: {repo_results['files-agreeing']}/{compared_files}")
+        print(
+            f"{repo.name} comments matching: {repo_results['matching-comments']}"
+            f" (libclang: {repo_results['libclang-comments']},"
+            f" lexer: {repo_results['lexer-comments']})"
+        )
+        print(f"{repo.name} libclang seconds: {repo_results['libclang-seconds']:.3f}")
+        print(f"{repo.name} lexer seconds: {repo_results['lexer-seconds']:.3f}")
+        for disagreeing_file in repo_results['disagreeing-files'][:10]:
+            print(f"{repo.name} disagreeing file: {disagreeing_file}")
+        print()
+
+    return results
+
+
+def clang_parse(repo_names=None, max_files=None, modes=tuple(ClangParseMode)):
+    '''Measure how a libclang parse mode changes parse time and validation verdicts.
+
+    Each C/C++ file that the build would extract comments from (see
+    `_enumerate_source_files()`) is validated, and its comments extracted, once in each
+    mode, as comment extraction would. Files validated as the same language in both modes have
+    their comment records compared.
+
+    `repo_names`: Names of repositories to benchmark. If `None` (default), benchmark every
+                  downloaded repository in repolist.txt.
+    `max_files`: Maximum number of files to benchmark per repository. If `None` (default),
+                 benchmark every C/C++ file.
+    `modes`: Pair of ClangParseMode enum values: the baseline mode, and the mode compared
+             to it.
+
+    Return: Dict of (repository name -> dict of results).
+
+    '''
+    baseline_mode, mode = modes
+    results = {}
+
+    for repo in RepoManager.get_repolist():
+        if repo_names is not None and repo.name not in repo_names:
+            continue
+
+        if not repo.is_available():
+            logging.warning(f"{repo.name}: Not downloaded; skipping.")
+            continue
+
+        logging.info(f"{repo.name}")
+
+        repo_results = {
+            'files': 0,
+            'files-agreeing': 0,
+            'files-unreadable': 0,
+            f'{baseline_mode}-parse-seconds': 0.0,
+            f'{mode}-parse-seconds': 0.0,
+            f'{baseline_mode}-lexing-seconds': 0.0,
+            f'{mode}-lexing-seconds': 0.0,
+            'verdict-changes': Counter(),
+            'disagreeing-files': [],
+        }
+
+        for path in _get_c_family_paths(repo):
+            if max_files is not None and repo_results['files'] >= max_files:
+                break
+
+            repo_results['files'] += 1
+
+            languages = []
+            records = []
+            for parse_mode in modes:
+                start_time = time.perf_counter()
+                language, translation = _validate_source_file(path, parse_mode=parse_mode)
+                repo_results[f'{parse_mode}-parse-seconds'] += time.perf_counter() - start_time
+
+                start_time = time.perf_counter()
+                languages.append(language)
+                records.append(
+                    _get_comment_records(path, language, translation) if language else None
+                )
+                repo_results[f'{parse_mode}-lexing-seconds'] += time.perf_counter() - start_time
+
+            if languages[0] != languages[1]:
+                repo_results['verdict-changes'][f'{languages[0]} -> {languages[1]}'] += 1
+                repo_results['disagreeing-files'].append(str(path.relative_to(repo.dir)))
+
+            elif languages[0] and None in records:
+                repo_results['files-unreadable'] += 1
+
+            elif records[0] == records[1]:
+                repo_results['files-agreeing'] += 1
+
+            else:
+                repo_results['disagreeing-files'].append(str(path.relative_to(repo.dir)))
+
+        results[repo.name] = repo_results
+
+        baseline_seconds = repo_results[f'{baseline_mode}-parse-seconds']
+        seconds = repo_results[f'{mode}-parse-seconds']
+        print(f"{repo.name} files: {repo_results['files']}")
+        print(
+            f"{repo.name} files agreeing: {repo_results['files-agreeing']}"
+            f"/{repo_results['files'] - repo_results['files-unreadable']}"
+        )
+        for change, count in sorted(repo_results['verdict-changes'].items()):
+            print(f"{repo.name} verdict changed {change}: {count}")
+        print(f"{repo.name} {baseline_mode} parse seconds: {baseline_seconds:.3f}")
+        print(
+            f"{repo.name} {mode} parse seconds: {seconds:.3f}"
+            + (f" ({baseline_seconds / seconds:.2f}x)" if seconds else "")
+        )
+        for disagreeing_file in repo_results['disagreeing-files'][:10]:
+            print(f"{repo.name} disagreeing file: {disagreeing_file}")
+        print()
+
+    return results
+
+
+def _classify_comment_as_code_per_comment(comment, language):
+    '''Classify a comment as code the way build notes were written before batching.'''
+    if is_comment_code(comment, language):
+        return CodeVerdict.EXCLUDED
+    elif validate_source_text_language(trim_comment_as_code(comment, language)):
+        return CodeVerdict.INCLUDED
+    else:
+        return CodeVerdict.NOT_CODE
+
+
+def comment_code(repo_names=None):
+    '''Measure batched code classification of comments against per-comment checks.
+
+    Comments are read from extracted comment corpus files, so the corpus should have been
+    built without build notes, which would have dropped commented-out code from it.
+
+    `repo_names`: Names of repositories to benchmark. If `None` (default), benchmark every
+                  repository in repolist.txt.
+
+    Return: Dict of (repository name -> dict of results).
+
+    '''
+    results = {}
+
+    for repo in RepoManager.get_repolist():
+        if repo_names is not None and repo.name not in repo_names:
+            continue
+
+        path = CORPUSDIR_PATH / Path(f'{NoteType.COMMENT}.{repo.name}.xml')
+        corpus_paths = get_corpus_file_paths(path)
+        if not corpus_paths:
+            logging.warning(f"{repo.name}: {path} does not exist; skipping.")
+            continue
+
+        logging.info(f"{repo.name}")
+
+        comments_by_language = {}
+        for corpus_path in corpus_paths:
+            for note in ElementTree.parse(corpus_path).getroot():
+                comments_by_language.setdefault(
+                    Language(note.findtext('language')), []
+                ).append(note.findtext('raw') or '')
+
+        repo_results = {
+            'comments': 0,
+            'disagreeing-comments': 0,
+            'per-comment-seconds': 0.0,
+            'batched-seconds': 0.0,
+            'stages': Counter(),
+            'verdicts': Counter(),
+        }
+
+        for language, comments in comments_by_language.items():
+            start_time = time.perf_counter()
+            reference_verdicts = [
+                _classify_comment_as_code_per_comment(comment, language)
+                for comment in comments
+            ]
+            repo_results['per-comment-seconds'] += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            verdicts = classify_comments_as_code(comments, language, repo_results['stages'])
+            repo_results['batched-seconds'] += time.perf_counter() - start_time
+
+            repo_results['comments'] += len(comments)
+            repo_results['disagreeing-comments'] += sum(
+                reference_verdict != verdict
+                for reference_verdict, verdict in zip(reference_verdicts, verdicts)
+            )
+            repo_results['verdicts'].update(verdicts)
+
+        results[repo.name] = repo_results
+
+        print(f"{repo.name} comments: {repo_results['comments']}")
+        print(f"{repo.name} disagreeing comments: {repo_results['disagreeing-comments']}")
+        for stage, count in repo_results['stages'].items():
+            print(f"{repo.name} decided by {stage}: {count}")
+        for verdict, count in repo_results['verdicts'].items():
+            print(f"{repo.name} {verdict}: {count}")
+        print(f"{repo.name} per-comment seconds: {repo_results['per-comment-seconds']:.3f}")
+        print(f"{repo.name} batched seconds: {repo_results['batched-seconds']:.3f}")
+        print()
+
+    return results
+
+
+_SYNTHETIC_WORDS = (
+    'the', 'value', 'buffer', 'is', 'returned', 'when', 'a', 'caller', 'needs', 'it',
+    'this', 'function', 'computes', 'an', 'offset', 'into', 'table', 'of', 'entries',
+    'we', 'must', 'not', 'free', 'memory', 'here', 'because', 'owner', 'still', 'uses',
+    'handle', 'errors', 'from', 'parser', 'and', 'update', 'index', 'before', 'loop',
+    'note', 'that', 'each', 'item', 'should', 'be', 'sorted', 'by', 'key', 'first',
+)
+'''Vocabulary of the natural-language text in generated repositories.'''
+
+_SYNTHETIC_EXTENSIONS = {
+    Language.C: '.c',
+    Language.CPP: '.cpp',
+    Language.PYTHON: '.py',
+}
+
+_SYNTHETIC_EPOCH = 1600000000
+'''Timestamp of the first commit of generated repositories.'''
+
+_SYNTHETIC_REPO_NAME = 'synthetic'
+
+
+def _parse_language_mix(s):
+    '''Parse a language mix such as 'python=2,c=1,c++=1' into a dict of (Language -> weight).'''
+    mix = {}
+    for item in s.split(','):
+        language, _, weight = item.partition('=')
+        mix[Language(language.strip())] = float(weight) if weight else 1.0
+
+    return mix
+
+
+def _synthetic_sentence(rng):
+    words = rng.choices(_SYNTHETIC_WORDS, k=rng.randint(4, 12))
+    return f"{' '.join(words).capitalize()}."
+
+
+def _synthetic_comment(rng):
+    '''Generate the lines of a comment, without delimiters.
+
+    Most comments are prose; some are commented-out code, so that classification of
+    comments as code is exercised too.
+
+    '''
+    if rng.random() < 0.1:
+        return [f"x = func_{rng.randrange(100)}(x)"]
+
+    return [_synthetic_sentence(rng) for line in range(rng.randint(1, 3))]
+
+
+def _render_synthetic_file(language, comments):
+    '''Render a source file with one function for each of `comments`.
+
+    `comments`: List of comments (lists of lines) or `None`, one for each function, to
+                place before the function.
+
+    Return: File contents as a string.
+
+    '''
+    lines = []
+    for index, comment in enumerate(comments):
+        if language == Language.PYTHON:
+            lines.extend(f"# {line}" for line in comment or ())
+            lines.extend([f"def func_{index}(x):", f"    return x + {index}", "", ""])
+
+        else:
+            if comment and index % 2:
+                lines.append(f"/* {comment[0]}")
+                lines.extend(f" * {line}" for line in comment[1:])
+                lines.append(" */")
+            else:
+                lines.extend(f"// {line}" for line in comment or ())
+            lines.extend([f"int func_{index}(int x)", "{", f"    return x + {index};", "}", ""])
+
+    return "\n".join(lines)
+
+
+def generate_synthetic_repo(
+        path,
+        files=200,
+        language_mix=None,
+        comment_density=0.5,
+        functions_per_file=20,
+        commits=50,
+        authors=5,
+        seed=0,
+):
+    '''Generate a bare git repository of source files with comments and history.
+
+    The first commit adds every file. Each later commit rewrites some of the comments of
+    about a tenth of the files, so blame attributes comments to many commits. The
+    repository is generated with `git fast-import`, and is the same for the same
+    arguments.
+
+    `path`: Path to create the repository at. Should end in ".git".
+    `files`: Number of source files.
+    `language_mix`: Dict of (Language enum value -> relative number of files). If `None`
+                    (default), use an equal mix of every language.
+    `comment_density`: Fraction of functions preceded by a comment.
+    `functions_per_file`: Number of functions in each source file.
+    `commits`: Number of commits in the history.
+    `authors`: Number of distinct commit authors.
+    `seed`: Seed for the random generator.
+
+    Return: `path`.
+
+    '''
+    if commits < 1:
+        raise ValueError(f"A repository needs at least 1 commit, not {commits}.")
+
+    path = Path(path)
+    rng = random.Random(seed)
+    if language_mix is None:
+        language_mix = {language: 1.0 for language in _SYNTHETIC_EXTENSIONS}
+
+    languages = rng.choices(list(language_mix), weights=list(language_mix.values()), k=files)
+    paths = [
+        f"pkg{index % 16:02d}/module_{index:05d}{_SYNTHETIC_EXTENSIONS[language]}"
+        for index, language in enumerate(languages)
+    ]
+
+    def comment_or_none():
+        return _synthetic_comment(rng) if rng.random() < comment_density else None
+
+    file_comments = [
+        [comment_or_none() for function in range(functions_per_file)]
+        for index in range(files)
+    ]
+
+    subprocess.run(['git', 'init', '--bare', '--quiet', str(path)], check=True)
+    fast_import = subprocess.Popen(
+        ['git', 'fast-import', '--quiet'],
+        cwd=path,
+        stdin=subprocess.PIPE,
+    )
+
+    def write_data(data):
+        data = data.encode('utf-8')
+        fast_import.stdin.write(f"data {len(data)}\n".encode('utf-8'))
+        fast_import.stdin.write(data)
+        fast_import.stdin.write(b"\n")
+
+    for commit in range(commits):
+        if commit == 0:
+            changed_files = range(files)
+        else:
+            changed_files = sorted(rng.sample(range(files), k=max(1, files // 10)))
+            for index in changed_files:
+                for function in rng.sample(
+                        range(functions_per_file),
+                        k=max(1, functions_per_file // 4),
+                ):
+                    file_comments[index][function] = comment_or_none()
+
+        author = rng.randrange(authors)
+        signature = (
+            f"Author {author} <author{author}@example.com>"
+            f" {_SYNTHETIC_EPOCH + 3600*commit} +0000"
+        )
+        message = " ".join(_synthetic_sentence(rng) for sentence in range(rng.randint(1, 4)))
+
+        fast_import.stdin.write(f"commit refs/heads/main\n".encode('utf-8'))
+        fast_import.stdin.write(f"author {signature}\n".encode('utf-8'))
+        fast_import.stdin.write(f"committer {signature}\n".encode('utf-8'))
+        write_data(message)
+        for index in changed_files:
+            fast_import.stdin.write(f"M 100644 inline {paths[index]}\n".encode('utf-8'))
+            write_data(_render_synthetic_file(languages[index], file_comments[index]))
+
+    fast_import.stdin.close()
+    if fast_import.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {path}")
+
+    subprocess.run(
+        ['git', 'symbolic-ref', 'HEAD', 'refs/heads/main'],
+        cwd=path,
+        check=True,
+    )
+
+    return path
+
+
+def _get_peak_rss(who):
+    '''Get the peak resident set size, in bytes, of `resource.RUSAGE_SELF` or `RUSAGE_CHILDREN`.'''
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _run_measured(function, workdir):
+    '''Run `function` in a child process whose working directory is `workdir`.
+
+    Running each benchmark in its own process gives it its own peak RSS, and its own
+    worker processes.
+
+    Return: Pair of (dict returned by `function`, dict of peak RSS measurements).
+
+    '''
+    context = mp.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    def run():
+        try:
+            os.chdir(workdir)
+            logging.getLogger().setLevel(logging.WARNING)
+            result = function()
+            sender.send((result, {
+                'peak-rss-bytes': _get_peak_rss(resource.RUSAGE_SELF),
+                'peak-worker-rss-bytes': _get_peak_rss(resource.RUSAGE_CHILDREN),
+            }, None))
+
+        except BaseException:
+            sender.send((None, None, traceback.format_exc()))
+
+    process = context.Process(target=run)
+    process.start()
+    sender.close()
+    try:
+        result, peak_rss, error = receiver.recv()
+    except EOFError:
+        result, peak_rss, error = None, None, f"Exit code {process.exitcode}"
+    process.join()
+
+    if error is not None:
+        raise RuntimeError(f"Benchmark failed:\n{error}")
+
+    return result, peak_rss
+
+
+def _count_corpus_notes(path):
+    '''Count the notes in a corpus file, or in all of its shards.'''
+    return sum(
+        1
+        for corpus_path in get_corpus_file_paths(path)
+        for event, elt in ElementTree.iterparse(corpus_path)
+        if elt.tag == 'note'
+    )
+
+
+def _benchmark_end_to_end(jobs):
+    '''Run the full build (download, extract, annotate) of the repolist.'''
+    start_time = time.perf_counter()
+    build_main(['-q', '--redo', '-j', str(jobs)])
+    seconds = time.perf_counter() - start_time
+
+    repo = RepoManager.get_repolist()[0]
+    return {
+        'seconds': seconds,
+        'files': len(_enumerate_source_files(repo)),
+        'notes': sum(
+            _count_corpus_notes(CORPUSDIR_PATH / Path(f'{note_type}.{repo.name}.xml'))
+            for note_type in NoteType
+        ),
+    }
+
+
+def _benchmark_comments(jobs):
+    '''Extract comments from the downloaded repository, as the build's extract step does.'''
+    repo = RepoManager.get_repolist()[0]
+
+    start_time = time.perf_counter()
+    extract_data(note_types=(NoteType.COMMENT,), jobs=jobs)
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'seconds': seconds,
+        'files': len(_enumerate_source_files(repo)),
+        'notes': _count_corpus_notes(CORPUSDIR_PATH / Path(f'{NoteType.COMMENT}.{repo.name}.xml')),
+    }
+
+
+def _benchmark_changelogs(jobs):
+    '''Extract changelogs from the downloaded repository, as the build's extract step does.'''
+    repo = RepoManager.get_repolist()[0]
+
+    start_time = time.perf_counter()
+    extract_data(note_types=(NoteType.CHANGELOG,), jobs=jobs)
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'seconds': seconds,
+        'commits': repo.count_commits(),
+        'notes': _count_corpus_notes(
+            CORPUSDIR_PATH / Path(f'{NoteType.CHANGELOG}.{repo.name}.xml')
+        ),
+    }
+
+
+def _get_source_revision():
+    '''Get the git revision of this source tree, and whether it has local changes.'''
+    source_dir = Path(__file__).resolve().parent
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=source_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=source_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip())
+
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return revision, dirty
+
+
+def synthetic(
+        files=200,
+        language_mix=None,
+        comment_density=0.5,
+        functions_per_file=20,
+        commits=50,
+        authors=5,
+        seed=0,
+        jobs=None,
+        benchmarks=('end-to-end', 'comments', 'changelogs'),
+        workdir=None,
+):
+    '''Measure build throughput on a generated repository.
+
+    The repository is generated by `generate_synthetic_repo()` and listed, by file URL, in
+    the repolist of a fresh working directory. The full build runs first, downloading the
+    repository; comment and changelog extraction then run on the downloaded copy. Each
+    benchmark runs in its own process.
+
+    `jobs`: Number of worker processes to build with. If `None` (default), use one worker
+            per CPU.
+    `benchmarks`: Names of benchmarks to run, from 'end-to-end', 'comments' and
+                  'changelogs'.
+    `workdir`: Empty directory to work in. If `None` (default), use a temporary directory.
+
+    Other parameters are as for `generate_synthetic_repo()`.
+
+    Return: Dict of results, including the parameters and the source revision they were
+            measured at.
+
+    '''
+    jobs = jobs or os.cpu_count()
+    parameters = {
+        'files': files,
+        'language-mix': {
+            str(language): weight
+            for language, weight in (language_mix or {
+                language: 1.0 for language in _SYNTHETIC_EXTENSIONS
+            }).items()
+        },
+        'comment-density': comment_density,
+        'functions-per-file': functions_per_file,
+        'commits': commits,
+        'authors': authors,
+        'seed': seed,
+        'jobs': jobs,
+    }
+    revision, dirty = _get_source_revision()
+    results = {
+        'revision': revision,
+        'dirty': dirty,
+        'parameters': parameters,
+        'benchmarks': {},
+    }
+
+    with (TemporaryDirectory() if workdir is None else nullcontext(workdir)) as workdir:
+        workdir = Path(workdir).resolve()
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        logging.info("Generating repository...")
+        repo_path = generate_synthetic_repo(
+            workdir / Path('upstream') / Path(f'{_SYNTHETIC_REPO_NAME}.git'),
+            files=files,
+            language_mix=language_mix,
+            comment_density=comment_density,
+            functions_per_file=functions_per_file,
+            commits=commits,
+            authors=authors,
+            seed=seed,
+        )
+        with open(workdir / REPOLIST_PATH, 'w') as repolist_file:
+            repolist_file.write(f"{repo_path.as_uri()},HEAD\n")
+
+        benchmark_functions = {
+            'end-to-end': _benchmark_end_to_end,
+            'comments': _benchmark_comments,
+            'changelogs': _benchmark_changelogs,
+        }
+        # The full build downloads the repository the other benchmarks use.
+        if 'end-to-end' not in benchmarks:
+            _run_measured(partial(download_repos, jobs=1), workdir)
+
+        for name in benchmark_functions:
+            if name not in benchmarks:
+                continue
+
+            logging.info(f"{name}")
+            result, peak_rss = _run_measured(partial(benchmark_functions[name], jobs), workdir)
+            for count in ('files', 'commits', 'notes'):
+                if count in result:
+                    result[f'{count}-per-second'] = (
+                        result[count] / result['seconds'] if result['seconds'] else 0
+                    )
+            result.update(peak_rss)
+            results['benchmarks'][name] = result
+
+            for key, value in result.items():
+                print(f"{name} {key}: {value:.3f}" if isinstance(value, float) else f"{name} {key}: {value}")
+            print()
+
+    return results
+
+
+_COMPARED_METRICS = (
+    'files-per-second',
+    'commits-per-second',
+    'notes-per-second',
+    'peak-rss-bytes',
+    'peak-worker-rss-bytes',
+)
+
+
+def compare(baseline_path, results_path):
+    '''Compare two results files written by the 'synthetic' benchmark.
+
+    Results files are written with the top-level `--output` option, which comes before
+    the subcommand: `benchmark.py --output FILE synthetic`.
+
+    Return: Dict of (benchmark name -> dict of (metric -> ratio of result to baseline)).
+
+    '''
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(results_path) as results_file:
+        results = json.load(results_file)
+
+    if baseline['parameters'] != results['parameters']:
+        logging.warning("Results were measured with different parameters.")
+
+    print(f"baseline revision: {baseline['revision']}{' (dirty)' if baseline['dirty'] else ''}")
+    print(f"results revision: {results['revision']}{' (dirty)' if results['dirty'] else ''}")
+    print()
+
+    ratios = {}
+    for name, benchmark_results in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+
+        ratios[name] = {}
+        for metric in _COMPARED_METRICS:
+            old = baseline['benchmarks'][name].get(metric)
+            new = benchmark_results.get(metric)
+            if old is None or new is None:
+                continue
+
+            ratios[name][metric] = new / old if old else None
+            change = f"{new / old - 1:+.1%}" if old else "n/a"
+            print(f"{name} {metric}: {old:.1f} -> {new:.1f} ({change})")
+        print()
+
+    return ratios
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+    logging.getLogger().setLevel(logging.INFO)
+
+    if args.benchmark == 'lexer-agreement':
+        results = lexer_agreement(args.repos, args.max_files)
+
+    elif args.benchmark == 'clang-parse':
+        results = clang_parse(args.repos, args.max_files, args.modes)
+
+    elif args.benchmark == 'comment-code':
+        results = comment_code(args.repos)
+
+    elif args.benchmark == 'synthetic':
+        results = synthetic(
+            files=args.files,
+            language_mix=_parse_language_mix(args.languages) if args.languages else None,
+            comment_density=args.comment_density,
+            functions_per_file=args.functions_per_file,
+            commits=args.commits,
+            authors=args.authors,
+            seed=args.seed,
+            jobs=args.jobs,
+            benchmarks=args.benchmarks,
+            workdir=args.workdir,
+        )
+
+    elif args.benchmark == 'compare':
+        results = compare(args.baseline, args.results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__': main(sys.argv[1:])
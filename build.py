@@ -3,39 +3,78 @@
 
 # TODO clean up imports
 
+from defines import ClangParseMode
+from defines import CloneMode
+from defines import CodeVerdict
+from defines import CommentBackend
 from defines import ConstructionStep
 from defines import Language
 from defines import NoteType
+from defines import QuarantineReason
 from defines import BUILDNOTESDIR_PATH
 from defines import BUILDNOTES_INCLUDED_CODE_PATH
 from defines import BUILDNOTES_EXCLUDED_CODE_PATH
+from defines import BUILDNOTES_CPROFILEDIR_PATH
+from defines import BUILDNOTES_PROFILE_PATH
 from defines import CORPUSDIR_PATH
+from defines import EXTRACTION_JOURNAL_PATH
 from defines import LIBCLANG_HEADER_PATH
 from defines import REPOLIST_PATH
 from defines import REPODIR_PATH
+from cache import AnnotationCache
+from cache import ExtractionCache
+from cache import Quarantine
+from columnar import write_binary_corpus
+from corpus import NoteWriter
+from corpus import get_corpus_file_paths
+from corpus import OutputJournal
+from lexer import CommentToken
+from lexer import lex_file_comments
+from profiling import BuildProfile
+from profiling import StageTimes
+from profiling import timed
+from profiling import timed_iter
 from repo import BlameIndex
+from repo import CommitMetadataTable
 from repo import RepoManager
+from scheduler import RestartingProcessPool
+from scheduler import Task
+from scheduler import recover_lost_work
+from scheduler import run_tasks
 
 from argparse import ArgumentParser
-from collections import deque
+from collections import Counter
 from collections import namedtuple
-from hashlib import sha256 as anon_hash
+from contextlib import ExitStack
+from contextlib import contextmanager
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from nltk.tag import pos_tag
 from nltk.tokenize import sent_tokenize
 from nltk.tokenize import word_tokenize
 from pathlib import Path
-import threading
-from threading import Thread
+from pathlib import PurePosixPath
 from xml.etree import ElementTree
 
 import ast
 import clang.cindex
-import itertools as itr
+import cProfile
+import faulthandler
+import fnmatch
+import keyword
 import logging
 import multiprocessing as mp
+import nltk
+import os
 import re
+import resource
 import shutil
+import signal
 import sys
+import threading
+import time
 import tokenize
 
 
@@ -44,6 +83,24 @@ import tokenize
 
 _CommentAuthorPair = namedtuple('_CommentAuthorPair', ('comment', 'authors'))
 _TextPos = namedtuple('_TextPos', ('line', 'column'))
+_WorkerResult = namedtuple(
+    '_WorkerResult',
+    (
+        'notes',
+        'worker',
+        'commit_metadata_stats',
+        'build_notes',
+        'code_stage_counts',
+        'profile',
+        'quarantined',
+    ),
+    defaults=(None, None, None, None),
+)
+_WorkProfile = namedtuple('_WorkProfile', ('language', 'stage_times', 'wall', 'cpu'))
+_AnnotationResult = namedtuple('_AnnotationResult', ('annotations', 'stage_times'))
+_BuildNotes = namedtuple('_BuildNotes', ('included_code', 'excluded_code'))
+_FileBudget = namedtuple('_FileBudget', ('time_limit', 'memory_limit'))
+_CommentOutputs = namedtuple('_CommentOutputs', ('writer', 'build_notes'))
 
 
 parser = ArgumentParser()
@@ -57,9 +114,15 @@ parser.add_argument(
 parser.add_argument(
     '--redo-from',
     choices=('download', 'extract', 'annotate'),
+    help="Partially rebuild corpus beginning from a particular step.",
+)
+
+parser.add_argument(
+    '--resume',
+    action='store_true',
     help=(
-        "Partially rebuild corpus beginning from a particular step."
-        " Not currently implemented for 'annotate'."
+        "Resume an interrupted extraction, keeping the files it finished, then continue"
+        " with later steps."
     ),
 )
 
@@ -72,8 +135,6 @@ parser.add_argument(
     ),
 )
 
-# TODO implement annotate redo
-
 # TODO implement
 # parser.add_argument(
 #     '--redo-extract',
@@ -119,9 +180,230 @@ parser.add_argument(
     help="Write information about corpus construction to build_notes directory.",
 )
 
+parser.add_argument(
+    '--shard-notes',
+    type=int,
+    help="Split each corpus file into shards of at most this many notes.",
+)
+
+parser.add_argument(
+    '--shard-bytes',
+    type=int,
+    help=(
+        "Split each corpus file into shards of about this many bytes. Shards are listed"
+        " in a manifest next to them."
+    ),
+)
+
+parser.add_argument(
+    '--c-backend',
+    choices=tuple(CommentBackend),
+    default=CommentBackend.LIBCLANG,
+    help=(
+        "How to extract comments from C and C++ files (default: libclang). 'lexer' only"
+        " lexes files for comments, which is much faster, but does not validate that"
+        " files parse; their language is taken from their extension ('.h' is C)."
+    ),
+)
+
+parser.add_argument(
+    '--clang-parse-mode',
+    choices=tuple(ClangParseMode),
+    default=ClangParseMode.FULL,
+    help=(
+        "How libclang parses C and C++ files (default: full). 'fast' skips function"
+        " bodies, which is much faster on large files, but accepts files with syntax"
+        " errors inside function bodies. Ignored by the lexer backend."
+    ),
+)
+
+parser.add_argument(
+    '--file-time-limit',
+    type=float,
+    metavar='SECONDS',
+    help=(
+        "Give up on extracting comments from a source file after this many seconds, and"
+        " quarantine it. Quarantined files are skipped by later builds until they change."
+    ),
+)
+
+parser.add_argument(
+    '--file-memory-limit',
+    type=int,
+    metavar='MB',
+    help=(
+        "Give up on extracting comments from a source file if that takes more than this"
+        " many megabytes of additional address space, and quarantine it."
+    ),
+)
+
+parser.add_argument(
+    '--clear-quarantine',
+    action='store_true',
+    help="Release all quarantined source files before extracting.",
+)
+
+parser.add_argument(
+    '--include',
+    nargs='+',
+    metavar='PATTERN',
+    help=(
+        "Only extract comments from files whose path within their repository matches one"
+        " of these fnmatch-style patterns."
+    ),
+)
+
+parser.add_argument(
+    '--exclude',
+    nargs='+',
+    metavar='PATTERN',
+    help=(
+        "Do not extract comments from files whose path within their repository matches"
+        " one of these fnmatch-style patterns."
+    ),
+)
+
+parser.add_argument(
+    '--max-file-size',
+    type=int,
+    metavar='BYTES',
+    help="Do not extract comments from files larger than this.",
+)
+
+parser.add_argument(
+    '--no-extraction-cache',
+    action='store_true',
+    help="Do not read or write cached per-file comment extraction results.",
+)
+
+parser.add_argument(
+    '--clear-extraction-cache',
+    action='store_true',
+    help="Delete all cached comment extraction results before extracting.",
+)
+
+parser.add_argument(
+    '--gc-extraction-cache',
+    action='store_true',
+    help=(
+        "After extracting, delete cached comment extraction results that were not used"
+        " by this build."
+    ),
+)
+
+parser.add_argument(
+    '--annotation-cache-size',
+    type=int,
+    default=100000,
+    help=(
+        "Maximum number of distinct texts whose annotations are cached (default: 100000)."
+        " 0 disables the annotation cache."
+    ),
+)
+
+parser.add_argument(
+    '--persist-annotation-cache',
+    action='store_true',
+    help="Load the annotation cache from, and save it to, the cache directory.",
+)
+
+parser.add_argument(
+    '--clone-mode',
+    choices=tuple(CloneMode),
+    default=CloneMode.FULL,
+    help=(
+        "How much history to download (default: full). 'blobless' downloads file"
+        " contents only when they are needed; 'single-revision' downloads only the"
+        " checked-out revision, so blame attributes every comment to it."
+    ),
+)
+
+parser.add_argument(
+    '--update-mirrors',
+    action='store_true',
+    help=(
+        "Fetch into previously mirrored repositories before checking them out, instead"
+        " of reusing the mirrors as they are."
+    ),
+)
+
+parser.add_argument(
+    '--binary',
+    action='store_true',
+    help=(
+        "After annotating, also write each corpus file in the binary columnar format"
+        " read by CccReader(CorpusFormat.BINARY)."
+    ),
+)
+
+parser.add_argument(
+    '--profile',
+    action='store_true',
+    help=(
+        f"Time each stage of construction, by repository and language, and report the"
+        f" timings and the slowest files to {BUILDNOTES_PROFILE_PATH}."
+    ),
+)
+
+parser.add_argument(
+    '--profile-sample',
+    type=float,
+    default=0,
+    metavar='RATE',
+    help=(
+        "With --profile, also run cProfile on about this fraction of source files (0 to 1)"
+        f" during extraction, dumping statistics to {BUILDNOTES_CPROFILEDIR_PATH}."
+    ),
+)
+
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=mp.cpu_count(),
+    help=(
+        "Number of worker processes to use for extraction and annotation, and number of"
+        " repositories to download at once (default: number of CPUs)."
+    ),
+)
+
 
 WRITE_BUILD_NOTES = False
 
+_IN_FLIGHT_FILES_PER_JOB = 4
+'''Number of files per worker process that may be queued or awaiting output at once.'''
+
+_BUILD_NOTES_SEPARATOR = f"{'<>'*32}\n"
+'''Line written after each comment in a build notes file.'''
+
+_ANNOTATION_BATCH_SIZE = 64
+'''Number of notes sent to a worker process at a time for annotation.'''
+
+_CHANGELOG_BATCH_SIZE = 256
+'''Number of commits sent to a worker process at a time for changelog extraction.'''
+
+_COMMENT_SECONDS_PER_BYTE = 1e-5
+'''Estimated worker time to extract the comments of one byte of source files.'''
+
+_CHANGELOG_SECONDS_PER_COMMIT = 1.25e-4
+'''Estimated worker time to extract the changelog of one commit.'''
+
+ANNOTATOR_VERSION = f'1-nltk{nltk.__version__}'
+'''Version of the annotator.
+
+Increment the leading number whenever a change to annotation would change the tokens or
+POS tags produced for a text, so that stale annotation cache entries are not reused.
+
+'''
+
+EXTRACTOR_VERSION = 2
+'''Version of the comment extractor.
+
+Increment whenever a change to extraction would change the raw notes produced for a file,
+so that stale extraction cache entries are not reused.
+
+'''
+
 
 class TokenizationError(Exception):
     pass
@@ -133,23 +415,39 @@ def normalize_string(s):
     return s.translate({7: ''})
 
 
-def anonymize_id(s):
-    '''Hash an identifying string to anonymize it.'''
-    return anon_hash(s.encode('utf-8')).hexdigest()[:16]
-
-
-def download_repos(force_redownload=False):
+def download_repos(
+        force_redownload=False,
+        jobs=None,
+        clone_mode=CloneMode.FULL,
+        update_mirrors=False,
+):
     '''Download repositories listed in repolist.txt.
 
+    Repositories are downloaded concurrently. Each is mirrored into the mirror cache and
+    checked out from there, so redownloading reuses the mirrors instead of fetching every
+    repository again.
+
     force_redownload: Whether to redownload previously downloaded repositories.
+    jobs: Maximum number of repositories to download at once. If `None` (default), use
+          one download per CPU.
+    clone_mode: CloneMode enum value selecting how much history to mirror.
+    update_mirrors: Whether to fetch into existing mirrors before checking out.
 
     '''
 
     logging.info("Retrieving repos...")
 
-    for repo in RepoManager.get_repolist():
-        logging.info(f" {repo.name}")
-        downloaded = repo.download(force_redownload)
+    def download(repo):
+        downloaded = repo.download(force_redownload, clone_mode, update_mirrors)
+        logging.info(f" {repo.name}{'' if downloaded else ' (already downloaded)'}")
+
+    # Downloads spend their time waiting on git, so threads suffice.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [
+                executor.submit(download, repo)
+                for repo in RepoManager.get_repolist()
+        ]:
+            future.result()
 
     logging.info("Finished retrieving repos.")
 
@@ -174,6 +472,10 @@ def strip_comment_delimiters(comment, language):
         )
 
 
+_CONSISTENT_WHITESPACE_REGEX = re.compile(r'( +|\t+)')
+'''Leading run of spaces or of tabs on a line, for `trim_comment_as_code()`.'''
+
+
 def trim_comment_as_code(comment, language):
     '''Trim comment delimiters and leading whitespace, preserving indentation.
 
@@ -185,10 +487,9 @@ def trim_comment_as_code(comment, language):
 
     # Find amount of whitespace to remove. Result is smallest number of leading
     # spaces/tabs on a line.
-    consistent_whitespace_regex = re.compile(r'( +|\t+)')
     whitespace_width = float('inf')
     for line in comment.split('\n'):
-        match = consistent_whitespace_regex.match(line)
+        match = _CONSISTENT_WHITESPACE_REGEX.match(line)
         if match and len(match.group()) < whitespace_width:
             whitespace_width = len(match.group())
 
@@ -247,57 +548,144 @@ def validate_source_text_language(text, language=None):
     return result
 
 
-def validate_source_file_language(path, language=None):
-    '''Determine whether the contents of the file at `path` is valid code in some
-    programming language.
+SOURCE_FILE_LANGUAGES = {
+    # Try C, then try C++.
+    '.c': (Language.C, Language.CPP),
+    '.h': (Language.C, Language.CPP),
+    '.cpp': (Language.CPP,),
+    '.cc': (Language.CPP,),
+    '.hpp': (Language.CPP,),
+    '.hh': (Language.CPP,),
+    '.py': (Language.PYTHON,),
+}
+'''Map of (file extension -> languages files with that extension may be written in).'''
 
-    `path`: Path to file to validate.
-    `language`: Language enum value of language to check `text` against. If `language` is
-                `None` (default), guess based on file extension.
 
-    Return: Language enum value representing programming language the contents of the file
-            at `path` belongs to, or `None`.
+def get_candidate_languages(path):
+    '''Guess which languages the file at `path` may be written in from its extension.
+
+    Return: Tuple of Language enum values, in the order they should be tried.
+
+    '''
+    return SOURCE_FILE_LANGUAGES.get(Path(path).suffix, ())
+
+
+_clang_index = None
+'''clang.cindex.Index shared by every libclang parse in the current process.'''
+
+_clang_index_pid = None
+'''ID of the process that created `_clang_index`.'''
+
+
+def _get_clang_index():
+    '''Get the long-lived clang.cindex.Index for the current process.
+
+    Creating an Index is not free, so each process creates one on first use and reuses it
+    for every file it parses. An Index inherited from a parent process is not reused.
+
+    '''
+    global _clang_index, _clang_index_pid
+
+    if _clang_index is None or _clang_index_pid != os.getpid():
+        _clang_index = clang.cindex.Index.create()
+        _clang_index_pid = os.getpid()
+
+    return _clang_index
+
+
+_CLANG_PARSE_OPTIONS = {
+    ClangParseMode.FULL: clang.cindex.TranslationUnit.PARSE_NONE,
+    ClangParseMode.FAST: (
+        clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+        | clang.cindex.TranslationUnit.PARSE_INCOMPLETE
+    ),
+}
+'''Map of (ClangParseMode enum value -> libclang translation unit parse options).
+
+Neither mode keeps a detailed preprocessing record, which comment extraction does not
+need. Neither builds a precompiled preamble either: a preamble only pays off when the
+same translation unit is reparsed, and each file is parsed once per candidate language.
+
+'''
+
+
+def _parse_c_family_file(path, language, parse_mode=ClangParseMode.FULL):
+    '''Parse a C or C++ file with libclang.
+
+    `parse_mode`: ClangParseMode enum value selecting how thoroughly the file is parsed.
+
+    Return: clang.cindex.TranslationUnit object.
+
+    '''
+    return _get_clang_index().parse(
+        path,
+        args=('--language', language, f'-I{LIBCLANG_HEADER_PATH}'),
+        options=_CLANG_PARSE_OPTIONS[parse_mode],
+    )
+
+
+def _validate_source_file(path, language=None, parse_mode=ClangParseMode.FULL):
+    '''Determine the programming language of the file at `path`, keeping its parse.
+
+    Same as `validate_source_file_language()`, but also returns the libclang translation
+    unit that C and C++ files were validated with, so that it can be reused instead of
+    parsing the file again.
+
+    `parse_mode`: ClangParseMode enum value selecting how C and C++ files are parsed.
+
+    Return: Pair of (Language enum value or `None`, clang.cindex.TranslationUnit object or
+            `None`). The translation unit is `None` unless the file was validated as C or
+            C++.
 
     '''
     path = Path(path)
 
     result = None
+    translation = None
 
     if language is None:
-        if path.suffix in ('.c', '.h'):
-            # Try C, then try C++.
-            result = validate_source_file_language(path, Language.C)
-            if not result:
-                result = validate_source_file_language(path, Language.CPP)
-
-        elif path.suffix in ('.cpp', '.cc', '.hpp', '.hh'):
-            result = validate_source_file_language(path, Language.CPP)
-
-        elif path.suffix == '.py':
-            result = validate_source_file_language(path, Language.PYTHON)
+        for candidate in get_candidate_languages(path):
+            result, translation = _validate_source_file(path, candidate, parse_mode)
+            if result:
+                break
 
     elif language in (Language.C, Language.CPP):
         try:
-            index = clang.cindex.Index.create()
-            translation = index.parse(
-                path,
-                args=('--language', language, f'-I{LIBCLANG_HEADER_PATH}')
-            )
+            translation = _parse_c_family_file(path, language, parse_mode)
             # Verify if no parse issues (parse issues are Clang diagnostic category 4).
             if all(
                     diagnostic.category_number != 4
                     for diagnostic in translation.diagnostics
             ):
                 result = language
+            else:
+                translation = None
 
-        except clang.cindex.TranslationUniteLoadError:
+        except clang.cindex.TranslationUnitLoadError:
             result = None
+            translation = None
 
     elif language == Language.PYTHON:
         with open(path) as source_file:
             result = validate_source_text_language(source_file.read(), language)
 
-    return result
+    return result, translation
+
+
+def validate_source_file_language(path, language=None, parse_mode=ClangParseMode.FULL):
+    '''Determine whether the contents of the file at `path` is valid code in some
+    programming language.
+
+    `path`: Path to file to validate.
+    `language`: Language enum value of language to check `text` against. If `language` is
+                `None` (default), guess based on file extension.
+    `parse_mode`: ClangParseMode enum value selecting how C and C++ files are parsed.
+
+    Return: Language enum value representing programming language the contents of the file
+            at `path` belongs to, or `None`.
+
+    '''
+    return _validate_source_file(path, language, parse_mode)[0]
 
 
 def is_comment_code(comment, language):
@@ -328,22 +716,142 @@ def is_comment_code(comment, language):
         )
 
 
-def _get_comment_tokens_from_source_file(path, language):
+_NAME_PAIR_REGEX = re.compile(
+    r'(?<![\w.])([A-Za-z_][A-Za-z0-9_]*)[ \t]+(?=([A-Za-z_][A-Za-z0-9_]*)(?!\w))'
+)
+'''Two ASCII names separated only by spaces or tabs, on one line.'''
+
+_CODE_STAGES = ('name-pair', 'unterminated-quote', 'parse')
+'''Stages of `classify_comments_as_code()`, in the order they are tried.'''
+
+
+def _has_name_pair(text):
+    '''Does `text` contain two adjacent names that cannot both be keywords?
+
+    Two names in a row are never valid Python unless one of them is a (soft) keyword.
+    Without quotes, backslashes or '#', no name can be inside a string, a continued line
+    or a comment.
+
+    '''
+    if any(c in text for c in '"\'\\#\0'):
+        return False
+
+    return any(
+        not (
+            keyword.iskeyword(first) or first in keyword.softkwlist
+            or keyword.iskeyword(second) or second in keyword.softkwlist
+        )
+        for first, second in (match.groups() for match in _NAME_PAIR_REGEX.finditer(text))
+    )
+
+
+def _has_unterminated_quote(text):
+    '''Is `text` a single line with a string literal that is never closed?
+
+    A string that is still open at the end of the only line of the text is never valid
+    Python. Texts with braces are not checked, since f-string replacement fields may
+    contain quotes of their own.
+
+    '''
+    line = text.rstrip('\n')
+    if any(c in line for c in '\n\r{\0'):
+        return False
+
+    i = 0
+    while i < len(line):
+        if line[i] == '#':
+            return False
+
+        if line[i] in '"\'':
+            delimiter = line[i]*3 if line.startswith(line[i]*3, i) else line[i]
+            i += len(delimiter)
+            while not line.startswith(delimiter, i):
+                if i >= len(line):
+                    return True
+                i += 2 if line[i] == '\\' else 1
+            i += len(delimiter)
+
+        else:
+            i += 1
+
+    return False
+
+
+def classify_comments_as_code(comments, language, stage_counts=None):
+    '''Decide which comments are valid code, and which of those are commented-out code.
+
+    Gives the same verdicts as calling `is_comment_code()` on each comment, then
+    `validate_source_text_language()` on those it rejects, as build notes are written.
+    Each comment is trimmed once and parsed at most once, and comments that cheap lexical
+    checks show cannot be valid Python are not parsed at all.
+
+    `comments`: Iterable of comment texts, as accumulated from a source file.
+    `language`: Language enum value of the file the comments came from.
+    `stage_counts`: collections.Counter to add, for each comment, the name of the stage
+                    that decided it to: 'name-pair' or 'unterminated-quote' (rejected
+                    without parsing), or 'parse'. If `None` (default), do not count.
+
+    Return: List of CodeVerdict enum values, one for each comment, in order.
+
+    '''
+    verdicts = []
+    for comment in comments:
+        trimmed_comment = trim_comment_as_code(comment, language)
+
+        # Python is the only language text is validated against, so only text that
+        # could be Python needs to be parsed.
+        if _has_name_pair(trimmed_comment):
+            stage, valid = 'name-pair', False
+        elif _has_unterminated_quote(trimmed_comment):
+            stage, valid = 'unterminated-quote', False
+        else:
+            stage, valid = 'parse', bool(validate_source_text_language(trimmed_comment))
+
+        if stage_counts is not None:
+            stage_counts[stage] += 1
+
+        if not valid:
+            verdicts.append(CodeVerdict.NOT_CODE)
+        elif language == Language.PYTHON and (
+                set('()[]=.').intersection(set(trimmed_comment))
+                or 'return' in trimmed_comment
+        ):
+            verdicts.append(CodeVerdict.EXCLUDED)
+        else:
+            verdicts.append(CodeVerdict.INCLUDED)
+
+    return verdicts
+
+
+def _get_comment_tokens_from_source_file(
+        path,
+        language,
+        translation=None,
+        c_backend=CommentBackend.LIBCLANG,
+        clang_parse_mode=ClangParseMode.FULL,
+):
     '''Retrieve all comment tokens from a file.
 
     `path`: Path to file to extract comments from.
     `language`: Programming language of the file at `path`.
+    `translation`: For C and C++ files, a clang.cindex.TranslationUnit already parsed from
+                   the file as `language`. If `None` (default), the file is parsed again.
+                   Ignored by the lexer backend.
+    `c_backend`: CommentBackend enum value selecting how comments are found in C and C++
+                 files.
+    `clang_parse_mode`: ClangParseMode enum value selecting how C and C++ files are
+                        parsed when `translation` is `None`.
 
     Return: List of token objects. The structure of these objects will depend on the
-            programming language that was parsed.
+            programming language that was parsed, and for C and C++, on `c_backend`.
 
     '''
-    if language in (Language.C, Language.CPP):
-        index = clang.cindex.Index.create()
-        translation = index.parse(
-            path,
-            args=('--language', language, f'-I{LIBCLANG_HEADER_PATH}'),
-        )
+    if language in (Language.C, Language.CPP) and c_backend == CommentBackend.LEXER:
+        tokens = lex_file_comments(path, language)
+
+    elif language in (Language.C, Language.CPP):
+        if translation is None:
+            translation = _parse_c_family_file(path, language, clang_parse_mode)
         tokens = [
             token for token in translation.cursor.get_tokens()
             if token.kind == clang.cindex.TokenKind.COMMENT
@@ -369,7 +877,11 @@ def _get_token_span(token, language):
             the span, the second of which represents the end of the span.
 
     '''
-    if language in (Language.C, Language.CPP):
+    if isinstance(token, CommentToken):
+        start = _TextPos(*token.start)
+        end = _TextPos(*token.end)
+
+    elif language in (Language.C, Language.CPP):
         start = _TextPos(token.extent.start.line, token.extent.start.column)
         end = _TextPos(token.extent.end.line, token.extent.end.column)
 
@@ -392,7 +904,13 @@ def _get_token_text(token, language):
     Return: String containing token text.
 
     '''
-    if language in (Language.C, Language.CPP):
+    if isinstance(token, CommentToken):
+        try:
+            text = token.text.decode('utf-8')
+        except UnicodeDecodeError:
+            raise TokenizationError()
+
+    elif language in (Language.C, Language.CPP):
         try:
             text = token.spelling
         except UnicodeDecodeError:
@@ -487,37 +1005,136 @@ def _create_note_element(
     raw_elt = ElementTree.SubElement(note_elt, 'raw')
     raw_elt.text = text
 
-    # Tokenize text. Strip delimiters from comments.
+    return note_elt
+
+
+def _get_annotation_input(text, note_type, language=None):
+    '''Get the text that is actually tokenized for a source annotation.
+
+    Strips delimiters from comments; other note types are annotated as they are.
+
+    '''
     if note_type == NoteType.COMMENT:
-        stripped_text = strip_comment_delimiters(text, language)
-        sents = [word_tokenize(sent) for sent in sent_tokenize(stripped_text)]
+        return strip_comment_delimiters(text, language)
     else:
-        sents = [word_tokenize(sent) for sent in sent_tokenize(text)]
+        return text
 
-    # XML element for tokens, separated by spaces, with sents separated by newlines.
-    tokens_elt = ElementTree.SubElement(note_elt, 'tokens')
-    tokens_elt.text = "\n".join(" ".join(token for token in sent) for sent in sents)
 
-    # XML element for POS tags, aligned to tokens, with same space/newline separation
-    # scheme.
-    pos_elt = ElementTree.SubElement(note_elt, 'pos')
-    pos_elt.text = "\n".join(" ".join(t[1] for t in pos_tag(sent)) for sent in sents)
+def _annotate_input(text, stage_times=None):
+    '''Tokenize and POS tag text returned by `_get_annotation_input()`.
 
-    return note_elt
+    `stage_times`: profiling.StageTimes object to time annotation stages in. If `None`
+                   (default), do not time them.
 
+    '''
+    with timed(stage_times, 'sentence-tokenization'):
+        sent_texts = sent_tokenize(text)
 
-def _accumulate_comments_from_source_file(path, repo, language, write_build_notes=False):
-    '''Get all comments from a programming source file.
+    with timed(stage_times, 'word-tokenization'):
+        sents = [word_tokenize(sent) for sent in sent_texts]
 
-    `path`: Path to file.
-    `repo`: RepoManager object associated with source file's repository.
-    `language`: Programming language associated with file.
+    with timed(stage_times, 'pos-tagging'):
+        tagged_sents = [pos_tag(sent) for sent in sents]
 
-    Return: List of dicts where each dict corresponds to a single comment, with the
-            following keys:
-            - 'comment': Text of the comment.
-            - 'authors': List of anonymized author IDs, retrieved from repository blame
-                         data.
+    tokens = "\n".join(" ".join(token for token in sent) for sent in sents)
+    pos = "\n".join(" ".join(t[1] for t in tagged_sent) for tagged_sent in tagged_sents)
+
+    return tokens, pos
+
+
+def annotate_text(text, note_type, language=None):
+    '''Tokenize and POS tag the raw text of a source annotation.
+
+    `text`: Raw text of the annotation.
+    `note_type`: NoteType enum value representing annotation type.
+    `language`: Language enum value representing the programming language the annotation
+                annotated. Used to strip delimiters from comments.
+
+    Return: Pair of strings (tokens, pos). `tokens` contains the tokens of `text`,
+            separated by spaces, with sentences separated by newlines. `pos` contains POS
+            tags aligned to the tokens, with the same space/newline separation scheme.
+
+    '''
+    return _annotate_input(_get_annotation_input(text, note_type, language))
+
+
+def _set_note_annotations(note_elt, tokens, pos):
+    '''Add <tokens> and <pos> subelements to a note, replacing any existing ones.
+
+    `note_elt`: XML element for a note, as created by `_create_note_element()`.
+    `tokens`, `pos`: Annotation strings, as returned by `annotate_text()`.
+
+    '''
+    for tag in ('tokens', 'pos'):
+        for old_elt in note_elt.findall(tag):
+            note_elt.remove(old_elt)
+
+    tokens_elt = ElementTree.SubElement(note_elt, 'tokens')
+    tokens_elt.text = tokens
+
+    pos_elt = ElementTree.SubElement(note_elt, 'pos')
+    pos_elt.text = pos
+
+
+def _annotate_input_batch(batch, profile=False):
+    '''Annotate a batch of texts returned by `_get_annotation_input()`.
+
+    Intended to be run in a worker process.
+
+    `batch`: List of strings.
+    `profile`: Whether to time the annotation stages of each text.
+
+    Return: _AnnotationResult whose `annotations` are (tokens, pos) pairs, as returned by
+            `annotate_text()`, in the same order as `batch`. If `profile` is set, its
+            `stage_times` are profiling.StageTimes objects, one for each text; otherwise it
+            is `None`.
+
+    '''
+    if not profile:
+        return _AnnotationResult([_annotate_input(text) for text in batch], None)
+
+    stage_times = [StageTimes() for text in batch]
+    return _AnnotationResult(
+        [_annotate_input(text, times) for text, times in zip(batch, stage_times)],
+        stage_times,
+    )
+
+
+def _accumulate_comments_from_source_file(
+        path,
+        repo,
+        language,
+        build_notes=None,
+        commit_metadata=None,
+        translation=None,
+        c_backend=CommentBackend.LIBCLANG,
+        code_stage_counts=None,
+        stage_times=None,
+):
+    '''Get all comments from a programming source file.
+
+    `path`: Path to file.
+    `repo`: RepoManager object associated with source file's repository.
+    `language`: Programming language associated with file.
+    `build_notes`: _BuildNotes pair of lists. If given, comments that are valid code are
+                   appended to them: excluded comments to `excluded_code`, and included
+                   comments to `included_code`.
+    `commit_metadata`: CommitMetadataTable to look up blamed commits in. If `None`
+                       (default), use a table local to this file.
+    `translation`: For C and C++ files, the clang.cindex.TranslationUnit the file was
+                   validated with. If `None` (default), the file is parsed again.
+    `c_backend`: CommentBackend enum value selecting how comments are found in C and C++
+                 files.
+    `code_stage_counts`: collections.Counter to count, when `build_notes` is given, which
+                         stage of `classify_comments_as_code()` decided each comment.
+    `stage_times`: profiling.StageTimes object to time extraction stages in. If `None`
+                   (default), do not time them.
+
+    Return: List of dicts where each dict corresponds to a single comment, with the
+            following keys:
+            - 'comment': Text of the comment.
+            - 'authors': List of anonymized author IDs, retrieved from repository blame
+                         data.
             - 'revs': List of revision IDs, retrieved from repository blame data.
             - 'path': Path to file. Same as `path` argument.
             - 'first-line': First line the comment appears on in the file.
@@ -531,152 +1148,884 @@ def _accumulate_comments_from_source_file(path, repo, language, write_build_note
     last_line = 0
     last_line_had_comment = False
     first_comment_found = False
+    comments = []
     comment_elements = []
 
-    blame_index = BlameIndex(repo, 'HEAD', path.relative_to(repo.dir))
+    with timed(stage_times, 'lexing'):
+        tokens = _get_comment_tokens_from_source_file(path, language, translation, c_backend)
+        token_spans = [_get_token_span(token, language) for token in tokens]
+
+    # Only lines containing comments are ever looked up, so only blame those.
+    with timed(stage_times, 'blame'):
+        blame_index = BlameIndex(
+            repo,
+            'HEAD',
+            path.relative_to(repo.dir),
+            commit_metadata=commit_metadata,
+            line_ranges=[(start.line, end.line) for start, end in token_spans],
+        )
     last_line_with_comment = 0 # tokenize functions index lines from 1
 
-    for token in _get_comment_tokens_from_source_file(path, language):
-        token_start, token_end = _get_token_span(token, language)
-
+    for token, (token_start, token_end) in zip(tokens, token_spans):
         if last_line_with_comment == token_start.line-1:
             # Continuation of previous comment.
             comment += f"{_get_token_text(token, language)}\n"
-            for blame in blame_index[token_start.line:token_end.line+1]:
-                authors.add(anonymize_id(blame.commit.author.name))
-                revs.add(blame.commit.name_rev[:7])
+            with timed(stage_times, 'commit-metadata'):
+                metadatas = blame_index.commit_metadata(token_start.line, token_end.line+1)
+            for metadata in metadatas:
+                authors.add(metadata.author)
+                revs.add(metadata.rev)
             last_line = token_end.line
 
         else:
             # New comment.
             if last_line_with_comment != 0:
                 # Accumulate previous comment.
-                if write_build_notes and is_comment_code(comment, language):
-                    with open(BUILDNOTES_EXCLUDED_CODE_PATH, 'a') as f:
-                        f.write(comment)
-                        f.write(f"{'<>'*32}\n")
-                else:
-                    if (
-                            write_build_notes
-                            and validate_source_text_language(trim_comment_as_code(comment, language))
-                    ):
-                        with open(BUILDNOTES_INCLUDED_CODE_PATH, 'a') as f:
-                            f.write(comment)
-                            f.write(f"{'<>'*32}\n")
-
-                    comment_elements.append(_create_note_element(
-                        comment,
-                        authors,
-                        revs,
-                        NoteType.COMMENT,
-                        repo,
-                        path,
-                        first_line,
-                        last_line,
-                        language,
-                    ))
+                comments.append(comment)
+                comment_elements.append(_create_note_element(
+                    comment,
+                    authors,
+                    revs,
+                    NoteType.COMMENT,
+                    repo,
+                    path,
+                    first_line,
+                    last_line,
+                    language,
+                ))
 
             comment = f"{_get_token_text(token, language)}\n"
-            authors = set(
-                anonymize_id(blame.commit.author.name)
-                for blame in blame_index[token_start.line:token_end.line+1]
-            )
-            revs = set(
-                blame.commit.name_rev[:7]
-                for blame in blame_index[token_start.line:token_end.line+1]
-            )
+            with timed(stage_times, 'commit-metadata'):
+                metadatas = blame_index.commit_metadata(token_start.line, token_end.line+1)
+            authors = set(metadata.author for metadata in metadatas)
+            revs = set(metadata.rev for metadata in metadatas)
             first_line = token_start.line
 
         last_line_with_comment = token_end.line
 
+    if build_notes is not None:
+        # Classify the file's comments together, dropping commented-out code.
+        with timed(stage_times, 'code-classification'):
+            verdicts = classify_comments_as_code(comments, language, code_stage_counts)
+        for comment, verdict in zip(comments, verdicts):
+            if verdict == CodeVerdict.EXCLUDED:
+                build_notes.excluded_code.append(comment)
+            elif verdict == CodeVerdict.INCLUDED:
+                build_notes.included_code.append(comment)
+
+        comment_elements = [
+            element for element, verdict in zip(comment_elements, verdicts)
+            if verdict != CodeVerdict.EXCLUDED
+        ]
+
     return comment_elements
 
 
-def _repo_path_comment_consumer(
+_worker_repos = {}
+'''RepoManager objects owned by the current worker process, keyed by repository name.'''
+
+_worker_commit_metadata = CommitMetadataTable()
+'''Commit metadata memoized by the current worker process, shared by all of its files.'''
+
+
+def _get_worker_repo(repo):
+    '''Get the worker-local RepoManager for `repo`.
+
+    RepoManager objects are pickled without their git handles when they are sent to a
+    worker process. Caching them per process lets each worker reuse a single git.Repo
+    (and its persistent git subprocesses) for every file it is given.
+
+    '''
+    if repo.name not in _worker_repos:
+        _worker_repos[repo.name] = repo
+
+    return _worker_repos[repo.name]
+
+
+_HARD_TIME_LIMIT_FACTOR = 2
+'''Multiple of the per-file time limit after which a worker stuck on a file exits.
+
+The time limit is enforced with SIGALRM, whose handler only runs between Python bytecodes,
+so it cannot interrupt a long call into libclang. A watchdog thread ends the worker if
+such a call overruns by this factor.
+
+'''
+
+_HARD_TIME_LIMIT_GRACE = 10
+'''Seconds after the hard time limit that faulthandler ends a worker whose watchdog could
+not run, because native code is holding the GIL.'''
+
+
+class _FileBudgetExceeded(Exception):
+    '''Extracting a source file exceeded its time or memory budget.'''
+
+    def __init__(self, reason):
+        super().__init__(f"{reason} limit exceeded")
+        self.reason = reason
+
+
+def _raise_time_limit_exceeded(signum, frame):
+    raise _FileBudgetExceeded(QuarantineReason.TIME)
+
+
+def _get_address_space_size():
+    '''Get the size of the current process's address space in bytes, or 0 if unknown.'''
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+@contextmanager
+def _file_budget(budget, on_hard_time_limit):
+    '''Enforce a per-file time and memory budget on the work done inside the context.
+
+    Must be entered on the main thread. Exceeding either limit raises _FileBudgetExceeded
+    inside the context. The memory limit is on the address space the process may add
+    while inside the context, so it also covers memory allocated by libclang.
+
+    `budget`: _FileBudget named tuple. Limits that are `None` are not enforced.
+    `on_hard_time_limit`: Callable run on a watchdog thread if the work is still running
+                          `_HARD_TIME_LIMIT_FACTOR` times past the time limit. The process
+                          exits as soon as it returns.
+
+    '''
+    def exit_after_hard_time_limit():
+        try:
+            on_hard_time_limit()
+        finally:
+            os._exit(1)
+
+    with ExitStack() as stack:
+        if budget.memory_limit is not None:
+            limits = resource.getrlimit(resource.RLIMIT_AS)
+            limit = _get_address_space_size() + budget.memory_limit
+            if limits[1] != resource.RLIM_INFINITY:
+                limit = min(limit, limits[1])
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limits[1]))
+            stack.callback(resource.setrlimit, resource.RLIMIT_AS, limits)
+
+        if budget.time_limit is not None:
+            hard_time_limit = budget.time_limit * _HARD_TIME_LIMIT_FACTOR
+
+            previous_handler = signal.signal(signal.SIGALRM, _raise_time_limit_exceeded)
+            stack.callback(signal.signal, signal.SIGALRM, previous_handler)
+
+            watchdog = threading.Timer(hard_time_limit, exit_after_hard_time_limit)
+            watchdog.daemon = True
+            watchdog.start()
+            stack.callback(watchdog.cancel)
+
+            faulthandler.dump_traceback_later(
+                hard_time_limit + _HARD_TIME_LIMIT_GRACE,
+                exit=True,
+            )
+            stack.callback(faulthandler.cancel_dump_traceback_later)
+
+            # Disarmed first on exit, so that it cannot go off while the rest is undone.
+            signal.setitimer(signal.ITIMER_REAL, budget.time_limit)
+            stack.callback(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        try:
+            yield
+
+        except MemoryError:
+            raise _FileBudgetExceeded(QuarantineReason.MEMORY) from None
+
+
+def _extract_comments_from_path(
         repo,
-        paths,
-        comment_element_lists_by_file,
+        path,
         write_build_notes=False,
+        c_backend=CommentBackend.LIBCLANG,
+        clang_parse_mode=ClangParseMode.FULL,
+        profile=False,
+        cprofile_path=None,
+        tracked_file=None,
+        budget=None,
 ):
-    '''Extract comments from all paths in a repo.
+    '''Extract comments from a single file in a repo.
 
-    Intended to be run in one of several threads.
+    Intended to be run in a worker process.
 
     `repo`: RepoManager object.
-    `paths`: Thread-safe container (e.g. deque) of all file paths in the repo. Must be
-             enumerated (i.e. have the structure created by the `enumerate()` built-in).
-    `comment_element_lists_by_file`: Output object. Must be a thread-safe container
-                                     (e.g. deque) the same length as `paths`. The initial
-                                     contents of the container are irrelevant. After
-                                     execution of the function, will be a list of lists,
-                                     each list containing `ElementTree.Element` objects
-                                     for the XML representation of the comments extracted
-                                     from a single source file.
+    `path`: Path to file.
+    `c_backend`: CommentBackend enum value selecting how comments are found in C and C++
+                 files.
+    `clang_parse_mode`: ClangParseMode enum value selecting how libclang parses C and C++
+                        files.
+    `profile`: Whether to time the extraction stages of the file.
+    `cprofile_path`: Path to dump cProfile statistics of the file's extraction to. If
+                     `None` (default), do not run cProfile.
+    `tracked_file`: repo.TrackedFile named tuple of the file, which it is quarantined
+                    under if it exceeds `budget`. Required if `budget` is given.
+    `budget`: _FileBudget named tuple to extract the file within. If extraction exceeds
+              it, or if the file has already been quarantined, the file is skipped. A
+              worker still stuck on the file well past its time limit quarantines it and
+              exits. If `None` (default), the file is not limited.
+
+    Return: _WorkerResult whose `notes` are serialized `<note>` elements (UTF-8 encoded
+            bytes), one for each comment extracted from the file. Files that are not valid
+            source code in a supported language, or whose comments cannot be read,
+            produce no notes. `worker` and `commit_metadata_stats` identify the worker
+            process and give its cumulative (hits, misses) commit metadata counts. If
+            `write_build_notes` is set, `build_notes` is a _BuildNotes pair of lists of
+            the file's comments that are valid code, and `code_stage_counts` is a Counter
+            of which stage of `classify_comments_as_code()` decided each of the file's
+            comments; otherwise both are `None`. If `profile` is set, `profile` is a
+            _WorkProfile of the file's language (or, if it is not valid code, the first
+            language it was tried as), its stage times and its total time. Skipped files
+            produce no notes, and their `quarantined` is the QuarantineReason enum value
+            they were quarantined for; it is `None` for every other file.
 
     '''
-    while paths:
-        i, path = paths.pop()
+    if budget is not None:
+        quarantine = Quarantine()
+        reason = quarantine.get(repo.name, tracked_file.path, tracked_file.sha)
+        if reason is None:
+            quarantine_file = partial(
+                quarantine.add,
+                repo.name,
+                tracked_file.path,
+                tracked_file.sha,
+            )
+            try:
+                with _file_budget(budget, partial(quarantine_file, QuarantineReason.TIME)):
+                    return _extract_comments_from_path(
+                        repo,
+                        path,
+                        write_build_notes=write_build_notes,
+                        c_backend=c_backend,
+                        clang_parse_mode=clang_parse_mode,
+                        profile=profile,
+                        cprofile_path=cprofile_path,
+                    )
+
+            except _FileBudgetExceeded as e:
+                reason = e.reason
+                quarantine_file(reason)
+                # The file may have been given up on in the middle of talking to one of
+                # the repository's persistent git processes, so start afresh.
+                _worker_repos.pop(repo.name, None)
+
+        return _WorkerResult(
+            [],
+            os.getpid(),
+            (_worker_commit_metadata.hits, _worker_commit_metadata.misses),
+            quarantined=reason,
+        )
 
-        logging.debug(f"thread={threading.get_ident()} index={i} path={path}")
+    if cprofile_path is not None:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(
+            _extract_comments_from_path,
+            repo,
+            path,
+            write_build_notes=write_build_notes,
+            c_backend=c_backend,
+            clang_parse_mode=clang_parse_mode,
+            profile=profile,
+        )
+        Path(cprofile_path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(cprofile_path)
+        return result
+
+    logging.debug(f"pid={os.getpid()} path={path}")
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    stage_times = StageTimes() if profile else None
+
+    repo = _get_worker_repo(repo)
+
+    candidate_languages = get_candidate_languages(path)
+    if (
+            c_backend == CommentBackend.LEXER
+            and candidate_languages
+            and candidate_languages[0] in (Language.C, Language.CPP)
+    ):
+        # The lexer does not need, and would not benefit from, a validation parse.
+        language, translation = candidate_languages[0], None
+    else:
+        with timed(stage_times, 'validation'):
+            language, translation = _validate_source_file(
+                path,
+                parse_mode=clang_parse_mode,
+            )
 
-        language = validate_source_file_language(path)
+    notes = []
+    build_notes = _BuildNotes([], []) if write_build_notes else None
+    code_stage_counts = Counter() if write_build_notes else None
+    if language:
+        try:
+            comment_elements = _accumulate_comments_from_source_file(
+                path,
+                repo,
+                language,
+                build_notes=build_notes,
+                commit_metadata=_worker_commit_metadata,
+                translation=translation,
+                c_backend=c_backend,
+                code_stage_counts=code_stage_counts,
+                stage_times=stage_times,
+            )
+            with timed(stage_times, 'serialization'):
+                notes = [
+                    ElementTree.tostring(element, encoding='utf-8')
+                    for element in comment_elements
+                ]
+
+        # Don't extract comments that we cannot read.
+        except TokenizationError:
+            pass
+
+    return _WorkerResult(
+        notes,
+        os.getpid(),
+        (_worker_commit_metadata.hits, _worker_commit_metadata.misses),
+        build_notes,
+        code_stage_counts,
+        _WorkProfile(
+            language or next(iter(candidate_languages), None),
+            stage_times,
+            time.perf_counter() - wall_start,
+            time.process_time() - cpu_start,
+        ) if profile else None,
+    )
+
+
+def _log_commit_metadata_stats(stats):
+    '''Log the combined hit rate of one or more CommitMetadataTable objects.
+
+    `stats`: Iterable of (hits, misses) pairs.
+
+    '''
+    hits = 0
+    misses = 0
+    for table_hits, table_misses in stats:
+        hits += table_hits
+        misses += table_misses
+
+    lookups = hits + misses
+    hit_rate = hits / lookups if lookups else 0
+    logging.debug(
+        f"  commit metadata: {lookups} lookups, {hits} hits, {misses} misses"
+        f" ({hit_rate:.1%} hit rate)"
+    )
+
+
+def _log_code_stage_counts(stage_counts):
+    '''Log how many comments each stage of `classify_comments_as_code()` decided.'''
+    comments = sum(stage_counts.values())
+    logging.info(
+        f"  code classification: {comments} comments, "
+        + ", ".join(
+            f"{stage_counts[stage]} decided by {stage}" for stage in _CODE_STAGES
+        )
+    )
+
+
+def _enumerate_source_files(
+        repo,
+        include_patterns=None,
+        exclude_patterns=None,
+        max_file_size=None,
+):
+    '''List the files of a repository that comments should be extracted from.
+
+    Files are taken from the tree of the checked-out revision, so untracked files and the
+    contents of .git are never considered. Only files with an extension in
+    `SOURCE_FILE_LANGUAGES` are included.
+
+    `repo`: RepoManager object.
+    `include_patterns`: Iterable of fnmatch-style patterns. If given, only include files
+                        whose path within the repository matches at least one of them.
+    `exclude_patterns`: Iterable of fnmatch-style patterns. Exclude files whose path within
+                        the repository matches any of them.
+    `max_file_size`: Exclude files larger than this many bytes.
+
+    Return: List of repo.TrackedFile named tuples, largest first, so that the biggest files
+            are started early instead of being left as stragglers at the end of a run.
+            Files of equal size are ordered by path.
+
+    '''
+    source_files = []
+    for tracked_file in repo.tracked_files():
+        if PurePosixPath(tracked_file.path).suffix not in SOURCE_FILE_LANGUAGES:
+            continue
+
+        if include_patterns and not any(
+                fnmatch.fnmatchcase(tracked_file.path, pattern)
+                for pattern in include_patterns
+        ):
+            continue
+
+        if exclude_patterns and any(
+                fnmatch.fnmatchcase(tracked_file.path, pattern)
+                for pattern in exclude_patterns
+        ):
+            continue
+
+        if max_file_size is not None and tracked_file.size > max_file_size:
+            logging.debug(f"  skipping {tracked_file.path} ({tracked_file.size} bytes)")
+            continue
+
+        if not (repo.dir / Path(tracked_file.path)).is_file():
+            logging.warning(f"  {tracked_file.path} is tracked but missing from working tree")
+            continue
+
+        source_files.append(tracked_file)
+
+    source_files.sort(key=lambda tracked_file: (-tracked_file.size, tracked_file.path))
+
+    return source_files
+
+
+def _get_repo_build_notes_path(path, repo):
+    '''Get the path a repository's part of the build notes file at `path` is staged at.'''
+    return path.with_name(f'.{path.stem}.{repo.name}{path.suffix}')
+
+
+@contextmanager
+def _open_comment_outputs(open_writer, repo, write_build_notes=False):
+    '''Open the outputs comment extraction writes a repository's results to.
+
+    `open_writer`: Callable returning a context manager that returns the NoteWriter for
+                   the repository's comment notes.
+    `repo`: RepoManager object.
+    `write_build_notes`: Whether to also open the repository's build notes files. Build
+                         notes are staged per repository, and merged into the build notes
+                         directory by `_merge_build_notes()`.
+
+    Return: Context manager returning a _CommentOutputs pair. Its `build_notes` is a
+            _BuildNotes pair of open files if `write_build_notes` is set, and `None`
+            otherwise.
+
+    '''
+    with open_writer() as writer:
+        if not write_build_notes:
+            yield _CommentOutputs(writer, None)
+            return
+
+        with (
+                open(_get_repo_build_notes_path(BUILDNOTES_INCLUDED_CODE_PATH, repo), 'w') as included_code_file,
+                open(_get_repo_build_notes_path(BUILDNOTES_EXCLUDED_CODE_PATH, repo), 'w') as excluded_code_file,
+        ):
+            yield _CommentOutputs(writer, _BuildNotes(included_code_file, excluded_code_file))
+
+
+def _merge_build_notes(repos):
+    '''Append the staged build notes of repositories to the build notes files.
+
+    Build notes are appended in the order of `repos`, so they do not depend on the order
+    repositories finish extracting in. Staged files are removed once merged.
+
+    `repos`: Iterable of RepoManager objects.
+
+    '''
+    for path in (BUILDNOTES_INCLUDED_CODE_PATH, BUILDNOTES_EXCLUDED_CODE_PATH):
+        with open(path, 'a') as build_notes_file:
+            for repo in repos:
+                repo_path = _get_repo_build_notes_path(path, repo)
+                if repo_path.is_file():
+                    with open(repo_path) as repo_build_notes_file:
+                        shutil.copyfileobj(repo_build_notes_file, build_notes_file)
+                    repo_path.unlink()
 
-        if language:
-            try:
-                comment_elements = _accumulate_comments_from_source_file(
-                    path,
-                    repo,
-                    language,
-                    write_build_notes=write_build_notes,
-                )
-                comment_element_lists_by_file[i] = comment_elements
 
-            # Don't extract comments that we cannot read.
-            except TokenizationError:
-                comment_element_lists_by_file[i] = []
+def _get_checkpoint_key(source_file):
+    '''Get the key a source file's checkpoint is recorded under in a corpus file journal.'''
+    return f'{source_file.sha} {source_file.path}'
+
+
+def _count_resumable_files(path, source_files, sharded=False):
+    '''Count the source files an interrupted extraction to `path` can be resumed after.
+
+    Only a prefix of `source_files` that matches the checkpoints of the interrupted
+    extraction, in order, can be resumed; files that have changed since, or that come
+    after a change, are extracted again.
+
+    `path`: Path to corpus file.
+    `source_files`: List of repo.TrackedFile named tuples, as returned by
+                    `_enumerate_source_files()`.
+    `sharded`: Whether the corpus file is being sharded.
+
+    Return: Number of leading `source_files` whose notes have already been written.
+
+    '''
+    checkpoints = NoteWriter.read_checkpoints(path, sharded)
+
+    resumable = 0
+    for checkpoint, source_file in zip(checkpoints, source_files):
+        if checkpoint != _get_checkpoint_key(source_file):
+            break
+        resumable += 1
+
+    if resumable < len(checkpoints):
+        logging.warning(
+            f"  {path}: Only {resumable} of {len(checkpoints)} extracted files are"
+            " unchanged; extracting the rest again"
+        )
+
+    return resumable
+
+
+def _quarantine_lost_file(quarantine, repo, source_file):
+    '''Quarantine a source file whose extraction kept killing worker processes.
+
+    Return: _WorkerResult standing in for the file's, with no notes.
+
+    '''
+    quarantine.add(repo.name, source_file.path, source_file.sha, QuarantineReason.CRASH)
+    return _WorkerResult([], None, None, quarantined=QuarantineReason.CRASH)
+
+
+def _submit_repo_comments(
+        executor,
+        repo,
+        source_files,
+        write_build_notes=False,
+        extraction_cache=None,
+        c_backend=CommentBackend.LIBCLANG,
+        clang_parse_mode=ClangParseMode.FULL,
+        commit_metadata_stats_by_worker=None,
+        checkpoint_files=False,
+        code_stage_counts=None,
+        profile=None,
+        quarantine=None,
+        file_budget=None,
+):
+    '''Submit comment extraction work for a repository.
+
+    `executor`: Executor to extract comments with, normally a
+                scheduler.RestartingProcessPool.
+    `repo`: RepoManager object.
+    `source_files`: List of repo.TrackedFile named tuples, as returned by
+                    `_enumerate_source_files()`.
+    `extraction_cache`: ExtractionCache object. Files whose cached results are still
+                        valid are not re-extracted, and newly extracted results are added
+                        to the cache. If `None` (default), do not use a cache. The cache
+                        is not used when `write_build_notes` is set, since build notes are
+                        only written during extraction, and commented-out code is then
+                        left out of the extracted notes.
+    `c_backend`: CommentBackend enum value selecting how comments are found in C and C++
+                 files.
+    `clang_parse_mode`: ClangParseMode enum value selecting how libclang parses C and C++
+                        files.
+    `commit_metadata_stats_by_worker`: Dict to record the commit metadata counts reported
+                                       by each worker in. See `_extract_comments_from_path()`.
+    `checkpoint_files`: Whether to record a checkpoint after each file's notes are
+                        written, for resuming. Requires a journaled NoteWriter.
+    `code_stage_counts`: collections.Counter to add the code classification stage counts
+                         reported for each file to, when `write_build_notes` is set.
+    `profile`: profiling.BuildProfile object to add the times of each extracted file to.
+               Files it samples are also extracted under cProfile. If `None` (default),
+               do not time extraction.
+    `quarantine`: cache.Quarantine object. Quarantined files are skipped, and files that
+                  `executor` gives up on for killing their workers are quarantined. If
+                  `None` (default), no files are skipped.
+    `file_budget`: _FileBudget named tuple to extract each file within. Files that exceed
+                   it are quarantined by their worker. If `None` (default), files are not
+                   limited.
+
+    Yield: (future, on_done) pairs, one for each of `source_files`, in order. See
+           scheduler.Task. `on_done` writes a file's notes (and build notes) to the
+           _CommentOutputs returned by `_open_comment_outputs()`.
+
+    '''
+    extract = partial(
+        _extract_comments_from_path,
+        repo,
+        write_build_notes=write_build_notes,
+        c_backend=c_backend,
+        clang_parse_mode=clang_parse_mode,
+        profile=profile is not None,
+        budget=file_budget,
+    )
+
+    def write_file_notes(source_file, cache_key, cached_notes, result, outputs):
+        if cached_notes is not None:
+            notes = cached_notes
+
+        elif result.quarantined is not None:
+            logging.warning(
+                f"  {repo.name}: quarantined {source_file.path} ({result.quarantined})"
+            )
+            notes = []
 
         else:
-            comment_element_lists_by_file[i] = []
+            notes = result.notes
+            if commit_metadata_stats_by_worker is not None:
+                commit_metadata_stats_by_worker[result.worker] = result.commit_metadata_stats
+            if cache_key is not None:
+                extraction_cache.put(cache_key, notes)
+
+            if code_stage_counts is not None and result.code_stage_counts is not None:
+                code_stage_counts.update(result.code_stage_counts)
+            if profile is not None and result.profile is not None:
+                profile.add_file(
+                    result.profile.stage_times,
+                    repo.name,
+                    source_file.path,
+                    result.profile.language,
+                    result.profile.wall,
+                    result.profile.cpu,
+                )
+
+            if outputs.build_notes is not None:
+                for comments, build_notes_file in zip(result.build_notes, outputs.build_notes):
+                    for comment in comments:
+                        build_notes_file.write(comment)
+                        build_notes_file.write(_BUILD_NOTES_SEPARATOR)
 
+        for serialized_note in notes:
+            outputs.writer.write(serialized_note)
 
-def _create_repo_comments_xml_tree(repo, write_build_notes=False):
-    '''Extract comments from a repository and build an XML tree to contain them.
+        if checkpoint_files:
+            outputs.writer.checkpoint(_get_checkpoint_key(source_file))
+
+    # Results of a full parse are cached under the same key as before parse modes existed.
+    extractor = f'{EXTRACTOR_VERSION}-{c_backend}'
+    if c_backend == CommentBackend.LIBCLANG and clang_parse_mode != ClangParseMode.FULL:
+        extractor = f'{extractor}-{clang_parse_mode}'
+
+    if extraction_cache is not None and not write_build_notes:
+        commit = repo.resolve_commit()
+        shallow = repo.is_shallow()
+
+    for source_file in source_files:
+        path = repo.dir / Path(source_file.path)
+
+        if (
+                quarantine is not None
+                and quarantine.get(repo.name, source_file.path, source_file.sha) is not None
+        ):
+            logging.debug(f"  skipping {source_file.path} (quarantined)")
+            yield None, partial(write_file_notes, source_file, None, [])
+            continue
+
+        cache_key = None
+        cached_notes = None
+        if extraction_cache is not None and not write_build_notes:
+            cache_key = ExtractionCache.key(
+                repo.name,
+                commit,
+                source_file.sha,
+                source_file.path,
+                get_candidate_languages(path),
+                extractor,
+                shallow=shallow,
+            )
+            cached_notes = extraction_cache.get(cache_key)
+
+        future = None
+        if cached_notes is None:
+            cprofile_path = None
+            if profile is not None and profile.sample(repo.name, source_file.path):
+                cprofile_path = BUILDNOTES_CPROFILEDIR_PATH / Path(repo.name) / Path(
+                    f'{source_file.path}.prof'
+                )
+            future = executor.submit(
+                extract,
+                path,
+                cprofile_path=cprofile_path,
+                tracked_file=source_file,
+            )
+            if quarantine is not None:
+                future = recover_lost_work(
+                    future,
+                    partial(_quarantine_lost_file, quarantine, repo, source_file),
+                )
+        yield future, partial(write_file_notes, source_file, cache_key, cached_notes)
+
+
+def _log_extraction_cache_stats(extraction_cache):
+    '''Log the hit and miss counts of an ExtractionCache object.'''
+    logging.debug(
+        f"  extraction cache: {extraction_cache.hits} hits,"
+        f" {extraction_cache.misses} misses"
+    )
+
+
+def _iter_changelog_notes(repo, commits=None, commit_metadata=None, stage_times=None):
+    '''Extract changelog notes from a repository's history.
 
     `repo`: RepoManager object.
+    `commits`: Iterable of (commit, message) pairs, as yielded by `RepoManager.iter_log()`.
+               If `None` (default), use the repository's entire history.
+    `commit_metadata`: CommitMetadataTable to look commits up in. If `None` (default), use
+                       a new table.
+    `stage_times`: profiling.StageTimes object to time commit metadata lookups in. If
+                   `None` (default), do not time them.
 
-    Return: Corpus-ready ElementTree.ElementTree object
+    Yield: Corpus-ready ElementTree.Element objects, one for each commit with a message,
+           in the order of `commits`.
 
     '''
-    paths = deque(enumerate(repo.dir.glob('**/*')))
-    comment_element_lists_by_file = deque(len(paths) * [None])
-    threads = [
-        Thread(
-            target=_repo_path_comment_consumer,
-            args=[repo, paths, comment_element_lists_by_file],
-            kwargs={'write_build_notes': write_build_notes},
-        ) for i in range(mp.cpu_count()) # TODO use arg
-    ]
-    for t in threads:
-        t.start()
+    if commits is None:
+        commits = repo.iter_log()
+
+    if commit_metadata is None:
+        commit_metadata = CommitMetadataTable()
+
+    for commit, message in commits:
+        if message:
+            with timed(stage_times, 'commit-metadata'):
+                metadata = commit_metadata[commit]
+            yield _create_note_element(
+                normalize_string(message),
+                [metadata.author],
+                [metadata.rev],
+                NoteType.CHANGELOG,
+                repo,
+            )
+
 
-    while any(t.is_alive() for t in threads): pass
+def _extract_changelog_batch(repo, commits, profile=False):
+    '''Extract changelog notes from a batch of commits.
 
-    root = ElementTree.Element('notes')
-    for element in itr.chain(*comment_element_lists_by_file):
-        if element is not None:
-            root.append(element)
+    Intended to be run in a worker process.
 
-    return ElementTree.ElementTree(root)
+    `repo`: RepoManager object.
+    `commits`: List of (commit, message) pairs, as yielded by `RepoManager.iter_log()`.
+    `profile`: Whether to time the extraction stages of the batch.
+
+    Return: _WorkerResult whose `notes` are serialized `<note>` elements (UTF-8 encoded
+            bytes), in the order of `commits`. See `_extract_comments_from_path()`.
+
+    '''
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    stage_times = StageTimes() if profile else None
+
+    notes = []
+    for note_elt in _iter_changelog_notes(repo, commits, _worker_commit_metadata, stage_times):
+        with timed(stage_times, 'serialization'):
+            notes.append(ElementTree.tostring(note_elt, encoding='utf-8'))
+
+    return _WorkerResult(
+        notes,
+        os.getpid(),
+        (_worker_commit_metadata.hits, _worker_commit_metadata.misses),
+        profile=_WorkProfile(
+            None,
+            stage_times,
+            time.perf_counter() - wall_start,
+            time.process_time() - cpu_start,
+        ) if profile else None,
+    )
+
+
+def _submit_repo_changelogs(
+        executor,
+        repo,
+        commit_metadata_stats_by_worker=None,
+        profile=None,
+):
+    '''Submit changelog extraction work for a repository.
+
+    The repository's history is streamed from `git log` and split into batches of
+    commits with messages.
+
+    `executor`: ProcessPoolExecutor to extract changelogs with.
+    `repo`: RepoManager object.
+    `commit_metadata_stats_by_worker`: Dict to record the commit metadata counts reported
+                                       by each worker in. See `_extract_comments_from_path()`.
+    `profile`: profiling.BuildProfile object to add the stage times of the repository's
+               changelog extraction to. If `None` (default), do not time extraction.
 
+    Yield: (future, on_done) pairs, one for each batch, in commit order (newest first).
+           See scheduler.Task. `on_done` writes a batch's notes to a NoteWriter.
 
-def extract_data(note_types=(), write_build_notes=False):
+    '''
+    def write_batch_notes(result, writer):
+        if commit_metadata_stats_by_worker is not None:
+            commit_metadata_stats_by_worker[result.worker] = result.commit_metadata_stats
+        if profile is not None and result.profile is not None:
+            profile.add(result.profile.stage_times, repo.name)
+        for serialized_note in result.notes:
+            writer.write(serialized_note)
+
+    extract = partial(_extract_changelog_batch, repo, profile=profile is not None)
+    log_times = StageTimes() if profile is not None else None
+
+    batch = []
+    for commit, message in timed_iter(repo.iter_log(), log_times, 'log'):
+        # Commits without messages produce no notes, so are not sent to the workers.
+        if message:
+            batch.append((commit, message))
+            if len(batch) == _CHANGELOG_BATCH_SIZE:
+                yield executor.submit(extract, batch), write_batch_notes
+                batch = []
+
+    if batch:
+        yield executor.submit(extract, batch), write_batch_notes
+
+    if profile is not None:
+        profile.add(log_times, repo.name)
+
+
+def extract_data(
+        note_types=(),
+        write_build_notes=False,
+        jobs=None,
+        extraction_cache=None,
+        gc_extraction_cache=False,
+        c_backend=CommentBackend.LIBCLANG,
+        clang_parse_mode=ClangParseMode.FULL,
+        include_patterns=None,
+        exclude_patterns=None,
+        max_file_size=None,
+        resume=False,
+        max_shard_notes=None,
+        max_shard_bytes=None,
+        profile=None,
+        quarantine=None,
+        file_budget=None,
+):
     '''Extract data from downloaded repos.
 
+    Progress is journaled as corpus files, and the source files within each comment corpus
+    file, are finished, so that an interrupted extraction can be resumed.
+
     `note_types`: Iterable of NoteType values. Only notes of this type will be extracted.
+    `jobs`: Number of worker processes to extract changelogs and comments with. If `None`
+            (default), use one worker per CPU. All repositories share the same workers.
+    `extraction_cache`: ExtractionCache object to reuse per-file comment extraction
+                        results from. If `None` (default), do not use a cache.
+    `gc_extraction_cache`: After extracting, delete entries from `extraction_cache` that
+                           were not used for any repo. Ignored when `write_build_notes` is
+                           set.
+    `c_backend`: CommentBackend enum value selecting how comments are found in C and C++
+                 files.
+    `clang_parse_mode`: ClangParseMode enum value selecting how libclang parses C and C++
+                        files.
+    `include_patterns`: Iterable of fnmatch-style patterns. If given, only extract comments
+                        from files whose path within their repository matches one of them.
+    `exclude_patterns`: Iterable of fnmatch-style patterns. Do not extract comments from
+                        files whose path within their repository matches any of them.
+    `max_file_size`: Do not extract comments from files larger than this many bytes.
+    `resume`: Resume an interrupted extraction. Corpus files it finished are not extracted
+              again, and comment corpus files it started are continued after the last
+              source file they recorded. Arguments should match those of the interrupted
+              extraction.
+    `max_shard_notes`, `max_shard_bytes`: If either is given, split each corpus file into
+                                          shards of at most this many notes, or of about
+                                          this many bytes. See corpus.NoteWriter.
+    `profile`: profiling.BuildProfile object to add extraction times to. If `None`
+               (default), do not time extraction.
+    `quarantine`: cache.Quarantine object listing source files to skip, and to add files
+                  that exceed `file_budget`, or that kill their workers, to. If `None`
+                  (default), no files are skipped, and a file that keeps killing its
+                  workers fails extraction.
+    `file_budget`: _FileBudget named tuple to extract each source file within. If `None`
+                   (default), files are not limited.
 
     '''
 
-    logging.info("Extracting data...")
+    logging.info("Resuming data extraction..." if resume else "Extracting data...")
 
     CORPUSDIR_PATH.mkdir(exist_ok=True)
 
@@ -690,48 +2039,323 @@ def extract_data(note_types=(), write_build_notes=False):
 
         BUILDNOTESDIR_PATH.mkdir()
 
-    for repo in RepoManager.get_repolist():
-        logging.info(f" {repo.name}")
+    output_journal = OutputJournal(EXTRACTION_JOURNAL_PATH, resume=resume)
+    open_writer = partial(
+        NoteWriter,
+        max_shard_notes=max_shard_notes,
+        max_shard_bytes=max_shard_bytes,
+    )
+    sharded = max_shard_notes is not None or max_shard_bytes is not None
+
+    # One task per corpus file. All tasks share a single pool of workers, and are
+    # interleaved on it, starting with the tasks estimated to take longest.
+    commit_metadata_stats_by_worker = {}
+    code_stage_counts = Counter()
+    tasks = []
+    repos = RepoManager.get_repolist()
+    for repo in repos:
+        changelogs_path = CORPUSDIR_PATH / Path(f'{NoteType.CHANGELOG}.{repo.name}.xml')
+        comments_path = CORPUSDIR_PATH / Path(f'{NoteType.COMMENT}.{repo.name}.xml')
+
+        if NoteType.COMMENT in note_types and comments_path.name not in output_journal:
+            enumeration_times = StageTimes() if profile is not None else None
+            with timed(enumeration_times, 'enumeration'):
+                source_files = _enumerate_source_files(
+                    repo,
+                    include_patterns=include_patterns,
+                    exclude_patterns=exclude_patterns,
+                    max_file_size=max_file_size,
+                )
+            if profile is not None:
+                profile.add(enumeration_times, repo.name)
+            resumed_files = 0
+            if resume:
+                resumed_files = _count_resumable_files(comments_path, source_files, sharded)
+            source_files = source_files[resumed_files:]
 
         # Extract changelogs.
-        changelogs_path = CORPUSDIR_PATH / Path(f'{NoteType.CHANGELOG}.{repo.name}.xml')
         if NoteType.CHANGELOG in note_types:
-            logging.debug(f"  {NoteType.CHANGELOG}")
-            changelogs_root = ElementTree.Element('notes')
-            for commit in repo.git.iter_commits():
-                if commit.message:
-                    changelogs_root.append(_create_note_element(
-                        normalize_string(commit.message),
-                        [anonymize_id(commit.author.name)],
-                        [commit.name_rev[:7]],
-                        NoteType.CHANGELOG,
-                        repo,
-                    ))
-
-            changelogs_tree = ElementTree.ElementTree(changelogs_root)
-            changelogs_tree.write(
-                changelogs_path,
-                encoding='utf-8',
-                xml_declaration=True,
-            )
+            if changelogs_path.name in output_journal:
+                logging.info(f" {repo.name}: {NoteType.CHANGELOG} (already extracted)")
+            else:
+                tasks.append(Task(
+                    f'{repo.name}: {NoteType.CHANGELOG}',
+                    repo.count_commits() * _CHANGELOG_SECONDS_PER_COMMIT,
+                    partial(
+                        output_journal.recording,
+                        partial(open_writer, changelogs_path),
+                        changelogs_path.name,
+                    ),
+                    partial(
+                        _submit_repo_changelogs,
+                        repo=repo,
+                        commit_metadata_stats_by_worker=commit_metadata_stats_by_worker,
+                        profile=profile,
+                    ),
+                ))
 
         # Extract comments.
-        comments_path = CORPUSDIR_PATH / Path(f'{NoteType.COMMENT}.{repo.name}.xml')
         if NoteType.COMMENT in note_types:
-            logging.debug(f"  {NoteType.COMMENT}")
-            comments_tree = _create_repo_comments_xml_tree(
-                repo,
-                write_build_notes=write_build_notes
+            if comments_path.name in output_journal:
+                logging.info(f" {repo.name}: {NoteType.COMMENT} (already extracted)")
+            else:
+                if resumed_files:
+                    logging.info(
+                        f" {repo.name}: {NoteType.COMMENT} (resuming after"
+                        f" {resumed_files} files)"
+                    )
+
+                tasks.append(Task(
+                    f'{repo.name}: {NoteType.COMMENT}',
+                    sum(source_file.size for source_file in source_files)
+                    * _COMMENT_SECONDS_PER_BYTE,
+                    partial(
+                        output_journal.recording,
+                        partial(
+                            _open_comment_outputs,
+                            partial(
+                                open_writer,
+                                comments_path,
+                                journal=True,
+                                resume_checkpoints=resumed_files,
+                            ),
+                            repo,
+                            write_build_notes,
+                        ),
+                        comments_path.name,
+                    ),
+                    partial(
+                        _submit_repo_comments,
+                        repo=repo,
+                        source_files=source_files,
+                        write_build_notes=write_build_notes,
+                        extraction_cache=extraction_cache,
+                        c_backend=c_backend,
+                        clang_parse_mode=clang_parse_mode,
+                        commit_metadata_stats_by_worker=commit_metadata_stats_by_worker,
+                        checkpoint_files=True,
+                        code_stage_counts=code_stage_counts,
+                        profile=profile,
+                        quarantine=quarantine,
+                        file_budget=file_budget,
+                    ),
+                ))
+
+    with RestartingProcessPool(max_workers=jobs) as executor:
+        run_tasks(tasks, executor, _IN_FLIGHT_FILES_PER_JOB * (jobs or os.cpu_count()))
+
+    if executor.restarts:
+        logging.warning(f"Restarted extraction workers {executor.restarts} times.")
+
+    if write_build_notes and NoteType.COMMENT in note_types:
+        _merge_build_notes(repos)
+        _log_code_stage_counts(code_stage_counts)
+
+    _log_commit_metadata_stats(commit_metadata_stats_by_worker.values())
+    if extraction_cache is not None:
+        _log_extraction_cache_stats(extraction_cache)
+
+    if extraction_cache is not None and gc_extraction_cache:
+        if write_build_notes:
+            logging.warning(
+                "Not collecting extraction cache garbage; the cache is not used when"
+                " writing build notes."
             )
-            comments_tree.write(
-                comments_path,
-                encoding='utf-8',
-                xml_declaration=True,
+        elif NoteType.COMMENT in note_types:
+            removed = extraction_cache.gc()
+            logging.info(f"Removed {removed} unused extraction cache entries.")
+        else:
+            logging.warning(
+                "Not collecting extraction cache garbage; comments were not extracted."
             )
 
+    output_journal.remove()
+
     logging.info("Finished extracting data.")
 
 
+def _submit_corpus_file_annotations(
+        executor,
+        path,
+        annotation_cache=None,
+        repo=None,
+        profile=None,
+):
+    '''Submit annotation work for a corpus file.
+
+    Notes are streamed from the file and sent to the workers in batches.
+
+    `executor`: ProcessPoolExecutor to annotate with.
+    `path`: Path to corpus file (or shard).
+    `annotation_cache`: AnnotationCache object. Notes whose text has a cached annotation
+                        are not sent to the workers, and new annotations are added to the
+                        cache. If `None` (default), do not use a cache.
+    `repo`: RepoManager object of the repository the corpus file came from. Only needed
+            with `profile`.
+    `profile`: profiling.BuildProfile object to add annotation times to, by the language
+               of each annotated note. If `None` (default), do not time annotation.
+
+    Yield: (future, on_done) pairs, one for each batch, in file order. See scheduler.Task.
+           `future` is `None` for batches whose annotations are all cached. `on_done`
+           writes a batch's annotated notes to a NoteWriter.
+
+    '''
+    def write_batch(note_elts, keys, annotations, result, writer):
+        computed_annotations = iter(result.annotations if result is not None else ())
+        computed_stage_times = iter(
+            result.stage_times if result is not None and result.stage_times is not None
+            else ()
+        )
+        serialization_times = StageTimes() if profile is not None else None
+        computed = {}
+        for note_elt, key, annotation in zip(note_elts, keys, annotations):
+            if annotation is None:
+                # Identical texts within a batch are only annotated once.
+                if key not in computed:
+                    computed[key] = next(computed_annotations)
+                    if annotation_cache is not None:
+                        annotation_cache.put(key, computed[key])
+                    if profile is not None:
+                        profile.add(
+                            next(computed_stage_times),
+                            repo.name,
+                            note_elt.findtext('language'),
+                        )
+                annotation = computed[key]
+
+            _set_note_annotations(note_elt, *annotation)
+            with timed(serialization_times, 'serialization'):
+                writer.write_element(note_elt)
+
+        if profile is not None:
+            profile.add(serialization_times, repo.name)
+
+    def submit_batch(note_elts):
+        keys = []
+        annotations = []
+        batch = {}
+        for note_elt in note_elts:
+            text = _get_annotation_input(
+                note_elt.findtext('raw'),
+                NoteType(note_elt.findtext('note-type')),
+                note_elt.findtext('language'),
+            )
+            key = annotation_cache.key(text) if annotation_cache is not None else text
+            annotation = annotation_cache.get(key) if annotation_cache is not None else None
+            if annotation is None:
+                batch.setdefault(key, text)
+
+            keys.append(key)
+            annotations.append(annotation)
+
+        future = None
+        if batch:
+            future = executor.submit(
+                _annotate_input_batch,
+                list(batch.values()),
+                profile=profile is not None,
+            )
+
+        # `annotations` holds the cached annotation of each note, or `None` for notes
+        # whose annotation is computed by `future`.
+        return future, partial(write_batch, note_elts, keys, annotations)
+
+    note_elts = []
+    root = None
+    for event, elt in ElementTree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elt
+
+        elif elt.tag == 'note' and elt is not root:
+            # Detach finished notes from the root so they can be freed once written.
+            root.remove(elt)
+            note_elts.append(elt)
+            if len(note_elts) == _ANNOTATION_BATCH_SIZE:
+                yield submit_batch(note_elts)
+                note_elts = []
+
+    if note_elts:
+        yield submit_batch(note_elts)
+
+
+def annotate_data(note_types=(), jobs=None, annotation_cache=None, profile=None):
+    '''Tokenize and POS tag the notes of previously extracted corpus files.
+
+    Each corpus file, or each shard of a sharded corpus file, is rewritten in place. All
+    files are annotated on a single pool of workers, interleaved, largest first.
+
+    `note_types`: Iterable of NoteType values. Only notes of this type will be annotated.
+    `jobs`: Number of worker processes to annotate with. If `None` (default), use one
+            worker per CPU. All corpus files share the same workers.
+    `annotation_cache`: AnnotationCache object to reuse annotations of identical texts
+                        from. If `None` (default), do not use a cache.
+    `profile`: profiling.BuildProfile object to add annotation times to. If `None`
+               (default), do not time annotation.
+
+    '''
+
+    logging.info("Annotating data...")
+
+    tasks = []
+    for repo in RepoManager.get_repolist():
+        for note_type in note_types:
+            path = CORPUSDIR_PATH / Path(f'{note_type}.{repo.name}.xml')
+            paths = get_corpus_file_paths(path)
+            if not paths:
+                logging.warning(f"  {path} does not exist; has it been extracted?")
+                continue
+
+            # The corpus file is read to the end before NoteWriter moves its output over
+            # it.
+            tasks.extend(
+                Task(
+                    shard_path.name,
+                    shard_path.stat().st_size,
+                    partial(NoteWriter, shard_path),
+                    partial(
+                        _submit_corpus_file_annotations,
+                        path=shard_path,
+                        annotation_cache=annotation_cache,
+                        repo=repo,
+                        profile=profile,
+                    ),
+                )
+                for shard_path in paths
+            )
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        run_tasks(tasks, executor, _IN_FLIGHT_FILES_PER_JOB * (jobs or os.cpu_count()))
+
+    if annotation_cache is not None:
+        lookups = annotation_cache.hits + annotation_cache.misses
+        hit_rate = annotation_cache.hits / lookups if lookups else 0
+        logging.info(
+            f"Annotation cache: {lookups} lookups, {annotation_cache.hits} hits"
+            f" ({hit_rate:.1%} hit rate), {len(annotation_cache)} entries."
+        )
+
+    logging.info("Finished annotating data.")
+
+
+def write_binary_data(note_types=()):
+    '''Convert annotated corpus files to binary columnar corpus files.
+
+    `note_types`: Iterable of NoteType values. Only corpus files of these types will be
+                  converted.
+
+    '''
+    logging.info("Writing binary corpus files...")
+
+    write_binary_corpus(
+        CORPUSDIR_PATH / Path(f'{note_type}.{repo.name}.xml')
+        for repo in RepoManager.get_repolist()
+        for note_type in note_types
+    )
+
+    logging.info("Finished writing binary corpus files.")
+
+
 def main(argv):
     args = parser.parse_args(argv)
 
@@ -741,6 +2365,53 @@ def main(argv):
             f"Incompatible opts {'-v' if args.v else '-d'} and {'-V' if args.V else '-q'}."
         )
 
+    if args.jobs < 1:
+        raise ValueError(f"--jobs must be at least 1, not {args.jobs}.")
+
+    if args.annotation_cache_size < 0:
+        raise ValueError(
+            f"--annotation-cache-size cannot be negative, not {args.annotation_cache_size}."
+        )
+
+    if args.persist_annotation_cache and args.annotation_cache_size == 0:
+        raise ValueError(
+            "Incompatible opts --persist-annotation-cache and --annotation-cache-size 0."
+        )
+
+    if args.no_extraction_cache and (args.clear_extraction_cache or args.gc_extraction_cache):
+        raise ValueError(
+            "Incompatible opts --no-extraction-cache and"
+            f" {'--clear-extraction-cache' if args.clear_extraction_cache else '--gc-extraction-cache'}."
+        )
+
+    if args.shard_notes is not None and args.shard_notes < 1:
+        raise ValueError(f"--shard-notes must be at least 1, not {args.shard_notes}.")
+
+    if args.shard_bytes is not None and args.shard_bytes < 1:
+        raise ValueError(f"--shard-bytes must be at least 1, not {args.shard_bytes}.")
+
+    if not 0 <= args.profile_sample <= 1:
+        raise ValueError(f"--profile-sample must be between 0 and 1, not {args.profile_sample}.")
+
+    if args.profile_sample and not args.profile:
+        raise ValueError("--profile-sample requires --profile.")
+
+    if args.file_time_limit is not None and args.file_time_limit <= 0:
+        raise ValueError(f"--file-time-limit must be positive, not {args.file_time_limit}.")
+
+    if args.file_memory_limit is not None and args.file_memory_limit < 1:
+        raise ValueError(f"--file-memory-limit must be positive, not {args.file_memory_limit}.")
+
+    if args.resume:
+        for opt, value in (
+                ('--redo', args.redo),
+                ('--redo-from', args.redo_from),
+                ('--build-notes', args.build_notes),
+                ('--gc-extraction-cache', args.gc_extraction_cache),
+        ):
+            if value:
+                raise ValueError(f"Incompatible opts --resume and {opt}.")
+
     # Process arguments.
     log_level = logging.INFO
     enable_debug_output = False
@@ -781,13 +2452,103 @@ def main(argv):
         logging.getLogger().addHandler(handler)
         logging.getLogger().setLevel(log_level)
 
+    if args.resume:
+        if EXTRACTION_JOURNAL_PATH.is_file():
+            redo_level = ConstructionStep.EXTRACT
+        else:
+            logging.info("No interrupted extraction to resume.")
+
+    # Setup caches.
+    extraction_cache = None
+    if not args.no_extraction_cache:
+        extraction_cache = ExtractionCache()
+
+    if args.clear_extraction_cache:
+        logging.info("Clearing extraction cache.")
+        extraction_cache.clear()
+
+    quarantine = Quarantine()
+    if args.clear_quarantine:
+        logging.info(f"Releasing {len(quarantine)} quarantined files.")
+        quarantine.clear()
+
+    file_budget = None
+    if args.file_time_limit is not None or args.file_memory_limit is not None:
+        file_budget = _FileBudget(
+            args.file_time_limit,
+            args.file_memory_limit * 2**20 if args.file_memory_limit is not None else None,
+        )
+
+    annotation_cache = None
+    if args.annotation_cache_size > 0:
+        annotation_cache = AnnotationCache(
+            ANNOTATOR_VERSION,
+            max_entries=args.annotation_cache_size,
+        )
+        if args.persist_annotation_cache:
+            annotation_cache.load()
+
+    profile = None
+    if args.profile:
+        profile = BuildProfile(sample_rate=args.profile_sample)
+        shutil.rmtree(BUILDNOTES_CPROFILEDIR_PATH, ignore_errors=True)
+
+    def profile_step(name):
+        return profile.step(name) if profile is not None else nullcontext()
+
     # Download
     redo_download = (redo_level <= ConstructionStep.DOWNLOAD)
-    download_repos(force_redownload=redo_download)
+    with profile_step('download'):
+        download_repos(
+            force_redownload=redo_download,
+            jobs=args.jobs,
+            clone_mode=args.clone_mode,
+            update_mirrors=args.update_mirrors,
+        )
 
     # Extract.
     if redo_level <= ConstructionStep.EXTRACT:
-        extract_data(note_types=note_types, write_build_notes=args.build_notes)
+        with profile_step('extract'):
+            extract_data(
+                note_types=note_types,
+                write_build_notes=args.build_notes,
+                jobs=args.jobs,
+                extraction_cache=extraction_cache,
+                gc_extraction_cache=args.gc_extraction_cache,
+                c_backend=args.c_backend,
+                clang_parse_mode=args.clang_parse_mode,
+                include_patterns=args.include,
+                exclude_patterns=args.exclude,
+                max_file_size=args.max_file_size,
+                resume=args.resume,
+                max_shard_notes=args.shard_notes,
+                max_shard_bytes=args.shard_bytes,
+                profile=profile,
+                quarantine=quarantine,
+                file_budget=file_budget,
+            )
+
+    # Annotate.
+    if redo_level <= ConstructionStep.ANNOTATE:
+        with profile_step('annotate'):
+            annotate_data(
+                note_types=note_types,
+                jobs=args.jobs,
+                annotation_cache=annotation_cache,
+                profile=profile,
+            )
+
+        if annotation_cache is not None and args.persist_annotation_cache:
+            annotation_cache.save()
+
+    # Convert.
+    if args.binary:
+        with profile_step('binary'):
+            write_binary_data(note_types=note_types)
+
+    if profile is not None:
+        profile.write(BUILDNOTES_PROFILE_PATH)
+        logging.info(f"Wrote build profile to {BUILDNOTES_PROFILE_PATH}.")
 
 
 if __name__== '__main__': main(sys.argv[1:])
@@ -0,0 +1,316 @@
+'''On-disk caches for reusable build results.'''
+
+
+from defines import ANNOTATION_CACHE_PATH
+from defines import EXTRACTION_CACHEDIR_PATH
+from defines import QUARANTINE_PATH
+from defines import QuarantineReason
+
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+
+class ExtractionCache:
+    '''Content-addressed store of per-file comment extraction results.
+
+    Entries are keyed by the repository and commit a file was extracted from, the git
+    blob SHA of the file, its path within the repository, the languages it may be parsed
+    as, and the extractor version, so an entry is only reused when all of these are
+    unchanged. The repository and commit are part of the key because notes record the
+    repository and file they come from, and the authors and revisions blamed for each
+    line. Because blob SHAs are taken from the checked-out commit, the cache assumes that
+    a repository's working tree matches that commit.
+
+    Each entry is stored as a pickle in its own file, which is written atomically.
+
+    '''
+
+    def __init__(self, directory=EXTRACTION_CACHEDIR_PATH):
+        self._dir = Path(directory)
+        self._used_keys = set()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(repo, commit, blob_sha, path, languages, version, shallow=False):
+        '''Compute the cache key for a file.
+
+        `repo`: Name of the repository the file is in.
+        `commit`: Hexsha of the commit the file is checked out (and blamed) at.
+        `blob_sha`: git blob SHA of the file contents.
+        `path`: Path to the file, relative to the repository directory.
+        `languages`: Iterable of Language enum values the file may be parsed as.
+        `version`: Version of the extractor that produces the cached result.
+        `shallow`: Whether the repository's history is truncated, so that blame
+                   attributes lines to `commit` rather than to the commits that wrote them.
+
+        Return: Hex digest string.
+
+        '''
+        fields = (
+            str(version),
+            repo,
+            commit,
+            'shallow' if shallow else 'full',
+            blob_sha,
+            Path(path).as_posix(),
+            ','.join(str(language) for language in languages),
+        )
+        return sha256('\0'.join(fields).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return self._dir / Path(key[:2]) / Path(f'{key}.pickle')
+
+    def get(self, key):
+        '''Return the cached value for `key`, or `None` if there is no entry.'''
+        self._used_keys.add(key)
+
+        try:
+            with open(self._entry_path(key), 'rb') as entry_file:
+                value = pickle.load(entry_file)
+
+        except FileNotFoundError:
+            self._misses += 1
+            return None
+
+        except (EOFError, pickle.UnpicklingError):
+            logging.warning(f"Discarding corrupt extraction cache entry {key}")
+            self._entry_path(key).unlink(missing_ok=True)
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Store `value` under `key`, replacing any existing entry.'''
+        self._used_keys.add(key)
+
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file and move it into place, so that readers never see a
+        # partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=entry_path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump(value, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, entry_path)
+
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+
+    def clear(self):
+        '''Delete every entry in the cache.'''
+        if self._dir.is_dir():
+            shutil.rmtree(self._dir)
+
+    def gc(self):
+        '''Delete every entry that has not been read or written through this object.
+
+        Return: Number of entries deleted.
+
+        '''
+        removed = 0
+        if self._dir.is_dir():
+            for entry_path in self._dir.glob('*/*'):
+                if entry_path.name.removesuffix('.pickle') not in self._used_keys:
+                    entry_path.unlink()
+                    removed += 1
+
+        return removed
+
+    @property
+    def hits(self):
+        '''Number of lookups answered from the cache.'''
+        return self._hits
+
+    @property
+    def misses(self):
+        '''Number of lookups that found no entry.'''
+        return self._misses
+
+
+class Quarantine:
+    '''List of source files that comment extraction gives up on, and skips thereafter.
+
+    A file is quarantined when extracting it exceeds the per-file time or memory budget,
+    or keeps killing the worker process extracting it. Entries are keyed by repository
+    name, path and git blob SHA, so a quarantined file is extracted again once its
+    contents change.
+
+    Entries are stored as JSON lines appended to one file, each with a single write, so
+    that worker processes can add entries while the main process is reading them.
+
+    '''
+
+    def __init__(self, path=QUARANTINE_PATH):
+        self._path = Path(path)
+        self._entries = {}
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        '''(Re)load the entries in the quarantine file.'''
+        self._entries = {}
+        try:
+            with open(self._path) as quarantine_file:
+                for line in quarantine_file:
+                    try:
+                        entry = json.loads(line)
+                        key = (entry['repo'], entry['path'], entry['sha'])
+                        self._entries[key] = QuarantineReason(entry['reason'])
+
+                    except (ValueError, KeyError, TypeError):
+                        logging.warning(
+                            f"Ignoring malformed entry in {self._path}: {line.strip()}"
+                        )
+
+        except FileNotFoundError:
+            pass
+
+    def get(self, repo, path, blob_sha):
+        '''Get the QuarantineReason a file was quarantined for, or `None`.
+
+        `repo`: Name of the file's repository.
+        `path`: Path to the file, relative to the repository directory.
+        `blob_sha`: git blob SHA of the file contents.
+
+        '''
+        return self._entries.get((repo, Path(path).as_posix(), blob_sha))
+
+    def add(self, repo, path, blob_sha, reason):
+        '''Quarantine a file. Parameters are as for `get()`.
+
+        `reason`: QuarantineReason enum value.
+
+        '''
+        path = Path(path).as_posix()
+        self._entries[(repo, path, blob_sha)] = reason
+
+        line = json.dumps({'repo': repo, 'path': path, 'sha': blob_sha, 'reason': reason})
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, f'{line}\n'.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def clear(self):
+        '''Release every file from quarantine.'''
+        self._entries = {}
+        self._path.unlink(missing_ok=True)
+
+
+class AnnotationCache:
+    '''Bounded, least-recently-used cache of annotations keyed by text hash.
+
+    Many notes (license headers, "Merge branch ..." messages, and the like) have identical
+    text, and so identical annotations. Entries are keyed by a hash of the text that is
+    annotated, together with the annotator version, so they are only reused while the
+    annotation method is unchanged. When the cache holds more than `max_entries` entries,
+    the least recently used entries are evicted.
+
+    The cache may optionally be loaded from and saved to a file, so that it can be reused
+    between builds.
+
+    '''
+
+    def __init__(self, version, max_entries=100000, path=ANNOTATION_CACHE_PATH):
+        self._version = version
+        self._max_entries = max_entries
+        self._path = Path(path)
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, text):
+        '''Compute the cache key for `text`.'''
+        return sha256(f'{self._version}\0{text}'.encode('utf-8')).digest()
+
+    def get(self, key):
+        '''Return the cached annotation for `key`, or `None` if there is no entry.'''
+        try:
+            value = self._entries[key]
+
+        except KeyError:
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Store `value` under `key`, evicting old entries if the cache is full.'''
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        '''Load entries saved by `save()`.
+
+        Saved entries are ignored if they were made by a different annotator version.
+
+        '''
+        try:
+            with open(self._path, 'rb') as cache_file:
+                version, entries = pickle.load(cache_file)
+
+        except FileNotFoundError:
+            return
+
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            logging.warning(f"Ignoring corrupt annotation cache {self._path}")
+            return
+
+        if version != self._version:
+            logging.info("Ignoring annotation cache made by a different annotator version.")
+            return
+
+        for key, value in entries.items():
+            self.put(key, value)
+
+    def save(self):
+        '''Save all entries to the cache file, replacing it atomically.'''
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=self._path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump(
+                    (self._version, self._entries),
+                    temp_file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_path, self._path)
+
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+
+    @property
+    def hits(self):
+        '''Number of lookups answered from the cache.'''
+        return self._hits
+
+    @property
+    def misses(self):
+        '''Number of lookups that found no entry.'''
+        return self._misses
@@ -0,0 +1,578 @@
+'''Compact binary columnar corpus format.
+
+A binary corpus file holds the same notes as an annotated XML corpus file, stored as
+flat arrays that can be memory mapped instead of parsed:
+
+- A vocabulary of interned strings (tokens, POS tags, and metadata values alike), stored
+  as concatenated UTF-8 data with an array of offsets.
+- Token ID and POS ID arrays, holding the tokens and tags of every sentence of every note
+  back to back.
+- Sentence offsets (index of each sentence's first token) and note offsets (index of each
+  note's first sentence).
+- Metadata columns, with one entry per note (or, for authors and revisions, flat ID arrays
+  with per-note offsets).
+
+The file starts with a magic number and a JSON header locating each column. Columns are
+aligned to 8 bytes and stored in native byte order.
+
+'''
+
+
+from corpus import get_corpus_file_paths
+
+from argparse import ArgumentParser
+from array import array
+from pathlib import Path
+from xml.etree import ElementTree
+
+import json
+import logging
+import mmap
+import sys
+
+
+EXTENSION = '.ccb'
+'''File extension of binary corpus files.'''
+
+FORMAT_VERSION = 1
+'''Version of the binary corpus format. Increment on any incompatible change.'''
+
+_MAGIC = b'CCB\0'
+
+_ALIGNMENT = 8
+
+NONE_ID = 0xFFFFFFFF
+'''String ID of missing optional metadata values.'''
+
+NONE_LINE = -1
+'''Line number of missing first/last line metadata values.'''
+
+_STRING_COLUMNS = ('repo', 'note-type', 'file', 'language', 'raw')
+'''Per-note metadata columns holding string IDs, in the order they appear in a note.'''
+
+_LINE_COLUMNS = ('first-line', 'last-line')
+'''Per-note metadata columns holding line numbers.'''
+
+_MULTI_COLUMNS = ('author', 'revision')
+'''Metadata with any number of values per note, stored as ID arrays with offsets.'''
+
+_NOTE_TAGS = (
+    'repo', 'author', 'revision', 'note-type', 'file', 'first-line', 'last-line',
+    'language', 'raw', 'tokens', 'pos',
+)
+'''Tags of the subelements of a note, in the order notes are written.'''
+
+_OPTIONAL_TAGS = ('file', 'first-line', 'last-line', 'language')
+
+
+parser = ArgumentParser(description="Convert annotated XML corpus files to binary corpus files.")
+
+parser.add_argument(
+    'paths',
+    nargs='+',
+    type=Path,
+    help="XML corpus files to convert. Sharded corpus files are converted shard by shard.",
+)
+
+parser.add_argument(
+    '--verify',
+    action='store_true',
+    help="After converting, check that the binary files round-trip to the XML files.",
+)
+
+
+def get_binary_path(xml_path):
+    '''Get the path of the binary corpus file converted from the XML corpus file at `xml_path`.'''
+    return Path(xml_path).with_suffix(EXTENSION)
+
+
+def _split_annotation(text):
+    '''Split a <tokens> or <pos> string into a list of sentences, each a list of strings.'''
+    if not text:
+        return []
+
+    return [sent.split(' ') for sent in text.split('\n')]
+
+
+def _join_annotation(sents):
+    '''Inverse of `_split_annotation()`.'''
+    if not sents:
+        return None
+
+    return '\n'.join(' '.join(sent) for sent in sents)
+
+
+class _ColumnBuilder:
+    '''Accumulate the columns of a binary corpus file in memory.'''
+
+    def __init__(self):
+        self.strings = {}
+        self.string_offsets = array('Q', [0])
+        self.string_data = bytearray()
+
+        self.token_ids = array('I')
+        self.pos_ids = array('I')
+        self.sent_offsets = array('Q', [0])
+        self.note_sent_offsets = array('Q', [0])
+
+        self.string_columns = {name: array('I') for name in _STRING_COLUMNS}
+        self.line_columns = {name: array('q') for name in _LINE_COLUMNS}
+        self.multi_offsets = {name: array('Q', [0]) for name in _MULTI_COLUMNS}
+        self.multi_ids = {name: array('I') for name in _MULTI_COLUMNS}
+
+        # Whether every token is a single whitespace-free word, so that `words()` can
+        # serve tokens without splitting them again.
+        self.simple_tokens = True
+
+    def intern(self, s):
+        if s is None:
+            return NONE_ID
+
+        try:
+            return self.strings[s]
+
+        except KeyError:
+            string_id = len(self.strings)
+            self.strings[s] = string_id
+            self.string_data += s.encode('utf-8')
+            self.string_offsets.append(len(self.string_data))
+            return string_id
+
+    def add_note(self, note_elt):
+        '''Add a note, as read from an annotated XML corpus file.'''
+        tags = [child.tag for child in note_elt]
+        if any(tag not in _NOTE_TAGS for tag in tags) or tags != sorted(
+                tags, key=_NOTE_TAGS.index
+        ) or any(
+                tags.count(tag) > 1 for tag in _NOTE_TAGS if tag not in _MULTI_COLUMNS
+        ):
+            raise ValueError(f"Unexpected note structure {tags}")
+
+        if 'tokens' not in tags or 'pos' not in tags:
+            raise ValueError("Notes must be annotated before they are converted")
+
+        for name in _STRING_COLUMNS:
+            self.string_columns[name].append(self.intern(
+                note_elt.findtext(name) if note_elt.find(name) is not None else None
+            ))
+
+        for name in _LINE_COLUMNS:
+            value = note_elt.findtext(name)
+            self.line_columns[name].append(int(value) if value is not None else NONE_LINE)
+
+        for name in _MULTI_COLUMNS:
+            self.multi_ids[name].extend(
+                self.intern(elt.text or '') for elt in note_elt.findall(name)
+            )
+            self.multi_offsets[name].append(len(self.multi_ids[name]))
+
+        token_sents = _split_annotation(note_elt.findtext('tokens'))
+        pos_sents = _split_annotation(note_elt.findtext('pos'))
+        if [len(sent) for sent in token_sents] != [len(sent) for sent in pos_sents]:
+            raise ValueError("Tokens and POS tags of a note are not aligned")
+
+        for token_sent, pos_sent in zip(token_sents, pos_sents):
+            for token, tag in zip(token_sent, pos_sent):
+                self.token_ids.append(self.intern(token))
+                self.pos_ids.append(self.intern(tag))
+                if self.simple_tokens and token.split() != [token]:
+                    self.simple_tokens = False
+            self.sent_offsets.append(len(self.token_ids))
+        self.note_sent_offsets.append(len(self.sent_offsets) - 1)
+
+    def columns(self):
+        '''Get (name, array) pairs of every column.'''
+        yield 'string-offsets', self.string_offsets
+        yield 'string-data', array('B', self.string_data)
+        yield 'token-ids', self.token_ids
+        yield 'pos-ids', self.pos_ids
+        yield 'sent-offsets', self.sent_offsets
+        yield 'note-sent-offsets', self.note_sent_offsets
+        yield from self.string_columns.items()
+        yield from self.line_columns.items()
+        for name in _MULTI_COLUMNS:
+            yield f'{name}-offsets', self.multi_offsets[name]
+            yield f'{name}-ids', self.multi_ids[name]
+
+
+def _pad(n):
+    return -n % _ALIGNMENT
+
+
+def write_binary_corpus_file(xml_path, binary_path=None):
+    '''Convert an annotated XML corpus file (or shard) to a binary corpus file.
+
+    `xml_path`: Path to the XML corpus file.
+    `binary_path`: Path to write the binary corpus file to. If `None` (default), write it
+                   next to the XML file; see `get_binary_path()`.
+
+    Return: Path to the binary corpus file.
+
+    '''
+    xml_path = Path(xml_path)
+    if binary_path is None:
+        binary_path = get_binary_path(xml_path)
+    binary_path = Path(binary_path)
+
+    builder = _ColumnBuilder()
+    root = None
+    for event, elt in ElementTree.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elt
+
+        elif elt.tag == 'note' and elt is not root:
+            builder.add_note(elt)
+            root.remove(elt)
+
+    columns = list(builder.columns())
+
+    # Lay out the columns after the header. The header's length depends on the offsets it
+    # records, so lay out against a fixed-width estimate and pad the header to it.
+    header = {
+        'version': FORMAT_VERSION,
+        'fileid': xml_path.name,
+        'byteorder': sys.byteorder,
+        'notes': len(builder.note_sent_offsets) - 1,
+        'simple-tokens': builder.simple_tokens,
+        'columns': {},
+    }
+    header_size = len(json.dumps(header)) + 128 * (len(columns) + 1)
+    header_size += _pad(header_size)
+
+    offset = len(_MAGIC) + 4 + header_size
+    for name, column in columns:
+        header['columns'][name] = {
+            'typecode': column.typecode,
+            'offset': offset,
+            'length': len(column),
+        }
+        offset += len(column) * column.itemsize
+        offset += _pad(offset)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    if len(header_bytes) > header_size:
+        raise AssertionError("Binary corpus header estimate too small")
+    header_bytes += b' ' * (header_size - len(header_bytes))
+
+    temp_path = binary_path.with_name(f'.{binary_path.name}.tmp')
+    with open(temp_path, 'wb') as binary_file:
+        binary_file.write(_MAGIC)
+        binary_file.write(header_size.to_bytes(4, 'little'))
+        binary_file.write(header_bytes)
+        for name, column in columns:
+            binary_file.write(column.tobytes())
+            binary_file.write(b'\0' * _pad(binary_file.tell()))
+    temp_path.replace(binary_path)
+
+    return binary_path
+
+
+class BinaryCorpusFile:
+    '''Memory-mapped binary corpus file.
+
+    Columns are served directly from the mapping; nothing is read into memory until it is
+    asked for. Strings are decoded on access.
+
+    '''
+
+    def __init__(self, path):
+        self._path = Path(path)
+
+        with open(self._path, 'rb') as binary_file:
+            self._mmap = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"{self._path} is not a binary corpus file")
+
+        header_start = len(_MAGIC) + 4
+        header_size = int.from_bytes(self._mmap[len(_MAGIC):header_start], 'little')
+        self._header = json.loads(self._mmap[header_start:header_start+header_size])
+
+        if self._header['version'] != FORMAT_VERSION:
+            raise ValueError(
+                f"{self._path} has binary corpus format version {self._header['version']},"
+                f" not {FORMAT_VERSION}"
+            )
+
+        if self._header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{self._path} was written with a different byte order")
+
+        buffer = memoryview(self._mmap)
+        self._columns = {}
+        for name, column in self._header['columns'].items():
+            itemsize = array(column['typecode']).itemsize
+            start = column['offset']
+            stop = start + column['length'] * itemsize
+            self._columns[name] = buffer[start:stop].cast(column['typecode'])
+
+        self._string_offsets = self._columns['string-offsets']
+        self._string_data = self._columns['string-data']
+        self._token_ids = self._columns['token-ids']
+        self._pos_ids = self._columns['pos-ids']
+        self._sent_offsets = self._columns['sent-offsets']
+        self._note_sent_offsets = self._columns['note-sent-offsets']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        '''Number of notes in the file.'''
+        return self._header['notes']
+
+    def close(self):
+        '''Release the memory mapping.'''
+        for column in self._columns.values():
+            column.release()
+        self._columns = {}
+        self._string_offsets = self._string_data = None
+        self._token_ids = self._pos_ids = None
+        self._sent_offsets = self._note_sent_offsets = None
+        self._mmap.close()
+
+    def string(self, string_id):
+        '''Get the vocabulary string with ID `string_id`, or `None` for `NONE_ID`.'''
+        if string_id == NONE_ID:
+            return None
+
+        start = self._string_offsets[string_id]
+        stop = self._string_offsets[string_id+1]
+        return bytes(self._string_data[start:stop]).decode('utf-8')
+
+    def _strings(self, string_ids):
+        '''Decode a sequence of string IDs, decoding each distinct ID only once.'''
+        decoded = {}
+        strings = []
+        for string_id in string_ids:
+            try:
+                strings.append(decoded[string_id])
+            except KeyError:
+                decoded[string_id] = self.string(string_id)
+                strings.append(decoded[string_id])
+
+        return strings
+
+    def _note_token_range(self, index):
+        first_sent = self._note_sent_offsets[index]
+        last_sent = self._note_sent_offsets[index+1]
+        return self._sent_offsets[first_sent], self._sent_offsets[last_sent]
+
+    def _note_sents(self, index, ids):
+        first_sent = self._note_sent_offsets[index]
+        last_sent = self._note_sent_offsets[index+1]
+        return [
+            self._strings(ids[self._sent_offsets[sent]:self._sent_offsets[sent+1]])
+            for sent in range(first_sent, last_sent)
+        ]
+
+    def words(self):
+        '''Get the list of all tokens, as `CccReader.words()` reads them from XML.'''
+        words = []
+        for index in range(len(self)):
+            start, stop = self._note_token_range(index)
+            if start == stop:
+                # Empty comment; just delimiter(s).
+                words.append(" ")
+            elif self._header['simple-tokens']:
+                words.extend(self._strings(self._token_ids[start:stop]))
+            else:
+                for token in self._strings(self._token_ids[start:stop]):
+                    words.extend(token.split())
+
+        return words
+
+    def sents(self):
+        '''Get the list of tokenized sentences, as `CccReader.sents()` reads them from XML.'''
+        sents = []
+        for index in range(len(self)):
+            note_sents = self._note_sents(index, self._token_ids)
+            if note_sents:
+                sents.extend(note_sents)
+            else:
+                # Empty comment; just delimiters.
+                sents.append([" "])
+
+        return sents
+
+    def pos(self):
+        '''Get (word, POS tag) pairs, as `CccReader.pos()` reads them from XML.'''
+        word_pos_pairs = []
+        for index in range(len(self)):
+            start, stop = self._note_token_range(index)
+            words = self._strings(self._token_ids[start:stop])
+            tags = self._strings(self._pos_ids[start:stop])
+            if self._header['simple-tokens']:
+                word_pos_pairs.extend(zip(words, tags))
+            else:
+                # Split and pair the way the XML reader does, which pairs tokens and tags
+                # by position after splitting on whitespace.
+                word_pos_pairs.extend(zip(' '.join(words).split(), ' '.join(tags).split()))
+
+        return word_pos_pairs
+
+    def note(self, index):
+        '''Rebuild note number `index` as an XML element, as it appears in XML corpus files.'''
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        values = {}
+        for name in _STRING_COLUMNS:
+            values[name] = self.string(self._columns[name][index])
+
+        for name in _LINE_COLUMNS:
+            line = self._columns[name][index]
+            values[name] = str(line) if line != NONE_LINE else None
+
+        for name in _MULTI_COLUMNS:
+            offsets = self._columns[f'{name}-offsets']
+            ids = self._columns[f'{name}-ids'][offsets[index]:offsets[index+1]]
+            values[name] = [self.string(string_id) for string_id in ids]
+
+        values['tokens'] = _join_annotation(self._note_sents(index, self._token_ids))
+        values['pos'] = _join_annotation(self._note_sents(index, self._pos_ids))
+
+        note_elt = ElementTree.Element('note')
+        for tag in _NOTE_TAGS:
+            if tag in _MULTI_COLUMNS:
+                for value in values[tag]:
+                    ElementTree.SubElement(note_elt, tag).text = value or None
+            elif tag not in _OPTIONAL_TAGS or values[tag] is not None:
+                ElementTree.SubElement(note_elt, tag).text = values[tag] or None
+
+        return note_elt
+
+    def notes(self):
+        '''Iterate over every note, as rebuilt by `note()`.'''
+        for index in range(len(self)):
+            yield self.note(index)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def fileid(self):
+        '''Fileid of the XML corpus file this file was converted from.'''
+        return self._header['fileid']
+
+
+def _xml_words_sents_pos(notes):
+    '''Get words, sents and pos from XML notes the way CccReader reads them.'''
+    words = []
+    sents = []
+    word_pos_pairs = []
+    for note in notes:
+        if note.find('tokens').text:
+            words.extend(note.find('tokens').text.split())
+            sents.extend(sent.split(' ') for sent in note.find('tokens').text.split('\n'))
+            word_pos_pairs.extend(zip(
+                note.find('tokens').text.split(),
+                note.find('pos').text.split(),
+            ))
+        else:
+            words.append(" ")
+            sents.append([" "])
+
+    return words, sents, word_pos_pairs
+
+
+def verify_binary_corpus_file(xml_path, binary_path=None):
+    '''Check that a binary corpus file round-trips to the XML corpus file it came from.
+
+    Every note rebuilt from the binary file must serialize identically to the note in the
+    XML file, and words, sentences and POS pairs must equal those read from the XML file.
+
+    `xml_path`: Path to the XML corpus file.
+    `binary_path`: Path to the binary corpus file. If `None` (default), use the path
+                   `write_binary_corpus_file()` writes to by default.
+
+    Return: List of strings describing each mismatch. Empty if the files agree.
+
+    '''
+    xml_path = Path(xml_path)
+    if binary_path is None:
+        binary_path = get_binary_path(xml_path)
+
+    mismatches = []
+    xml_notes = list(ElementTree.parse(xml_path).getroot())
+    with BinaryCorpusFile(binary_path) as binary_file:
+        if len(binary_file) != len(xml_notes):
+            mismatches.append(
+                f"{binary_path}: {len(binary_file)} notes, but {xml_path} has {len(xml_notes)}"
+            )
+
+        for index, (xml_note, binary_note) in enumerate(zip(xml_notes, binary_file.notes())):
+            if ElementTree.tostring(xml_note) != ElementTree.tostring(binary_note):
+                mismatches.append(f"{binary_path}: note {index} differs")
+
+        xml_words, xml_sents, xml_pos = _xml_words_sents_pos(xml_notes)
+        for name, xml_value, binary_value in (
+                ('words', xml_words, binary_file.words()),
+                ('sents', xml_sents, binary_file.sents()),
+                ('pos', xml_pos, binary_file.pos()),
+        ):
+            if xml_value != binary_value:
+                mismatches.append(f"{binary_path}: {name} differ")
+
+    return mismatches
+
+
+def write_binary_corpus(paths, verify=False):
+    '''Convert XML corpus files to binary corpus files.
+
+    Each shard of a sharded corpus file is converted to its own binary file. Binary files
+    left by earlier conversions of the same corpus file, under a different sharding, are
+    removed.
+
+    `paths`: Iterable of paths to XML corpus files (without shard indices).
+    `verify`: Whether to check each binary file with `verify_binary_corpus_file()`.
+
+    Return: List of mismatches found by verification. See `verify_binary_corpus_file()`.
+
+    '''
+    mismatches = []
+    for path in paths:
+        path = Path(path)
+        xml_paths = get_corpus_file_paths(path)
+        if not xml_paths:
+            logging.warning(f"  {path} does not exist; has it been extracted?")
+            continue
+
+        binary_paths = [get_binary_path(xml_path) for xml_path in xml_paths]
+        old_paths = [get_binary_path(path)] + [
+            shard_path for shard_path in path.parent.glob(f'{path.stem}.*{EXTENSION}')
+            if shard_path.stem.removeprefix(f'{path.stem}.').isdigit()
+        ]
+        for old_path in old_paths:
+            if old_path not in binary_paths:
+                old_path.unlink(missing_ok=True)
+
+        for xml_path, binary_path in zip(xml_paths, binary_paths):
+            logging.debug(f"  {xml_path} -> {binary_path}")
+            write_binary_corpus_file(xml_path, binary_path)
+            if verify:
+                mismatches.extend(verify_binary_corpus_file(xml_path, binary_path))
+
+    for mismatch in mismatches:
+        logging.error(mismatch)
+
+    return mismatches
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+    logging.getLogger().setLevel(logging.INFO)
+
+    mismatches = write_binary_corpus(args.paths, verify=args.verify)
+    if args.verify:
+        logging.info(f"{len(mismatches)} mismatches.")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,505 @@
+'''Tools for writing corpus files.'''
+
+
+from contextlib import contextmanager
+from pathlib import Path
+from xml.etree import ElementTree
+
+import json
+import logging
+import os
+import time
+
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+'''XML declaration written at the start of every corpus file.'''
+
+CHECKPOINT_INTERVAL = 1.0
+'''Minimum number of seconds between syncs of a NoteWriter's checkpoints to disk.'''
+
+
+MANIFEST_VERSION = 1
+'''Version of the format of shard manifests written by NoteWriter.'''
+
+
+def get_shard_path(path, index):
+    '''Get the path of shard number `index` of the corpus file at `path`.
+
+    For example, shard 3 of `comment.django.xml` is `comment.django.0003.xml`.
+
+    '''
+    path = Path(path)
+    return path.with_name(f'{path.stem}.{index:04d}{path.suffix}')
+
+
+def get_manifest_path(path):
+    '''Get the path of the shard manifest of the corpus file at `path`.'''
+    path = Path(path)
+    return path.with_name(f'{path.stem}.manifest.json')
+
+
+def read_manifest(path):
+    '''Read the shard manifest of the corpus file at `path`.
+
+    Return: Dict parsed from the manifest, with keys:
+            - 'version': MANIFEST_VERSION the manifest was written with.
+            - 'fileid': Name of the (unsharded) corpus file.
+            - 'notes': Total number of notes in all shards.
+            - 'shards': List of dicts, in order, each with the keys 'fileid' (name of the
+                        shard file) and 'notes' (number of notes in the shard).
+            `None` if the corpus file is not sharded.
+
+    '''
+    try:
+        with open(get_manifest_path(path)) as manifest_file:
+            return json.load(manifest_file)
+
+    except FileNotFoundError:
+        return None
+
+
+def get_corpus_file_paths(path):
+    '''Get the paths of the files holding the notes of the corpus file at `path`.
+
+    Return: List of the paths of the file's shards, in order, if it is sharded. Otherwise,
+            a list of just `path`, or an empty list if it does not exist.
+
+    '''
+    path = Path(path)
+    manifest = read_manifest(path)
+    if manifest is not None:
+        return [path.with_name(shard['fileid']) for shard in manifest['shards']]
+    elif path.is_file():
+        return [path]
+    else:
+        return []
+
+
+def _get_temp_path(path):
+    return path.with_name(f'.{path.name}.tmp')
+
+
+def _get_journal_path(path):
+    return path.with_name(f'.{path.name}.journal')
+
+
+class NoteWriter:
+    '''Incrementally write `<note>` elements to a corpus file.
+
+    Notes are written to a temporary file next to `path` as they arrive, so memory use
+    does not grow with the number of notes. The temporary file is moved to `path` when the
+    writer is closed, so an interrupted build never leaves a truncated corpus file behind.
+
+    Use as a context manager; if the managed block raises, the temporary file is discarded
+    and `path` is left untouched.
+
+    A sharded writer splits its notes across several shard files instead (see
+    `get_shard_path()`), starting a new shard once the current one holds a maximum number
+    of notes or bytes. Shards are moved into place together when the writer is closed,
+    along with a manifest listing them (see `read_manifest()`). Closing a writer also
+    removes shards, or the unsharded file, left at `path` by earlier builds.
+
+    A journaled writer can also record checkpoints, each marking the end of a unit of
+    work (such as one source file's notes). Checkpoints are kept in a journal next to the
+    temporary file, and are only synced to disk after the notes before them, so that an
+    interrupted write can be resumed from its last synced checkpoint. If the managed block
+    of a journaled writer raises, the temporary file and journal are kept for resuming.
+
+    '''
+
+    def __init__(
+            self,
+            path,
+            journal=False,
+            resume_checkpoints=0,
+            max_shard_notes=None,
+            max_shard_bytes=None,
+    ):
+        '''Start writing the corpus file at `path`.
+
+        `journal`: Whether to journal checkpoints.
+        `resume_checkpoints`: Number of checkpoints to resume from. If nonzero, the notes
+                              written before that many checkpoints of the journal left by
+                              an earlier journaled writer are kept, and writing continues
+                              after them. See `read_checkpoints()`.
+        `max_shard_notes`: If given, shard the file, with at most this many notes per
+                           shard.
+        `max_shard_bytes`: If given, shard the file, starting a new shard once a shard
+                           has grown to this many bytes. Shards may exceed it by one note.
+
+        '''
+        self._path = Path(path)
+        self._max_shard_notes = max_shard_notes
+        self._max_shard_bytes = max_shard_bytes
+        self._notes_written = 0
+
+        # Note counts of finished shards, and of the shard being written.
+        self._finished_shard_notes = []
+        self._shard_notes = 0
+
+        self._journal_path = _get_journal_path(self._path)
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._journal_file = None
+        self._unsynced_records = []
+        self._last_sync_time = time.monotonic()
+
+        if resume_checkpoints:
+            if not journal:
+                raise ValueError("`resume_checkpoints` requires `journal`")
+
+            records = NoteWriter._read_resumable_records(self._path, self.sharded)
+            checkpoint_indices = [i for i, record in enumerate(records) if record[0] == 'C']
+            if len(checkpoint_indices) < resume_checkpoints:
+                raise ValueError(
+                    f"{self._journal_path} has only {len(checkpoint_indices)} resumable"
+                    f" checkpoints, not {resume_checkpoints}"
+                )
+
+            records = records[:checkpoint_indices[resume_checkpoints-1] + 1]
+            self._finished_shard_notes = [
+                record[2] for record in records if record[0] == 'S'
+            ]
+            _, _, offset, self._shard_notes, self._notes_written, _ = records[-1]
+
+            self._file = open(_get_temp_path(self._shard_path), 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+            # Remove shards started after the last resumed checkpoint.
+            index = len(self._finished_shard_notes) + 1
+            while self.sharded and _get_temp_path(self._get_shard_path(index)).is_file():
+                _get_temp_path(self._get_shard_path(index)).unlink()
+                index += 1
+
+            # Drop the checkpoints that are not being resumed from.
+            self._journal_file = open(self._journal_path, 'w')
+            for record in records:
+                self._journal_file.write(NoteWriter._format_journal_record(record))
+            self._sync_journal()
+
+        else:
+            self._open_shard()
+            if journal:
+                self._journal_file = open(self._journal_path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _get_shard_path(self, index):
+        return get_shard_path(self._path, index) if self.sharded else self._path
+
+    @property
+    def _shard_path(self):
+        '''Path of the shard being written.'''
+        return self._get_shard_path(len(self._finished_shard_notes))
+
+    def _open_shard(self):
+        self._file = open(_get_temp_path(self._shard_path), 'wb')
+        self._file.write(XML_DECLARATION)
+        self._file.write(b'<notes>')
+        self._shard_notes = 0
+
+    def _finish_shard(self):
+        self._file.write(b'</notes>')
+        self._file.close()
+
+    def _start_next_shard(self):
+        '''Finish the shard being written, and start writing the next.'''
+        shard_path = self._shard_path
+        self._file.write(b'</notes>')
+        if self._journal_file is not None:
+            # Checkpoints recorded after this shard must not reach the disk before it.
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced_records.append(('S', shard_path.name, self._shard_notes))
+        self._file.close()
+
+        self._finished_shard_notes.append(self._shard_notes)
+        self._open_shard()
+
+    @staticmethod
+    def _format_journal_record(record):
+        return '\t'.join(str(field) for field in record) + '\n'
+
+    @staticmethod
+    def _read_journal(journal_path):
+        '''Read records from a journal.
+
+        Records are either checkpoints, ('C', shard name, offset, shard notes written,
+        notes written, key), or finished shards, ('S', shard name, shard notes written). A
+        record that was only partially written before an interruption is ignored.
+
+        '''
+        records = []
+        try:
+            with open(journal_path) as journal_file:
+                for line in journal_file:
+                    if not line.endswith('\n'):
+                        break
+
+                    fields = line.rstrip('\n').split('\t', 5)
+                    if fields[0] == 'C':
+                        records.append((
+                            'C',
+                            fields[1],
+                            int(fields[2]),
+                            int(fields[3]),
+                            int(fields[4]),
+                            fields[5],
+                        ))
+                    else:
+                        records.append(('S', fields[1], int(fields[2])))
+
+        except FileNotFoundError:
+            pass
+
+        return records
+
+    @staticmethod
+    def _read_resumable_records(path, sharded=False):
+        '''Read the records of a journal that an interrupted write can be resumed from.
+
+        Stop at the first record whose shard is named differently than a writer with the
+        given sharding would name it, or whose notes are missing from disk.
+
+        '''
+        path = Path(path)
+
+        records = []
+        index = 0
+        for record in NoteWriter._read_journal(_get_journal_path(path)):
+            shard_path = get_shard_path(path, index) if sharded else path
+            if record[1] != shard_path.name:
+                break
+
+            try:
+                shard_size = _get_temp_path(shard_path).stat().st_size
+            except FileNotFoundError:
+                break
+
+            if record[0] == 'C':
+                if shard_size < record[2]:
+                    break
+            else:
+                index += 1
+
+            records.append(record)
+
+        return records
+
+    @staticmethod
+    def read_checkpoints(path, sharded=False):
+        '''Read the checkpoints left by an interrupted journaled writer for `path`.
+
+        `sharded`: Whether the writer to resume with is sharded. Checkpoints of a writer
+                   with different sharding cannot be resumed from.
+
+        Return: List of checkpoint keys, in the order they were recorded. Empty if there
+                is nothing to resume.
+
+        '''
+        return [
+            record[5]
+            for record in NoteWriter._read_resumable_records(path, sharded)
+            if record[0] == 'C'
+        ]
+
+    def write(self, serialized_note):
+        '''Write a single serialized `<note>` element (UTF-8 encoded bytes).'''
+        if self._shard_notes and (
+                (self._max_shard_notes is not None and self._shard_notes >= self._max_shard_notes)
+                or (self._max_shard_bytes is not None and self._file.tell() >= self._max_shard_bytes)
+        ):
+            self._start_next_shard()
+
+        self._file.write(serialized_note)
+        self._notes_written += 1
+        self._shard_notes += 1
+
+    def write_element(self, note_elt):
+        '''Write a single `<note>` ElementTree.Element.'''
+        self.write(ElementTree.tostring(note_elt, encoding='utf-8'))
+
+    def checkpoint(self, key):
+        '''Record that every note so far has been written, under the string `key`.
+
+        Checkpoints are synced to disk at most every `CHECKPOINT_INTERVAL` seconds, so a
+        hard interruption loses at most that much work.
+
+        '''
+        if self._journal_file is None:
+            raise ValueError(f"{self._path} is not being journaled")
+
+        self._unsynced_records.append((
+            'C',
+            self._shard_path.name,
+            self._file.tell(),
+            self._shard_notes,
+            self._notes_written,
+            key,
+        ))
+        if time.monotonic() - self._last_sync_time >= CHECKPOINT_INTERVAL:
+            self._sync_checkpoints()
+
+    def _sync_checkpoints(self):
+        '''Sync the notes, then the checkpoints recorded after them, to disk.'''
+        if self._unsynced_records:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            for record in self._unsynced_records:
+                self._journal_file.write(NoteWriter._format_journal_record(record))
+            self._unsynced_records = []
+            self._sync_journal()
+
+        self._last_sync_time = time.monotonic()
+
+    def _sync_journal(self):
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+
+    def _write_manifest(self):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'fileid': self._path.name,
+            'notes': self._notes_written,
+            'shards': [
+                {'fileid': self._get_shard_path(index).name, 'notes': notes}
+                for index, notes in enumerate(self._finished_shard_notes)
+            ],
+        }
+
+        manifest_path = get_manifest_path(self._path)
+        temp_path = _get_temp_path(manifest_path)
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def _remove_stale_files(self):
+        '''Remove corpus files for `path` that earlier builds left and this one did not write.'''
+        if self.sharded:
+            self._path.unlink(missing_ok=True)
+            index = len(self._finished_shard_notes)
+        else:
+            get_manifest_path(self._path).unlink(missing_ok=True)
+            index = 0
+
+        while get_shard_path(self._path, index).is_file():
+            get_shard_path(self._path, index).unlink()
+            index += 1
+
+    def close(self):
+        '''Finish the corpus file and move it into place at `path`.'''
+        if not self._file.closed:
+            self._finish_shard()
+            self._finished_shard_notes.append(self._shard_notes)
+
+            for index in range(len(self._finished_shard_notes)):
+                shard_path = self._get_shard_path(index)
+                os.replace(_get_temp_path(shard_path), shard_path)
+
+            if self.sharded:
+                self._write_manifest()
+            self._remove_stale_files()
+
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_path.unlink(missing_ok=True)
+
+    def discard(self):
+        '''Abandon the corpus file, leaving `path` untouched.
+
+        A journaled writer keeps its temporary files and journal, after syncing its
+        checkpoints, so that it can be resumed.
+
+        '''
+        if not self._file.closed:
+            if self._journal_file is not None:
+                self._sync_checkpoints()
+                self._file.close()
+                self._journal_file.close()
+                logging.info(f"Kept checkpoints of {self._path} for resuming.")
+            else:
+                self._file.close()
+                for index in range(len(self._finished_shard_notes) + 1):
+                    _get_temp_path(self._get_shard_path(index)).unlink(missing_ok=True)
+
+    @property
+    def path(self):
+        '''Path to the corpus file being written.'''
+        return self._path
+
+    @property
+    def sharded(self):
+        '''Whether the corpus file is split into shards.'''
+        return self._max_shard_notes is not None or self._max_shard_bytes is not None
+
+    @property
+    def notes_written(self):
+        '''Number of notes written so far.'''
+        return self._notes_written
+
+
+class OutputJournal:
+    '''Record of the corpus files a run has finished writing.
+
+    Lets a run that is interrupted partway be resumed without rewriting the files it
+    finished. The journal exists only while a run is in progress (or interrupted).
+
+    '''
+
+    def __init__(self, path, resume=False):
+        '''Open the journal at `path`.
+
+        `resume`: Whether to keep the files recorded by an earlier run, if the journal
+                  exists. Otherwise, the journal is started afresh.
+
+        '''
+        self._path = Path(path)
+        self._completed = set()
+
+        if resume and self._path.is_file():
+            with open(self._path) as journal_file:
+                self._completed.update(
+                    line.rstrip('\n') for line in journal_file if line.endswith('\n')
+                )
+
+        else:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._path.write_text('')
+
+    def __contains__(self, name):
+        return name in self._completed
+
+    def record(self, name):
+        '''Record that the corpus file `name` has been finished.'''
+        with open(self._path, 'a') as journal_file:
+            journal_file.write(f'{name}\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self._completed.add(name)
+
+    @contextmanager
+    def recording(self, open_output, name):
+        '''Context manager that opens an output, and records `name` once it is closed.
+
+        `open_output`: Callable returning a context manager, such as a NoteWriter.
+
+        '''
+        with open_output() as output:
+            yield output
+
+        self.record(name)
+
+    def remove(self):
+        '''Remove the journal, once the run it records has finished.'''
+        self._path.unlink(missing_ok=True)
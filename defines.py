@@ -20,6 +20,24 @@ LIBCLANG_HEADER_PATH = Path('/usr/lib64/clang/16/include')
 CORPUSDIR_PATH = Path('./corpus')
 '''Path to the directory where corpus data is stored.'''
 
+EXTRACTION_JOURNAL_PATH = CORPUSDIR_PATH / Path('.extraction.journal')
+'''Path to the file recording the progress of an unfinished extraction, for resuming.'''
+
+CACHEDIR_PATH = Path('./cache')
+'''Path to the directory where reusable intermediate build results are stored.'''
+
+EXTRACTION_CACHEDIR_PATH = CACHEDIR_PATH / Path('extraction')
+'''Path to the directory where per-file comment extraction results are cached.'''
+
+ANNOTATION_CACHE_PATH = CACHEDIR_PATH / Path('annotations.pickle')
+'''Path to the file where the annotation cache is persisted between builds.'''
+
+MIRRORDIR_PATH = CACHEDIR_PATH / Path('mirrors')
+'''Path to the directory where bare mirrors of downloaded repositories are stored.'''
+
+QUARANTINE_PATH = CACHEDIR_PATH / Path('quarantine.jsonl')
+'''Path to the file listing source files that comment extraction skips.'''
+
 BUILDNOTESDIR_PATH = Path('./build_notes')
 '''Path to the directory where build notes are stored.'''
 
@@ -29,14 +47,20 @@ BUILDNOTES_INCLUDED_CODE_PATH = BUILDNOTESDIR_PATH / Path('comments_code_include
 BUILDNOTES_EXCLUDED_CODE_PATH = BUILDNOTESDIR_PATH / Path('comments_code_excluded.txt')
 '''Path to the file that logs syntactically valid code that has not been included in the corpus.'''
 
+BUILDNOTES_PROFILE_PATH = BUILDNOTESDIR_PATH / Path('profile.json')
+'''Path to the file where the timings of a profiled build are reported.'''
+
+BUILDNOTES_CPROFILEDIR_PATH = BUILDNOTESDIR_PATH / Path('profiles')
+'''Path to the directory where cProfile statistics of sampled source files are dumped.'''
+
 
 class ConstructionStep(IntEnum):
     '''Steps of corpus construction.
 
     START: Before building corpus.
     DOWNLOAD: Downloading repos.
-    EXTRACT: Extracting and tokenizing raw data from repos.
-    ANNOTATE: Annotating utterances.
+    EXTRACT: Extracting raw data from repos.
+    ANNOTATE: Tokenizing and POS tagging extracted utterances.
     END: After building corpus.
 
     '''
@@ -69,3 +93,85 @@ class NoteType(StrEnum):
     CHANGELOG = 'changelog'
     COMMENT = 'comment'
     # DOCUMENTATION = 'documentation'
+
+
+class CommentBackend(StrEnum):
+    '''Methods of extracting comments from C and C++ source files.
+
+    LIBCLANG: Validate each file by parsing it with libclang, then take comments from the
+              parsed translation unit.
+    LEXER: Find comments with the lightweight lexer in lexer.py, without parsing. Files
+           are not validated; their language is taken from their extension.
+
+    '''
+    LIBCLANG = 'libclang'
+    LEXER = 'lexer'
+
+
+class ClangParseMode(StrEnum):
+    '''Ways of parsing C and C++ files with libclang.
+
+    FULL: Parse and semantically analyze the whole file.
+    FAST: Skip function bodies, and treat the file as an incomplete translation unit, so
+          that no end-of-file analysis (such as template instantiation) is done. Syntax
+          errors inside function bodies are then not diagnosed, so a few files that FULL
+          rejects are accepted.
+
+    '''
+    FULL = 'full'
+    FAST = 'fast'
+
+
+class CorpusFormat(StrEnum):
+    '''Formats corpus files can be read from.
+
+    XML: Annotated XML corpus files, as written by construction.
+    BINARY: Binary columnar corpus files converted from the XML files (see columnar.py).
+
+    '''
+    XML = 'xml'
+    BINARY = 'binary'
+
+
+class CodeVerdict(StrEnum):
+    '''Verdicts on whether a comment is code, as recorded in build notes.
+
+    NOT_CODE: The comment is not syntactically valid code.
+    EXCLUDED: The comment is commented-out code, and is left out of the corpus.
+    INCLUDED: The comment is syntactically valid code, but looks like natural language,
+              so it is kept in the corpus.
+
+    '''
+    NOT_CODE = 'not-code'
+    EXCLUDED = 'excluded'
+    INCLUDED = 'included'
+
+
+class QuarantineReason(StrEnum):
+    '''Reasons comment extraction gave up on a source file.
+
+    TIME: Extracting the file took longer than the per-file time limit.
+    MEMORY: Extracting the file needed more memory than the per-file memory limit.
+    CRASH: Extracting the file repeatedly killed the worker process extracting it.
+
+    '''
+    TIME = 'time'
+    MEMORY = 'memory'
+    CRASH = 'crash'
+
+
+class CloneMode(StrEnum):
+    '''Ways of mirroring a repository's history when downloading it.
+
+    FULL: Mirror every object.
+    BLOBLESS: Mirror commits and trees only. File contents are fetched from the
+              repository's URL when they are first needed, so only the contents of the
+              checked-out revision, and of revisions that are blamed, are downloaded.
+    SINGLE_REVISION: Mirror only the tip of each ref (a depth-1 shallow clone). A pinned
+                     revision that is not a tip is fetched on its own. Blame then
+                     attributes every line to the checked-out revision.
+
+    '''
+    FULL = 'full'
+    BLOBLESS = 'blobless'
+    SINGLE_REVISION = 'single-revision'
@@ -0,0 +1,135 @@
+'''Lightweight lexer that extracts comments from C and C++ source code.
+
+Finding comments does not require parsing: libclang's comment tokens come from lexing the
+file in raw mode, without preprocessing. This module reproduces that lexing, skipping
+over everything that is not a comment, so that comments can be extracted without
+resolving includes or running semantic analysis.
+
+'''
+
+
+from defines import Language
+
+from bisect import bisect_right
+from collections import namedtuple
+
+import re
+
+
+CommentToken = namedtuple('CommentToken', ('start', 'end', 'text'))
+'''Comment found by the lexer.
+
+start: (line, column) pair of the first byte of the comment.
+end: (line, column) pair of the byte just past the end of the comment.
+text: Bytes of the comment, including delimiters and any line splices.
+
+Lines and columns both count from 1, and columns count bytes, as in libclang source
+locations.
+
+'''
+
+
+# Bytes that may continue an identifier. Bytes of multibyte UTF-8 characters are treated as
+# identifier bytes, as are dollar signs (a GNU extension libclang enables by default).
+_IDENTIFIER_START = rb'A-Za-z_$\x80-\xff'
+_IDENTIFIER_CONTINUE = rb'0-9A-Za-z_$\x80-\xff'
+
+# Line splice: a backslash at the end of a line, optionally followed by whitespace. Like
+# libclang, comments that directly follow a splice are considered to start with it.
+_SPLICE_PATTERN = rb'\\[ \t]*\r?\n'
+
+_COMMON_TOKEN_PATTERNS = (
+    # Line comment. A splice continues the comment onto the next line.
+    rb'(?P<line_comment>(?:' + _SPLICE_PATTERN + rb')*//(?:' + _SPLICE_PATTERN + rb'|[^\r\n])*)',
+    # Block comment. Unterminated block comments run to the end of the file.
+    rb'(?P<block_comment>(?:' + _SPLICE_PATTERN + rb')*/\*.*?(?:\*/|\Z))',
+    # String and character literals. Unterminated literals end at the end of the line.
+    rb'"(?:\\(?:\r\n|.)|[^"\\\r\n])*"?',
+    rb"'(?:\\(?:\r\n|.)|[^'\\\r\n])*'?",
+    # Identifier.
+    rb'[' + _IDENTIFIER_START + rb'][' + _IDENTIFIER_CONTINUE + rb']*',
+)
+
+_C_PP_NUMBER_PATTERN = (
+    rb'\.?[0-9](?:[eEpP][+-]|[.' + _IDENTIFIER_CONTINUE + rb'])*'
+)
+
+# C++14 digit separators: a quote inside a number is not the start of a character literal.
+_CPP_PP_NUMBER_PATTERN = (
+    rb"\.?[0-9](?:[eEpP][+-]|'[" + _IDENTIFIER_CONTINUE + rb"]|[." + _IDENTIFIER_CONTINUE + rb'])*'
+)
+
+# C++11 raw string literal. Must come before identifiers, so that its prefix is not lexed
+# as one.
+_CPP_RAW_STRING_PATTERN = rb'(?:u8|[uUL])?R"(?P<delimiter>[^ ()\\\t\v\f\r\n]{0,16})\(.*?\)(?P=delimiter)"'
+
+# Anything else: a run of bytes that cannot start any of the tokens above, or else a
+# single byte.
+_OTHER_PATTERN = rb'''[^/"'.\\''' + _IDENTIFIER_CONTINUE + rb']+|.'
+
+_C_TOKEN_REGEX = re.compile(
+    b'|'.join((*_COMMON_TOKEN_PATTERNS, _C_PP_NUMBER_PATTERN, _OTHER_PATTERN)),
+    re.DOTALL,
+)
+
+_CPP_TOKEN_REGEX = re.compile(
+    b'|'.join((
+        _CPP_RAW_STRING_PATTERN,
+        *_COMMON_TOKEN_PATTERNS,
+        _CPP_PP_NUMBER_PATTERN,
+        _OTHER_PATTERN,
+    )),
+    re.DOTALL,
+)
+
+_NEWLINE_REGEX = re.compile(rb'\n')
+
+
+def lex_comments(source, language):
+    '''Find all comments in C or C++ source code.
+
+    Literals are lexed the way libclang lexes them (including C++ raw strings and digit
+    separators), so that comment delimiters inside them are not mistaken for comments.
+    Preprocessor directives are lexed like any other line, as libclang does when
+    tokenizing a file.
+
+    `source`: Source code, as bytes.
+    `language`: Language enum value, either `Language.C` or `Language.CPP`.
+
+    Return: List of CommentToken named tuples, in source order.
+
+    '''
+    if language == Language.C:
+        token_regex = _C_TOKEN_REGEX
+    elif language == Language.CPP:
+        token_regex = _CPP_TOKEN_REGEX
+    else:
+        raise ValueError(f"`language` must be one of {{{Language.C},{Language.CPP}}}, not {language}")
+
+    line_starts = [0]
+    line_starts.extend(match.end() for match in _NEWLINE_REGEX.finditer(source))
+
+    def get_position(offset):
+        line = bisect_right(line_starts, offset)
+        return line, offset - line_starts[line-1] + 1
+
+    comments = []
+    for match in token_regex.finditer(source):
+        if match.lastgroup in ('line_comment', 'block_comment'):
+            comments.append(CommentToken(
+                get_position(match.start()),
+                get_position(match.end()),
+                match.group(),
+            ))
+
+    return comments
+
+
+def lex_file_comments(path, language):
+    '''Find all comments in the C or C++ source file at `path`.
+
+    See `lex_comments()`.
+
+    '''
+    with open(path, 'rb') as source_file:
+        return lex_comments(source_file.read(), language)
@@ -0,0 +1,231 @@
+'''Timing and profiling of corpus construction.'''
+
+
+from collections import Counter
+from contextlib import contextmanager
+from contextlib import nullcontext
+from pathlib import Path
+
+import heapq
+import json
+import time
+import zlib
+
+
+STAGES = (
+    'enumeration',
+    'validation',
+    'lexing',
+    'blame',
+    'commit-metadata',
+    'code-classification',
+    'log',
+    'sentence-tokenization',
+    'word-tokenization',
+    'pos-tagging',
+    'serialization',
+)
+'''Stages of corpus construction that are timed, in the order they are reported.
+
+enumeration: Listing a repository's source files.
+validation: Determining the language of a source file (parsing C/C++ with libclang, or
+            Python with `ast`).
+lexing: Finding the comments of a source file (with libclang, the lexer, or `tokenize`).
+blame: Running `git blame` on a source file.
+commit-metadata: Looking up the author and revision of blamed lines or commits.
+code-classification: Deciding which comments are code, for build notes.
+log: Reading a repository's history with `git log`.
+sentence-tokenization, word-tokenization, pos-tagging: Annotating a note's text.
+serialization: Converting notes to XML, and writing annotated notes.
+
+'''
+
+
+class StageTimes:
+    '''Wall and CPU time spent in each stage of corpus construction.
+
+    CPU time is that of the process the stage ran in.
+
+    '''
+
+    def __init__(self):
+        self.wall = Counter()
+        self.cpu = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager adding the time spent inside it to stage `name`.'''
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+
+        finally:
+            self.wall[name] += time.perf_counter() - wall_start
+            self.cpu[name] += time.process_time() - cpu_start
+
+    def update(self, other):
+        '''Add the times of another StageTimes object to this one.'''
+        self.wall.update(other.wall)
+        self.cpu.update(other.cpu)
+
+    def to_dict(self):
+        '''Get a JSON-serializable dict of (stage -> {'wall': seconds, 'cpu': seconds}).'''
+        stages = [stage for stage in STAGES if stage in self.wall]
+        stages.extend(stage for stage in self.wall if stage not in STAGES)
+        return {
+            stage: {'wall': self.wall[stage], 'cpu': self.cpu[stage]}
+            for stage in stages
+        }
+
+
+def timed(stage_times, name):
+    '''Time stage `name` into `stage_times`, or do nothing if `stage_times` is `None`.'''
+    return stage_times.stage(name) if stage_times is not None else nullcontext()
+
+
+def timed_iter(iterable, stage_times, name):
+    '''Iterate over `iterable`, timing the production of each item as stage `name`.
+
+    If `stage_times` is `None`, iterate without timing.
+
+    '''
+    if stage_times is None:
+        yield from iterable
+        return
+
+    iterator = iter(iterable)
+    while True:
+        with stage_times.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+        yield item
+
+
+class BuildProfile:
+    '''Timings of a build, broken down by step, stage, repository and language.
+
+    Stage times are recorded by whichever process does the work, and added to the profile
+    in the main process with `add()`.
+
+    `max_slowest_files`: Number of slowest files to keep for the report.
+    `sample_rate`: Fraction of source files to run under cProfile. See `sample()`.
+
+    '''
+
+    def __init__(self, max_slowest_files=20, sample_rate=0):
+        self._max_slowest_files = max_slowest_files
+        self._sample_rate = sample_rate
+        self._steps = StageTimes()
+        self._stages = StageTimes()
+        self._stages_by_repo = {}
+        self._stages_by_language = {}
+        self._files_by_repo = Counter()
+        self._files_by_language = Counter()
+        self._slowest_files = []
+        self._sampled_files = []
+
+    def step(self, name):
+        '''Context manager timing construction step `name` (e.g. 'extract').'''
+        return self._steps.stage(name)
+
+    def add(self, stage_times, repo, language=None):
+        '''Add stage times recorded for work on a repository.
+
+        `stage_times`: StageTimes object.
+        `repo`: Name of the repository.
+        `language`: Language enum value the work was done for, or `None` if the work is
+                    not specific to a language.
+
+        '''
+        self._stages.update(stage_times)
+        self._stages_by_repo.setdefault(repo, StageTimes()).update(stage_times)
+        if language is not None:
+            self._stages_by_language.setdefault(str(language), StageTimes()).update(stage_times)
+
+    def add_file(self, stage_times, repo, path, language, wall, cpu):
+        '''Add the stage times and total time of extracting comments from a source file.
+
+        `path`: Path to the file, relative to the repository directory.
+        `wall`, `cpu`: Total wall and CPU time spent on the file by its worker.
+
+        Other parameters are as for `add()`.
+
+        '''
+        self.add(stage_times, repo, language)
+        self._files_by_repo[repo] += 1
+        self._files_by_language[str(language)] += 1
+
+        # Keep a min-heap of the slowest files.
+        record = (wall, repo, str(path), str(language), cpu, stage_times.to_dict())
+        if len(self._slowest_files) < self._max_slowest_files:
+            heapq.heappush(self._slowest_files, record)
+        elif self._slowest_files and record[:2] > self._slowest_files[0][:2]:
+            heapq.heapreplace(self._slowest_files, record)
+
+    def sample(self, repo, path):
+        '''Decide whether to run extraction of a source file under cProfile.
+
+        Files are sampled by a hash of their repository and path, so the same files are
+        sampled by every build with the same sample rate.
+
+        '''
+        if self._sample_rate <= 0:
+            return False
+
+        key = f'{repo}/{Path(path).as_posix()}'.encode('utf-8')
+        sampled = zlib.crc32(key) / 2**32 < self._sample_rate
+        if sampled:
+            self._sampled_files.append((repo, str(path)))
+
+        return sampled
+
+    def to_dict(self):
+        '''Get the profile as a JSON-serializable dict.'''
+        return {
+            'steps': self._steps.to_dict(),
+            'stages': self._stages.to_dict(),
+            'repos': {
+                repo: {
+                    'files': self._files_by_repo[repo],
+                    'stages': stage_times.to_dict(),
+                }
+                for repo, stage_times in sorted(self._stages_by_repo.items())
+            },
+            'languages': {
+                language: {
+                    'files': self._files_by_language[language],
+                    'stages': stage_times.to_dict(),
+                }
+                for language, stage_times in sorted(self._stages_by_language.items())
+            },
+            'slowest-files': [
+                {
+                    'repo': repo,
+                    'path': path,
+                    'language': language,
+                    'wall': wall,
+                    'cpu': cpu,
+                    'stages': stages,
+                }
+                for wall, repo, path, language, cpu, stages in sorted(
+                    self._slowest_files,
+                    key=lambda record: record[:3],
+                    reverse=True,
+                )
+            ],
+            'sampled-files': [
+                {'repo': repo, 'path': path} for repo, path in self._sampled_files
+            ],
+        }
+
+    def write(self, path):
+        '''Write the profile to `path` as JSON.'''
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+
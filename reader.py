@@ -1,41 +1,318 @@
 '''NLTK reader for Code Comment Corpus.'''
 
 
+from columnar import BinaryCorpusFile
+from columnar import get_binary_path
+from columnar import EXTENSION as BINARY_EXTENSION
+from corpus import read_manifest
+from defines import CorpusFormat
 from defines import NoteType
 from repo import RepoManager
 
+from collections import OrderedDict
 from nltk.corpus.reader.api import CategorizedCorpusReader
+from nltk.corpus.reader.util import ConcatenatedCorpusView
+from nltk.corpus.reader.util import StreamBackedCorpusView
 from nltk.corpus.reader.xmldocs import XMLCorpusReader
+from pathlib import Path
 from timeit import timeit
 from xml.etree import ElementTree
 
+import copy
+import os
+import re
+
+
+_FILEID_REGEX = re.compile(
+    r'(?P<note_type>[^.]+)\.(?P<repo>.+?)(?:\.(?P<shard>[0-9]{4,}))?\.(?P<extension>[^.]+)'
+)
+
 
 def get_fileid_components(fileid):
     '''Split a corpus fileid into its semantic components.
 
+    Fileids have the form `<note type>.<repo>.xml` or, for shards of sharded corpus files,
+    `<note type>.<repo>.<shard>.xml` (e.g. `comment.django.0003.xml`).
+
     Return: Python dict of:
             - 'note-type': NoteType enum value of what type of annotations the file
                            contains.
             - 'repo': Name of the repository the file's data came from, as a string.
+            - 'shard': Index of the shard, as an int, or `None` if the file is not a
+                       shard.
             - 'extension': Extension of the file. Will generally be "xml".    
 
     '''
-    components = fileid.split('.')
+    match = _FILEID_REGEX.fullmatch(fileid)
+    if match is None:
+        raise ValueError(f"Could not interpret '{fileid}' as corpus fileid.")
+
     return {
-        'note-type': NoteType(components[0]),
-        'repo': components[1],
-        'extension': components[2],
+        'note-type': NoteType(match['note_type']),
+        'repo': match['repo'],
+        'shard': int(match['shard']) if match['shard'] is not None else None,
+        'extension': match['extension'],
     }
 
 
+def _note_words(note):
+    '''Get the tokens of a note, as `CccReader.words()` reads them.'''
+    if note.find('tokens').text:
+        return note.find('tokens').text.split()
+    else:
+        # Empty comment; just delimiter(s).
+        return [" "]
+
+
+def _note_sents(note):
+    '''Get the tokenized sentences of a note, as `CccReader.sents()` reads them.'''
+    if note.find('tokens').text:
+        return [sent.split(' ') for sent in note.find('tokens').text.split('\n')]
+    else:
+        # Empty comment; just delimiters.
+        return [[" "]]
+
+
+def _note_pos(note):
+    '''Get the (word, part-of-speech tag) pairs of a note, as `CccReader.pos()` reads them.'''
+    if note.find('tokens').text:
+        words = note.find('tokens').text.split()
+        pos = note.find('pos').text.split()
+        return list(zip(words, pos))
+    else:
+        return []
+
+
+_NOTE_START = b'<note>'
+_NOTE_END = b'</note>'
+
+
+class NoteStreamView(StreamBackedCorpusView):
+    '''Lazy sequence of the values of the notes in an XML corpus file.
+
+    The file is read in blocks of whole notes, of about `block_size` bytes. Each block is
+    parsed on its own and released once its values have been taken, so iterating over the
+    view takes constant memory however large the file is. Like other NLTK corpus views,
+    the view supports `len()` (which reads the file through once), indexing and slicing;
+    random access re-reads only the block it falls in.
+
+    Blocks are found without parsing: a note can only end at the text "</note>", since any
+    "<" in note text is escaped.
+
+    `path`: Path or nltk PathPointer of the XML corpus file.
+    `read_note`: Callable taking a `<note>` element and returning a list of its values.
+    `block_size`: Number of bytes to read at a time.
+
+    '''
+
+    def __init__(self, path, read_note, block_size=2**16):
+        self._read_note = read_note
+        self._block_size = block_size
+        super().__init__(path, encoding=None)
+
+    def read_block(self, stream):
+        start = stream.tell()
+        data = stream.read(self._block_size)
+
+        end = data.rfind(_NOTE_END)
+        while end == -1:
+            more = stream.read(self._block_size)
+            if not more:
+                # Nothing is left but the end of the file.
+                return []
+
+            data += more
+            end = data.rfind(_NOTE_END)
+
+        end += len(_NOTE_END)
+        stream.seek(start + end)
+
+        values = []
+        for note in ElementTree.fromstring(
+                b'<notes>' + data[data.find(_NOTE_START):end] + b'</notes>'
+        ):
+            values.extend(self._read_note(note))
+
+        return values
+
+
+DEFAULT_CACHE_FILE_BYTES = 2**28
+'''Default total size on disk of the corpus files CccReader keeps parsed.'''
+
+
+class ParsedFileCache:
+    '''Least-recently-used cache of parsed corpus files, bounded by their size on disk.
+
+    Entries are keyed by fileid, and remember the modification time and size of the file
+    they were parsed from, so a file that has been rewritten since (for example, by a
+    rebuild) is parsed again.
+
+    The budget is a file-size budget, not a memory bound: it limits the total size on disk
+    of the files whose parses are kept. A parsed file takes several times as much memory
+    as its file, so the memory used grows in proportion to the budget.
+
+    `max_file_bytes`: Maximum total size on disk of the cached files. If 0, nothing is
+                      cached.
+
+    '''
+
+    def __init__(self, max_file_bytes=DEFAULT_CACHE_FILE_BYTES):
+        self._max_file_bytes = max_file_bytes
+        # Map of (fileid -> ((modification time, size), parsed file)), least recently used
+        # first.
+        self._entries = OrderedDict()
+        self._file_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, fileid, path, parse):
+        '''Get a parsed corpus file, parsing it if it is not cached or has changed.
+
+        `fileid`: Fileid of the file.
+        `path`: Path to the file.
+        `parse`: Callable taking no arguments and returning the parsed file.
+
+        '''
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._entries.get(fileid)
+        if entry is not None:
+            if entry[0] == signature:
+                self._entries.move_to_end(fileid)
+                self._hits += 1
+                return entry[1]
+
+            self._invalidations += 1
+            self._remove(fileid)
+
+        self._misses += 1
+        value = parse()
+
+        if stat.st_size <= self._max_file_bytes:
+            self._entries[fileid] = (signature, value)
+            self._file_bytes += stat.st_size
+            while self._file_bytes > self._max_file_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+        return value
+
+    def _remove(self, fileid):
+        (_, size), _ = self._entries.pop(fileid)
+        self._file_bytes -= size
+
+    def clear(self):
+        '''Drop every entry. Statistics are kept.'''
+        self._entries.clear()
+        self._file_bytes = 0
+
+    @property
+    def max_file_bytes(self):
+        '''Maximum total size on disk of the cached files.'''
+        return self._max_file_bytes
+
+    @property
+    def file_bytes(self):
+        '''Total size on disk of the cached files.'''
+        return self._file_bytes
+
+    @property
+    def hits(self):
+        '''Number of lookups answered from the cache.'''
+        return self._hits
+
+    @property
+    def misses(self):
+        '''Number of lookups that had to parse the file.'''
+        return self._misses
+
+    @property
+    def invalidations(self):
+        '''Number of entries dropped because their file had changed.'''
+        return self._invalidations
+
+    @property
+    def evictions(self):
+        '''Number of entries dropped to stay within `max_file_bytes`.'''
+        return self._evictions
+
+
 class CccReader(CategorizedCorpusReader, XMLCorpusReader):
-    '''Reader class for Code Comment Corpus.'''
+    '''Reader class for Code Comment Corpus.
+
+    `corpus_format`: CorpusFormat value of the files to read. With `CorpusFormat.BINARY`,
+                     read the binary files converted from the XML files (see columnar.py)
+                     instead of parsing XML; fileids are then the binary files' names.
+    `cache_file_bytes`: Total size on disk of the XML corpus files to keep parsed between
+                        calls (see ParsedFileCache). If 0, every call parses the files it
+                        reads. Binary corpus files are memory-mapped, so are not cached.
+
+    '''
 
-    def __init__(self):
+    def __init__(
+            self,
+            corpus_format=CorpusFormat.XML,
+            cache_file_bytes=DEFAULT_CACHE_FILE_BYTES,
+    ):
         root = 'corpus'
-        fileids = r'.*?\..*?\.xml'
+        self._cache = ParsedFileCache(cache_file_bytes)
+        self._corpus_format = CorpusFormat(corpus_format)
+        if self._corpus_format == CorpusFormat.BINARY:
+            extension = re.escape(BINARY_EXTENSION)
+        else:
+            extension = r'\.xml'
+
+        fileids = rf'.*?\..*?{extension}'
         XMLCorpusReader.__init__(self, root, fileids)
-        CategorizedCorpusReader.__init__(self, kwargs={'cat_pattern': r'(.*?)\..*?\.xml'})
+        CategorizedCorpusReader.__init__(self, kwargs={'cat_pattern': rf'(.*?)\..*?{extension}'})
+
+    @property
+    def cache(self):
+        '''ParsedFileCache of the XML corpus files read so far, for its statistics.'''
+        return self._cache
+
+    def _parse(self, fileid):
+        '''Get the root element of an XML corpus file, parsing it only if needed.'''
+        return self._cache.get(
+            fileid,
+            self.abspath(fileid).path,
+            lambda: XMLCorpusReader.xml(self, fileid),
+        )
+
+    def _notes(self, fileids=None, categories=None, repos=None):
+        '''Iterate over the notes of the selected XML corpus files.
+
+        The notes are shared with the reader's cache, so must not be modified.
+
+        '''
+        for fileid in self._filter_fileids(fileids, categories, repos):
+            yield from self._parse(fileid)
+
+    def _view(self, read_note, fileids=None, categories=None, repos=None):
+        '''Get a lazy view of what `read_note` returns for each note of the selected files.'''
+        return ConcatenatedCorpusView([
+            NoteStreamView(self.abspath(fileid), read_note)
+            for fileid in self._filter_fileids(fileids, categories, repos)
+        ])
+
+    def _read_binary(self, read, fileids=None, categories=None, repos=None):
+        '''Concatenate what `read` returns for each selected binary corpus file.
+
+        `read`: Callable taking a BinaryCorpusFile and returning an iterable.
+
+        '''
+        values = []
+        for fileid in self._filter_fileids(fileids, categories, repos):
+            with BinaryCorpusFile(self.abspath(fileid).path) as binary_file:
+                values.extend(read(binary_file))
+
+        return values
 
     def _filter_fileids(self, fileids=None, categories=None, repos=None):
         '''Return fileids that match all provided criteria.
@@ -78,6 +355,29 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
 
         return fileids
 
+    def shards(self, fileid):
+        '''Get the fileids of the shards of a corpus file, in order.
+
+        Shards are ordinary fileids, so each can be read independently (for example, by
+        separate processes).
+
+        `fileid`: Fileid of a corpus file, without a shard index (e.g.
+                  `comment.django.xml`).
+
+        Return: List of the shards' fileids, or a list of just `fileid` if the file is not
+                sharded.
+
+        '''
+        manifest = read_manifest(Path(self.root) / fileid)
+        if manifest is None:
+            return [fileid]
+
+        shards = [shard['fileid'] for shard in manifest['shards']]
+        if self._corpus_format == CorpusFormat.BINARY:
+            shards = [get_binary_path(shard).name for shard in shards]
+
+        return shards
+
     def repos(self):
         '''Get list of repositories corpus data was extracted from.'''
         return set(
@@ -97,20 +397,26 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         repos: List of repositories. Each element may be either the repository name as a
                string, or a RepoManager object. The list may contain a mixture of both.
 
-        Return: xml.etree.ElementTree.Element tree representing the corpus.
+        Return: xml.etree.ElementTree.Element tree representing the corpus. The tree is
+                the caller's own: modifying it does not affect later calls.
 
         '''
-        fileids = self._filter_fileids(fileids, categories, repos)
-
+        if self._corpus_format == CorpusFormat.BINARY:
+            xml_root = ElementTree.Element('notes')
+            xml_root.extend(self._read_binary(
+                BinaryCorpusFile.notes, fileids, categories, repos,
+            ))
+            return xml_root
+
+        # Copy the notes, so that the cached parses cannot be modified through them.
         xml_root = ElementTree.Element('notes')
-        for fileid in fileids:
-            file_notes = XMLCorpusReader.xml(self, fileid)
-            for note in file_notes:
-                xml_root.append(note)
+        xml_root.extend(
+            copy.deepcopy(note) for note in self._notes(fileids, categories, repos)
+        )
 
         return xml_root
 
-    def words(self, fileids=None, categories=None, repos=None):
+    def words(self, fileids=None, categories=None, repos=None, lazy=False):
         '''Get list of all tokens in corpus.
 
         May optionally filter to a subcorpus using the fileids, categories, and repos
@@ -121,6 +427,10 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         categories: List of note categories (see defines.NoteType).
         repos: List of repositories. Each element may be either the repository name as a
                string, or a RepoManager object. The list may contain a mixture of both.
+        lazy: Return a lazy sequence that streams tokens from the XML corpus files (see
+              NoteStreamView) instead of a list, bypassing the reader's cache. The
+              sequence re-reads the files on every pass, and never compares equal to a
+              list. Binary corpus files are memory-mapped, and are always read into a list.
 
         '''
         # TODO Stip comment delimiters.
@@ -131,19 +441,19 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         # for fileid in fileids:
         #     words.extend(super().words(fileids=[fileid]))
 
-        xml = self.xml(fileids, categories, repos)
+        if self._corpus_format == CorpusFormat.BINARY:
+            return self._read_binary(BinaryCorpusFile.words, fileids, categories, repos)
+
+        if lazy:
+            return self._view(_note_words, fileids, categories, repos)
 
         words = []
-        for note in xml:
-            if note.find('tokens').text:
-                words.extend(note.find('tokens').text.split())
-            else:
-                # Empty comment; just delimiter(s).
-                words.append(" ")
+        for note in self._notes(fileids, categories, repos):
+            words.extend(_note_words(note))
 
         return words
 
-    def sents(self, fileids=None, categories=None, repos=None):
+    def sents(self, fileids=None, categories=None, repos=None, lazy=False):
         '''Get a list of tokenized sentences.
 
         May optionally filter to a subcorpus using the fileids, categories, and repos
@@ -154,6 +464,8 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         categories: List of note categories (see defines.NoteType).
         repos: List of repositories. Each element may be either the repository name as a
                string, or a RepoManager object. The list may contain a mixture of both.
+        lazy: Return a lazy sequence that streams sentences from the XML corpus files.
+              See `words()`.
 
         Return: List of sentences, where each element of the return list is itself a list
                 of the tokens in that sentence.
@@ -161,22 +473,19 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         '''
         # TODO Strip comment delimiters.
 
-        xml = self.xml(fileids, categories, repos)
+        if self._corpus_format == CorpusFormat.BINARY:
+            return self._read_binary(BinaryCorpusFile.sents, fileids, categories, repos)
+
+        if lazy:
+            return self._view(_note_sents, fileids, categories, repos)
 
         sents = []
-        for note in xml:
-            if note.find('tokens').text:
-                sents.extend(
-                    sent.split(' ')
-                    for sent in note.find('tokens').text.split('\n')
-                )
-            else:
-                # Empty comment; just delimiters.
-                sents.append([" "])
+        for note in self._notes(fileids, categories, repos):
+            sents.extend(_note_sents(note))
 
         return sents
 
-    def pos(self, fileids=None, categories=None, repos=None):
+    def pos(self, fileids=None, categories=None, repos=None, lazy=False):
         '''Get pairs of the form (word, part-of-speech tag).
 
         May optionally filter to a subcorpus using the fileids, categories, and repos
@@ -187,19 +496,22 @@ class CccReader(CategorizedCorpusReader, XMLCorpusReader):
         `categories`: List of note cateogires (see defines.NoteType).
         `repos`: List of repositories. Each element may be either the repository name as a
                string, or a RepoManager object. The list may contain a mixture of both.
+        `lazy`: Return a lazy sequence that streams pairs from the XML corpus files. See
+                `words()`.
 
         Return: List of tuples, where each tuple is a pair of the form
                 (word, part-of-speech tag).
 
         '''
-        xml = self.xml(fileids, categories, repos)
+        if self._corpus_format == CorpusFormat.BINARY:
+            return self._read_binary(BinaryCorpusFile.pos, fileids, categories, repos)
+
+        if lazy:
+            return self._view(_note_pos, fileids, categories, repos)
 
         word_pos_pairs = []
-        for note in xml:
-            if note.find('tokens').text:
-                words = note.find('tokens').text.split()
-                pos = note.find('pos').text.split()
-                word_pos_pairs.extend(zip(words, pos))
+        for note in self._notes(fileids, categories, repos):
+            word_pos_pairs.extend(_note_pos(note))
 
         return word_pos_pairs
 
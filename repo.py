@@ -1,17 +1,79 @@
 '''Tools for repository management.'''
 
 
+from defines import CloneMode
+from defines import MIRRORDIR_PATH
 from defines import REPODIR_PATH
 from defines import REPOLIST_PATH
 
+from hashlib import sha256 as anon_hash
 from pathlib import Path
 
 import collections
 import git
+import itertools as itr
 import logging
 import os
 import re
 import shutil
+import tempfile
+
+
+CommitMetadata = collections.namedtuple('CommitMetadata', ('author', 'rev'))
+'''Corpus-ready metadata for a single commit.
+
+author: Anonymized ID of the commit's author.
+rev: Short (7 character) revision ID of the commit.
+
+'''
+
+
+TrackedFile = collections.namedtuple('TrackedFile', ('path', 'sha', 'size'))
+'''File tracked in a repository at some revision.
+
+path: Path relative to the repository directory, as a POSIX-style string.
+sha: git blob SHA of the file contents.
+size: Size of the file in bytes.
+
+'''
+
+_SYMLINK_MODE = '120000'
+'''git tree entry mode of symbolic links.'''
+
+_CLONE_MODE_ARGS = {
+    CloneMode.FULL: (),
+    CloneMode.BLOBLESS: ('--filter=blob:none',),
+    CloneMode.SINGLE_REVISION: ('--depth=1',),
+}
+'''Extra `git clone`/`git fetch` arguments for each CloneMode.'''
+
+_CLONE_MODE_CONFIG_KEY = 'ccc.clonemode'
+'''git config key recording the CloneMode a mirror was created with.'''
+
+_ABBREVIATED_SHA_PATTERN = re.compile(r'[0-9a-fA-F]{4,39}')
+'''Pattern of abbreviated object names, which cannot be fetched by name.'''
+
+_LOG_FORMAT = '%H%n%an%n%B'
+'''`git log` format of each commit record read by `RepoManager.iter_log()`.'''
+
+_LOG_READ_SIZE = 1 << 16
+'''Number of bytes of `git log` output read at a time.'''
+
+
+_CommitRecord = collections.namedtuple('_CommitRecord', ('hexsha', 'author'))
+'''Lightweight stand-in for git.Commit, for commit data parsed directly from git output.'''
+
+_AuthorRecord = collections.namedtuple('_AuthorRecord', ('name', 'email'))
+'''Lightweight stand-in for git.Actor, for author data parsed directly from git output.'''
+
+
+class RevisionNotFoundError(Exception):
+    '''A repository's pinned revision could not be found at its URL.'''
+
+
+def anonymize_id(s):
+    '''Hash an identifying string to anonymize it.'''
+    return anon_hash(s.encode('utf-8')).hexdigest()[:16]
 
 
 class RepoManager:
@@ -23,6 +85,7 @@ class RepoManager:
         self._name = RepoManager.get_name_from_url(url)
         # self._commit # TODO
         self._dir = REPODIR_PATH / Path(self._name)
+        self._mirror_dir = MIRRORDIR_PATH / Path(f'{self._name}.git')
         self._git = None
         self._git_cmd = None
 
@@ -32,6 +95,15 @@ class RepoManager:
     def __repr__(self):
         return f"RepoManager({self._name})"
 
+    def __getstate__(self):
+        # git.Repo and git.cmd.Git objects hold open subprocesses and cannot be pickled;
+        # drop them so RepoManager objects can be sent to worker processes. They will be
+        # recreated lazily on first use.
+        state = self.__dict__.copy()
+        state['_git'] = None
+        state['_git_cmd'] = None
+        return state
+
     @staticmethod
     def get_repolist(repolist_path=REPOLIST_PATH):
         '''Get list of RepoManager objects created from repolist file.'''
@@ -67,14 +139,27 @@ class RepoManager:
         '''
         return self._dir.is_dir() and os.listdir(self._dir)
 
-    def download(self, force_redownload=False):
+    def download(self, force_redownload=False, clone_mode=CloneMode.FULL, update_mirror=False):
         '''Download the repository from data at its URL.
 
+        The repository's history is kept in a bare mirror at `self.mirror_dir`, and
+        `self.dir` is a worktree of the mirror with `self.rev` checked out. An existing
+        mirror is reused, so redownloading only fetches from the URL if `self.rev` is
+        missing from the mirror (or if `update_mirror` is `True`).
+
         If the path at `self.dir` is a populated directory, this function assumes that the
         repository has already been downloaded, ans skips it unless `force_redownload` is
         `True`.
 
-        skip_redownload: Download repository even if directory at self.dir is populated.
+        force_redownload: Download repository even if directory at self.dir is populated.
+        clone_mode: CloneMode enum value selecting how much history to mirror. A mirror
+                    created with a different mode is replaced.
+        update_mirror: Fetch from the repository's URL into an existing mirror before
+                       checking out.
+
+        Return: Whether the repository was downloaded.
+
+        Raise RevisionNotFoundError if `self.rev` cannot be found at the repository's URL.
 
         '''
         download = True
@@ -82,20 +167,176 @@ class RepoManager:
             if force_redownload:
                 logging.debug(f"{self._name}: Forcing redownload")
                 shutil.rmtree(self._dir)
+                self._git = None
+                self._git_cmd = None
                 download = True
             else:
                 logging.debug(f"{self._name}: Already downloaded")
                 download = False
 
         if download:
-            logging.debug(f"{self._name}: Downloading...")
-            git.Repo.clone_from(self._url, self._dir)
+            commit = self._update_mirror(clone_mode, update_mirror)
             logging.debug(f"{self._name}: Switching to revision {self._rev}")
-            self.git_cmd.checkout(self._rev)
+            mirror_git_cmd = git.cmd.Git(self._mirror_dir)
+            # Forget worktrees whose directories have been deleted, such as the one above.
+            mirror_git_cmd.worktree('prune')
+            mirror_git_cmd.worktree('add', '--detach', str(self._dir.resolve()), commit)
             logging.debug(f"{self._name}: Done.")
 
         return download
 
+    def _update_mirror(self, clone_mode=CloneMode.FULL, update=False):
+        '''Create or update the bare mirror of the repository.
+
+        Return: Hexsha of the commit `self.rev` refers to in the mirror.
+
+        '''
+        clone_mode_args = _CLONE_MODE_ARGS[clone_mode]
+
+        if self._mirror_dir.is_dir():
+            try:
+                mirror_clone_mode = git.cmd.Git(self._mirror_dir).config(_CLONE_MODE_CONFIG_KEY)
+            except git.exc.GitCommandError:
+                mirror_clone_mode = None
+
+            if mirror_clone_mode != clone_mode:
+                logging.debug(
+                    f"{self._name}: Replacing {mirror_clone_mode or 'unknown'} mirror with"
+                    f" {clone_mode} mirror"
+                )
+                shutil.rmtree(self._mirror_dir)
+
+        if not self._mirror_dir.is_dir():
+            logging.debug(f"{self._name}: Mirroring {self._url} ({clone_mode})...")
+            self._mirror_dir.parent.mkdir(parents=True, exist_ok=True)
+            git.cmd.Git().clone('--mirror', *clone_mode_args, self._url, str(self._mirror_dir))
+            git.cmd.Git(self._mirror_dir).config(_CLONE_MODE_CONFIG_KEY, str(clone_mode))
+
+        elif update:
+            logging.debug(f"{self._name}: Updating mirror...")
+            git.cmd.Git(self._mirror_dir).fetch('--prune', *clone_mode_args, 'origin')
+
+        else:
+            logging.debug(f"{self._name}: Reusing mirror")
+
+        mirror_git_cmd = git.cmd.Git(self._mirror_dir)
+        try:
+            return mirror_git_cmd.rev_parse('--verify', f'{self._rev}^{{commit}}')
+        except git.exc.GitCommandError:
+            pass
+
+        # rev-parse resolves any object present in the mirror, so the revision is missing
+        # from it: it is newer than the mirror, not reachable from any ref, or outside the
+        # history of a shallow mirror. Fetch it explicitly. Only ref names and full object
+        # names can be fetched, so an abbreviated object name is first expanded.
+        logging.debug(f"{self._name}: Fetching revision {self._rev}")
+        try:
+            mirror_git_cmd.fetch(*clone_mode_args, 'origin', self._rev)
+        except git.exc.GitCommandError as e:
+            if not _ABBREVIATED_SHA_PATTERN.fullmatch(self._rev):
+                raise RevisionNotFoundError(
+                    f"{self._name}: Could not fetch revision {self._rev} from {self._url}."
+                ) from e
+
+            rev = self._expand_abbreviated_rev()
+            logging.debug(f"{self._name}: Fetching revision {rev}")
+            try:
+                mirror_git_cmd.fetch(*clone_mode_args, 'origin', rev)
+            except git.exc.GitCommandError as e:
+                raise RevisionNotFoundError(
+                    f"{self._name}: Could not fetch revision {rev} (expanded from"
+                    f" {self._rev}) from {self._url}."
+                ) from e
+
+        return mirror_git_cmd.rev_parse('--verify', 'FETCH_HEAD^{commit}')
+
+    def _expand_abbreviated_rev(self):
+        '''Expand `self.rev`, an abbreviated object name, to a full commit hexsha.
+
+        The name is resolved against the history at the repository's URL, which is cloned
+        without trees or file contents into a temporary directory for the purpose.
+
+        '''
+        logging.debug(f"{self._name}: Expanding abbreviated revision {self._rev}")
+        self._mirror_dir.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self._mirror_dir.parent) as history_dir:
+            try:
+                git.cmd.Git().clone('--bare', '--filter=tree:0', self._url, history_dir)
+                return git.cmd.Git(history_dir).rev_parse(
+                    '--verify', f'{self._rev}^{{commit}}'
+                )
+            except git.exc.GitCommandError as e:
+                raise RevisionNotFoundError(
+                    f"{self._name}: Revision {self._rev} does not name a commit at"
+                    f" {self._url}."
+                ) from e
+
+    def tracked_files(self, rev='HEAD'):
+        '''List the regular files tracked at revision `rev`.
+
+        Reads the tree of `rev` with a single `git ls-tree`, without walking the working
+        tree. Symbolic links and submodules are not included.
+
+        Return: List of TrackedFile named tuples, in git's path order.
+
+        '''
+        tracked_files = []
+        for entry in self.git_cmd.ls_tree('-r', '-l', '-z', rev).split('\0'):
+            if entry:
+                info, path = entry.split('\t', 1)
+                mode, object_type, sha, size = info.split()
+                if object_type == 'blob' and mode != _SYMLINK_MODE:
+                    tracked_files.append(TrackedFile(path, sha, int(size)))
+
+        return tracked_files
+
+    def resolve_commit(self, rev='HEAD'):
+        '''Get the hexsha of the commit revision `rev` refers to.'''
+        return self.git_cmd.rev_parse('--verify', f'{rev}^{{commit}}')
+
+    def is_shallow(self):
+        '''Is the repository's history truncated (as by CloneMode.SINGLE_REVISION)?'''
+        return self.git_cmd.rev_parse('--is-shallow-repository') == 'true'
+
+    def count_commits(self, rev='HEAD'):
+        '''Count the commits reachable from revision `rev`.'''
+        return int(self.git_cmd.rev_list('--count', rev))
+
+    def iter_log(self, rev='HEAD'):
+        '''Iterate over the commits reachable from revision `rev`, newest first.
+
+        Commit data is read from a single `git log` process as it is produced, rather than
+        loading each commit object separately.
+
+        Yield: (commit, message) pairs. `commit` has `hexsha` and `author.name`
+               attributes, and so can be looked up in a CommitMetadataTable. `message` is
+               the raw commit message.
+
+        '''
+        process = self.git_cmd.log(rev, '-z', f'--format={_LOG_FORMAT}', as_process=True)
+
+        # Records are terminated by NUL bytes, which cannot occur in commit data.
+        partial_record = b''
+        for chunk in iter(lambda: process.stdout.read(_LOG_READ_SIZE), b''):
+            *records, partial_record = (partial_record + chunk).split(b'\0')
+            for record in records:
+                yield RepoManager._parse_log_record(record)
+
+        if partial_record:
+            yield RepoManager._parse_log_record(partial_record)
+
+        process.wait()
+
+    @staticmethod
+    def _parse_log_record(record):
+        '''Parse a single record of `git log` output in `_LOG_FORMAT`.'''
+        hexsha, author_name, message = record.split(b'\n', 2)
+        commit = _CommitRecord(
+            hexsha.decode('ascii'),
+            _AuthorRecord(author_name.decode('utf-8', errors='replace'), None),
+        )
+        return commit, message.decode('utf-8', errors='replace')
+
     @property
     def url(self):
         '''URL to download the repository from.'''
@@ -111,6 +352,11 @@ class RepoManager:
         '''Name of the repository.'''
         return self._name
 
+    @property
+    def mirror_dir(self):
+        '''Path to the bare mirror the repository is checked out from.'''
+        return self._mirror_dir
+
     @property
     def dir(self):
         '''Path to directory containing the repository.'''
@@ -136,45 +382,188 @@ class RepoManager:
         return self._git_cmd
 
 
+class CommitMetadataTable:
+    '''Memoized lookup table mapping (commit -> CommitMetadata).
+
+    Entries are keyed by commit hexsha, so the anonymized author ID and short revision of
+    each commit are computed only once, however many blamed lines or changelog entries
+    refer to it. Any object with `hexsha` and `author.name` attributes (such as a
+    git.Commit) can be looked up.
+
+    '''
+
+    def __init__(self):
+        self._table = {}
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, commit):
+        try:
+            metadata = self._table[commit.hexsha]
+            self._hits += 1
+
+        except KeyError:
+            # The short revision is the leading part of the hexsha. This is the same value
+            # as `commit.name_rev[:7]`, without running `git name-rev`.
+            metadata = CommitMetadata(anonymize_id(commit.author.name), commit.hexsha[:7])
+            self._table[commit.hexsha] = metadata
+            self._misses += 1
+
+        return metadata
+
+    @property
+    def hits(self):
+        '''Number of lookups answered from the table.'''
+        return self._hits
+
+    @property
+    def misses(self):
+        '''Number of lookups that had to compute new metadata.'''
+        return self._misses
+
+
 class BlameIndex:
     '''Lookup table mapping (line number -> blame data) for a source file.'''
 
     _Entry = collections.namedtuple('_BlameIndexEntry', ('commit', 'line'))
 
-    def __init__(self, repo, rev, path):
-        self._raw_blame = repo.git.blame(rev, path)
+    _PORCELAIN_HEADER_REGEX = re.compile(rb'[0-9a-f]{40,64} [0-9]+ [0-9]+(?: [0-9]+)?')
+
+    def __init__(self, repo, rev, path, commit_metadata=None, line_ranges=None):
+        '''Blame the file at `path` and index the result by line number.
+
+        `repo`: RepoManager object for the repository containing the file.
+        `rev`: Revision to blame the file at.
+        `path`: Path to the file, relative to the repository directory.
+        `commit_metadata`: CommitMetadataTable used by `commit_metadata()`. Passing the
+                           same table to several indices lets them share memoized
+                           metadata. If `None` (default), the index uses its own table.
+        `line_ranges`: Iterable of (first line, last line) pairs, inclusive. If given, only
+                       these lines are blamed and indexed, with a single `git blame`
+                       invocation whose porcelain output is parsed directly; commits in
+                       the index are then lightweight records with `hexsha` and
+                       `author.name` attributes rather than git.Commit objects. If `None`
+                       (default), the whole file is blamed through GitPython.
+
+        '''
         self._repo = repo
         self._rev = rev
         self._path = path
+        self._commit_metadata = (
+            commit_metadata if commit_metadata is not None else CommitMetadataTable()
+        )
+
+        if line_ranges is None:
+            self._raw_blame = repo.git.blame(rev, path)
+        else:
+            self._raw_blame = self._blame_line_ranges(line_ranges)
 
-        self._index = []
+        # Map line numbers (indexed from 1) to entries. When only some line ranges were
+        # blamed, lines outside of them are missing.
+        self._index = {}
+        line_numbers = iter(self._line_numbers) if line_ranges is not None else itr.count(1)
         for commit, lines in self._raw_blame:
             for line in lines:
-                self._index.append(BlameIndex._Entry(commit, line))
+                self._index[next(line_numbers)] = BlameIndex._Entry(commit, line)
+
+    @staticmethod
+    def _merge_line_ranges(line_ranges):
+        '''Sort line ranges and merge those that overlap or are adjacent.'''
+        merged = []
+        for first, last in sorted(line_ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+
+        return merged
+
+    def _blame_line_ranges(self, line_ranges):
+        '''Blame only `line_ranges` of the file, parsing `git blame --porcelain` output.
+
+        Return: Raw blame data with the same structure as `git.Repo.blame()` output: a
+                list of [commit, lines] pairs, in line order. Also sets `_line_numbers` to
+                the line number of each blamed line, in the same order.
+
+        '''
+        self._line_numbers = []
+        raw_blame = []
+
+        line_ranges = BlameIndex._merge_line_ranges(line_ranges)
+        if not line_ranges:
+            return raw_blame
+
+        output = self._repo.git_cmd.blame(
+            '--porcelain',
+            *(f'-L{first},{last}' for first, last in line_ranges),
+            self._rev,
+            '--',
+            str(self._path),
+            stdout_as_string=False,
+        )
+
+        # Commits are only described the first time they appear, so one record is shared by
+        # every line blamed on the same commit.
+        commits = {}
+        hexsha = None
+        author_name = None
+        for output_line in output.split(b'\n'):
+            if output_line.startswith(b'\t'):
+                # Line content; ends the entry for one blamed line.
+                if hexsha not in commits:
+                    commits[hexsha] = _CommitRecord(hexsha, _AuthorRecord(author_name, None))
+                commit = commits[hexsha]
+
+                line = output_line[1:].decode('utf-8', errors='replace')
+                if raw_blame and raw_blame[-1][0] is commit:
+                    raw_blame[-1][1].append(line)
+                else:
+                    raw_blame.append([commit, [line]])
+
+            elif BlameIndex._PORCELAIN_HEADER_REGEX.fullmatch(output_line):
+                # "<hexsha> <original line> <final line> [<lines in group>]"
+                fields = output_line.split()
+                hexsha = fields[0].decode('ascii')
+                self._line_numbers.append(int(fields[2]))
+
+            elif output_line.startswith(b'author '):
+                author_name = output_line[len(b'author '):].decode('utf-8', errors='replace').strip()
+
+        return raw_blame
 
     def __len__(self):
         return len(self._index)
 
     def __getitem__(self, key):
-        # Lines index from 1, list indexes from 0; decrement all indices by 1.
         if isinstance(key, slice):
-            return self._index[slice(key.start-1, key.stop-1, key.step)]
+            return [
+                self._index[line]
+                for line in range(key.start, key.stop, key.step or 1)
+                if line in self._index
+            ]
         else:
-            return self._index[key-1]
+            return self._index[key]
 
     def search(self, string):
         '''Return first index entry whose line contains `string`.'''
-        for i, entry in self._index:
+        for entry in self._index.values():
             if string in entry.line:
                 return entry
 
     def find_all(self, string):
         '''Return all index entries whose line contains `string`.'''
         return [
-            entry for entry in self._index
+            entry for entry in self._index.values()
             if string in entry.line
         ]
 
+    def commit_metadata(self, start, stop):
+        '''Return CommitMetadata for each line from `start` up to (not including) `stop`.'''
+        return [self._commit_metadata[entry.commit] for entry in self[start:stop]]
+
     @property
     def raw_blame(self):
         '''Raw blame data for the source file.'''
@@ -0,0 +1,290 @@
+'''Tools for scheduling ordered work from several outputs onto one pool of workers.'''
+
+
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import Executor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from functools import partial
+
+import logging
+import sys
+import threading
+
+
+Task = namedtuple('Task', ('name', 'cost', 'open_output', 'submit'))
+'''Work whose results are written, in order, to a single output.
+
+name: Name of the task, for logging.
+cost: Estimated cost of the task, such as its run time in seconds. Costlier tasks are started
+      first, so the costs of tasks run together must be in the same unit.
+open_output: Callable returning a context manager. It is entered when the task starts, and
+             exited once every result of the task has been written.
+submit: Callable taking an executor and returning an iterator of (future, on_done) pairs.
+        `future` is a Future, or `None` for work that needs no worker. Each
+        `on_done(result, output)` is called in iteration order, with the result of its
+        future (or `None`) and the value returned by entering the task's output.
+
+'''
+
+
+class _TaskState:
+    '''Progress of a task that has been started by `run_tasks()`.'''
+
+    def __init__(self, task, executor):
+        self.task = task
+        self.stack = ExitStack()
+        self.output = self.stack.enter_context(task.open_output())
+        self.work = iter(task.submit(executor))
+
+        # Queue of (future, on_done) pairs, in submission order.
+        self.pending = deque()
+
+    def submit_next(self):
+        '''Submit the next piece of work. Return False if there is none left.'''
+        try:
+            self.pending.append(next(self.work))
+            return True
+
+        except StopIteration:
+            self.work = None
+            return False
+
+    def write_done(self):
+        '''Write the results of finished work, in order. Return the number written.'''
+        written = 0
+        while self.pending:
+            future, on_done = self.pending[0]
+            if future is not None and not future.done():
+                break
+
+            self.pending.popleft()
+            on_done(future.result() if future is not None else None, self.output)
+            written += 1
+
+        return written
+
+    @property
+    def finished(self):
+        return self.work is None and not self.pending
+
+
+def run_tasks(tasks, executor, max_in_flight):
+    '''Run tasks on a shared executor, interleaving their work.
+
+    Tasks are started in descending order of cost. Work is always submitted from the
+    earliest-started task that has work left, so the costliest tasks get workers first,
+    and later tasks fill the pool while earlier ones wait on their last results. Each
+    task's results are written in order as soon as every earlier result of the same task
+    has been written, so a task never holds up another task's output.
+
+    `tasks`: Iterable of Task objects.
+    `executor`: concurrent.futures.Executor to submit work to.
+    `max_in_flight`: Maximum number of pieces of work, across all tasks, that may be
+                     submitted but not yet written at once. Bounds memory use.
+
+    '''
+    waiting = deque(sorted(tasks, key=lambda task: task.cost, reverse=True))
+    active = []
+    in_flight = 0
+
+    try:
+        while waiting or active:
+            # Submit work until the budget is used up, or there is no work left.
+            while in_flight < max_in_flight:
+                state = next((state for state in active if state.work is not None), None)
+                if state is None:
+                    if not waiting:
+                        break
+
+                    task = waiting.popleft()
+                    logging.info(f" {task.name}")
+                    state = _TaskState(task, executor)
+                    active.append(state)
+
+                if state.submit_next():
+                    in_flight += 1
+
+            # Write finished work, and close the outputs of finished tasks.
+            written = 0
+            for state in list(active):
+                written += state.write_done()
+                if state.finished:
+                    active.remove(state)
+                    state.stack.close()
+
+            in_flight -= written
+
+            # Wait for the next result that could be written.
+            if not written:
+                heads = [state.pending[0][0] for state in active if state.pending]
+                if heads:
+                    wait(heads, return_when=FIRST_COMPLETED)
+
+    except BaseException:
+        exc_info = sys.exc_info()
+        for state in active:
+            state.stack.__exit__(*exc_info)
+        raise
+
+
+class WorkLostError(BrokenProcessPool):
+    '''Work was given up on because it killed the worker process running it.'''
+
+
+class RestartingProcessPool(Executor):
+    '''Process pool that replaces its workers when one dies, and retries the lost work.
+
+    When a worker of a ProcessPoolExecutor exits unexpectedly, the pool is broken for good,
+    and all work in flight on it fails. This executor instead starts a new pool, and
+    submits the lost work again, one piece at a time, holding back new work until it is
+    done. Work that is lost again while it is the only work in flight must be what kills
+    its worker, so its future fails with WorkLostError. Work that is lost
+    `max_attempts` times fails with WorkLostError too.
+
+    `max_workers`: As for ProcessPoolExecutor.
+    `max_attempts`: Number of times work may be lost before it is given up on.
+
+    '''
+
+    def __init__(self, max_workers=None, max_attempts=3):
+        self._max_workers = max_workers
+        self._max_attempts = max_attempts
+        self._lock = threading.RLock()
+        self._pool = ProcessPoolExecutor(max_workers=max_workers)
+
+        # Incremented each time the pool is replaced.
+        self._generation = 0
+        # Map of (generation -> number of pieces of work in flight on that pool).
+        self._in_flight = {0: 0}
+        # Map of (generation -> number of pieces of work in flight when that pool broke).
+        self._lost = {}
+
+        # Queue of (future, call, attempts) triples of lost work, to be retried one at a
+        # time, and of new work held back until they have been.
+        self._retries = deque()
+        self._held = deque()
+        self._retrying = False
+
+        self._restarts = 0
+
+    @property
+    def restarts(self):
+        '''Number of times the pool has been replaced.'''
+        return self._restarts
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._retrying:
+                self._held.append((future, (fn, args, kwargs), 0))
+            else:
+                self._submit(future, (fn, args, kwargs), 0)
+
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            pool = self._pool
+            if cancel_futures:
+                for future, _, _ in (*self._retries, *self._held):
+                    future.cancel()
+                self._retries.clear()
+                self._held.clear()
+
+        pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def _restart(self):
+        '''Replace a broken pool.'''
+        self._generation += 1
+        self._in_flight[self._generation] = 0
+        self._pool = ProcessPoolExecutor(max_workers=self._max_workers)
+        self._restarts += 1
+        logging.warning("A worker process died; restarting workers and retrying lost work.")
+
+    def _submit(self, future, call, attempts):
+        '''Submit work to the current pool. The lock must be held.'''
+        fn, args, kwargs = call
+        try:
+            inner_future = self._pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # The pool broke, but no lost work has been reported yet.
+            self._lost[self._generation] = self._in_flight[self._generation]
+            self._restart()
+            inner_future = self._pool.submit(fn, *args, **kwargs)
+
+        self._in_flight[self._generation] += 1
+        inner_future.add_done_callback(
+            partial(self._on_done, future, call, attempts, self._generation)
+        )
+
+    def _on_done(self, future, call, attempts, generation, inner_future):
+        '''Pass on the outcome of work, or retry it if it was lost.'''
+        exception = None if inner_future.cancelled() else inner_future.exception()
+
+        with self._lock:
+            if isinstance(exception, BrokenProcessPool):
+                if generation not in self._lost:
+                    self._lost[generation] = self._in_flight[generation]
+                lost_alone = self._lost[generation] == 1
+                if generation == self._generation:
+                    self._restart()
+
+            self._in_flight[generation] -= 1
+
+            if not isinstance(exception, BrokenProcessPool):
+                if inner_future.cancelled():
+                    future.cancel()
+                elif exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(inner_future.result())
+
+            elif (attempts > 0 and lost_alone) or attempts + 1 >= self._max_attempts:
+                future.set_exception(WorkLostError(
+                    f"Work was lost {attempts + 1} times to worker processes dying."
+                ))
+
+            else:
+                self._retries.append((future, call, attempts + 1))
+
+            # Retry lost work one piece at a time, then release the work held back.
+            if self._retrying and attempts > 0:
+                self._retrying = False
+            if not self._retrying and self._retries:
+                self._retrying = True
+                self._submit(*self._retries.popleft())
+            elif not self._retrying:
+                while self._held:
+                    self._submit(*self._held.popleft())
+
+
+def recover_lost_work(future, fallback):
+    '''Get a future that resolves like `future`, unless its work was given up on.
+
+    `future`: Future returned by RestartingProcessPool.submit().
+    `fallback`: Callable returning the result to resolve with if `future` fails with
+                WorkLostError.
+
+    Return: Future.
+
+    '''
+    recovered = Future()
+
+    def on_done(future):
+        if future.cancelled():
+            recovered.cancel()
+        elif isinstance(future.exception(), WorkLostError):
+            recovered.set_result(fallback())
+        elif future.exception() is not None:
+            recovered.set_exception(future.exception())
+        else:
+            recovered.set_result(future.result())
+
+    future.add_done_callback(on_done)
+    return recovered
@@ -0,0 +1,104 @@
+'''Tests for corpus construction.'''
+
+
+from benchmark import _classify_comment_as_code_per_comment
+from build import _has_name_pair
+from build import _has_unterminated_quote
+from build import classify_comments_as_code
+from build import trim_comment_as_code
+from defines import CodeVerdict
+from defines import Language
+
+from collections import Counter
+
+import ast
+import pytest
+
+
+_CODE_VERDICT_CASES = [
+    # Plain code.
+    ('# x = 1', Language.PYTHON, CodeVerdict.EXCLUDED),
+    ('# return x', Language.PYTHON, CodeVerdict.EXCLUDED),
+    ('# lambda x: x', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# 1 if x else 2', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# if x is not None:', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('#', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# TODO', Language.PYTHON, CodeVerdict.INCLUDED),
+    # Adjacent names, with and without keywords.
+    ('# print foo', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# foo\tbar', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# not x', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# x is not None', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# await foo', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# x.y z', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# naïve approach', Language.PYTHON, CodeVerdict.NOT_CODE),
+    # Soft keywords.
+    ('# match x', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# case x', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# _ foo', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# _ = foo', Language.PYTHON, CodeVerdict.EXCLUDED),
+    ('# match x:\n#     case 1: pass', Language.PYTHON, CodeVerdict.INCLUDED),
+    # Quotes.
+    ("# 'hello world'", Language.PYTHON, CodeVerdict.INCLUDED),
+    ("# don't do this", Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# "unterminated', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ("# '''triple", Language.PYTHON, CodeVerdict.NOT_CODE),
+    ("# '''triple'''", Language.PYTHON, CodeVerdict.INCLUDED),
+    ("# x = '#'", Language.PYTHON, CodeVerdict.EXCLUDED),
+    # Backslashes.
+    ("# 'it\\'s'", Language.PYTHON, CodeVerdict.INCLUDED),
+    ("# 'a\\\\' b", Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# a \\ b', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# foo \\\n# bar', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# x = \\\n#     1', Language.PYTHON, CodeVerdict.EXCLUDED),
+    # Comments within comments.
+    ('# a # b', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# print(x)  # note', Language.PYTHON, CodeVerdict.EXCLUDED),
+    # Braces.
+    ('# {a b}', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# {"a": 1}', Language.PYTHON, CodeVerdict.INCLUDED),
+    ('# {x for x in y}', Language.PYTHON, CodeVerdict.INCLUDED),
+    ("# f'{x!r} {y}'", Language.PYTHON, CodeVerdict.INCLUDED),
+    ("# f'{x['k']}'", Language.PYTHON, CodeVerdict.NOT_CODE),
+    # Multi-line comments.
+    ('# def f():\n#     return 1', Language.PYTHON, CodeVerdict.EXCLUDED),
+    ('# Compute the value.\n# More text.', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# x = 1\n# y = 2 3', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# x = 1\n# print y', Language.PYTHON, CodeVerdict.NOT_CODE),
+    ("# 'a'\n# b c", Language.PYTHON, CodeVerdict.NOT_CODE),
+    ('# a\0b', Language.PYTHON, CodeVerdict.NOT_CODE),
+    # C comments are only checked against Python, and never excluded.
+    ('// int x = 1;', Language.C, CodeVerdict.NOT_CODE),
+    ('// just some words', Language.C, CodeVerdict.NOT_CODE),
+    ("// don't", Language.C, CodeVerdict.NOT_CODE),
+    ('/* foo(bar) */', Language.C, CodeVerdict.INCLUDED),
+    ('/* a = b\n * c = d */', Language.C, CodeVerdict.INCLUDED),
+    ('// x = {1, 2}', Language.CPP, CodeVerdict.INCLUDED),
+]
+
+
+@pytest.mark.parametrize('comment, language, verdict', _CODE_VERDICT_CASES)
+def test_classify_comments_as_code_matches_per_comment_checks(comment, language, verdict):
+    assert _classify_comment_as_code_per_comment(comment, language) == verdict
+    assert classify_comments_as_code([comment], language) == [verdict]
+
+
+@pytest.mark.parametrize('language', list(Language))
+def test_classify_comments_as_code_batch(language):
+    comments = [comment for comment, _, _ in _CODE_VERDICT_CASES]
+    stage_counts = Counter()
+
+    verdicts = classify_comments_as_code(comments, language, stage_counts)
+
+    assert verdicts == [
+        _classify_comment_as_code_per_comment(comment, language) for comment in comments
+    ]
+    assert sum(stage_counts.values()) == len(comments)
+
+
+@pytest.mark.parametrize('comment, language, verdict', _CODE_VERDICT_CASES)
+def test_code_prefilters_only_reject_invalid_python(comment, language, verdict):
+    text = trim_comment_as_code(comment, language)
+    if _has_name_pair(text) or _has_unterminated_quote(text):
+        with pytest.raises(SyntaxError):
+            ast.parse(text)
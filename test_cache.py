@@ -0,0 +1,205 @@
+'''Tests for on-disk build caches.'''
+
+
+from build import _CommentOutputs
+from build import _WorkerResult
+from build import _submit_repo_comments
+from cache import ExtractionCache
+from defines import ClangParseMode
+from defines import CommentBackend
+from defines import Language
+from repo import TrackedFile
+
+from concurrent.futures import Future
+from pathlib import Path
+
+import build
+import pytest
+
+
+_KEY_FIELDS = {
+    'repo': 'repo',
+    'commit': 'c' * 40,
+    'blob_sha': 'b' * 40,
+    'path': 'src/main.c',
+    'languages': (Language.C, Language.CPP),
+    'version': '2-libclang',
+    'shallow': False,
+}
+
+
+@pytest.mark.parametrize('field, value', [
+    ('repo', 'fork'),
+    ('commit', 'd' * 40),
+    ('blob_sha', 'e' * 40),
+    ('path', 'src/other.c'),
+    ('languages', (Language.CPP, Language.C)),
+    ('version', '3-libclang'),
+    ('shallow', True),
+])
+def test_key_fields(field, value):
+    assert ExtractionCache.key(**_KEY_FIELDS) != ExtractionCache.key(
+        **{**_KEY_FIELDS, field: value}
+    )
+
+
+def test_get_and_put(tmp_path):
+    cache = ExtractionCache(tmp_path)
+    key = ExtractionCache.key(**_KEY_FIELDS)
+    assert cache.get(key) is None
+
+    cache.put(key, [b'<note/>'])
+    assert cache.get(key) == [b'<note/>']
+    assert ExtractionCache(tmp_path).get(key) == [b'<note/>']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_corrupt_entry_discarded(tmp_path):
+    cache = ExtractionCache(tmp_path)
+    key = ExtractionCache.key(**_KEY_FIELDS)
+    cache.put(key, [b'<note/>'])
+    entry_path, = tmp_path.glob('*/*')
+    entry_path.write_bytes(entry_path.read_bytes()[:5])
+
+    assert cache.get(key) is None
+    assert not entry_path.exists()
+
+
+def test_gc(tmp_path):
+    keys = [ExtractionCache.key(**{**_KEY_FIELDS, 'path': f'{i}.c'}) for i in range(3)]
+    cache = ExtractionCache(tmp_path)
+    for key in keys:
+        cache.put(key, [])
+
+    cache = ExtractionCache(tmp_path)
+    cache.get(keys[0])
+    cache.put(keys[2], [])
+    assert cache.gc() == 1
+    assert sorted(path.stem for path in tmp_path.glob('*/*')) == sorted(keys[::2])
+
+
+# Both files have the same contents, so the same blob SHA.
+_SOURCE_FILES = [
+    TrackedFile('main.c', 'a' * 40, 100),
+    TrackedFile('copy.c', 'a' * 40, 100),
+]
+
+
+class _FakeRepo:
+    def __init__(self, name, commit, shallow=False):
+        self.name = name
+        self.dir = Path(name)
+        self.commit = commit
+        self.shallow = shallow
+
+    def resolve_commit(self, rev='HEAD'):
+        return self.commit
+
+    def is_shallow(self):
+        return self.shallow
+
+
+class _FakeExecutor:
+    '''Executor that records the files submitted to it, without extracting them.'''
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.paths = []
+
+    def submit(self, fn, path, **kwargs):
+        self.paths.append(path.name)
+        future = Future()
+        note = f'<note>{self.repo.name}:{self.repo.commit}:{path.name}</note>'
+        future.set_result(_WorkerResult([note.encode('utf-8')], 0, None, ([], [])))
+        return future
+
+
+class _FakeWriter:
+    def __init__(self):
+        self.notes = []
+
+    def write(self, note):
+        self.notes.append(note)
+
+
+def _extract(cache, repo, **kwargs):
+    '''Extract `_SOURCE_FILES` from `repo` through `cache`.
+
+    Return: (names of the files that were extracted, notes written).
+
+    '''
+    executor = _FakeExecutor(repo)
+    writer = _FakeWriter()
+    work = _submit_repo_comments(
+        executor, repo, _SOURCE_FILES, extraction_cache=cache, **kwargs
+    )
+    outputs = _CommentOutputs(writer, None)
+    for future, on_done in work:
+        on_done(future.result() if future is not None else None, outputs)
+
+    return executor.paths, writer.notes
+
+
+def test_cached_extraction(tmp_path):
+    repo = _FakeRepo('repo', 'c' * 40)
+    paths, notes = _extract(ExtractionCache(tmp_path), repo)
+    assert paths == ['main.c', 'copy.c']
+
+    cache = ExtractionCache(tmp_path)
+    assert _extract(cache, repo) == ([], notes)
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+@pytest.mark.parametrize('repo', [
+    _FakeRepo('fork', 'c' * 40),
+    _FakeRepo('repo', 'd' * 40),
+    _FakeRepo('repo', 'c' * 40, shallow=True),
+])
+def test_same_blob_elsewhere_not_shared(tmp_path, repo):
+    _extract(ExtractionCache(tmp_path), _FakeRepo('repo', 'c' * 40))
+
+    paths, notes = _extract(ExtractionCache(tmp_path), repo)
+    assert paths == ['main.c', 'copy.c']
+    assert notes[0].startswith(f'<note>{repo.name}:{repo.commit}:'.encode('utf-8'))
+    assert len(list(tmp_path.glob('*/*'))) == 4
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'c_backend': CommentBackend.LEXER},
+    {'clang_parse_mode': ClangParseMode.FAST},
+])
+def test_extractor_change_misses(tmp_path, kwargs):
+    repo = _FakeRepo('repo', 'c' * 40)
+    _extract(ExtractionCache(tmp_path), repo)
+
+    paths, _ = _extract(ExtractionCache(tmp_path), repo, **kwargs)
+    assert paths == ['main.c', 'copy.c']
+    assert _extract(ExtractionCache(tmp_path), repo, **kwargs)[0] == []
+
+
+def test_extractor_version_change_misses(tmp_path, monkeypatch):
+    repo = _FakeRepo('repo', 'c' * 40)
+    _extract(ExtractionCache(tmp_path), repo)
+
+    monkeypatch.setattr(build, 'EXTRACTOR_VERSION', build.EXTRACTOR_VERSION + 1)
+    paths, _ = _extract(ExtractionCache(tmp_path), repo)
+    assert paths == ['main.c', 'copy.c']
+
+
+def test_build_notes_bypass_cache(tmp_path):
+    repo = _FakeRepo('repo', 'c' * 40)
+    _extract(ExtractionCache(tmp_path), repo)
+    entries = {path: path.read_bytes() for path in tmp_path.glob('*/*')}
+
+    # Extraction for build notes leaves commented-out code out of its notes, so cached
+    # results are neither used nor replaced.
+    cache = ExtractionCache(tmp_path)
+    paths, _ = _extract(cache, repo, write_build_notes=True)
+    assert paths == ['main.c', 'copy.c']
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert {path: path.read_bytes() for path in tmp_path.glob('*/*')} == entries
+
+    # Nor are results cached when there were none.
+    cache = ExtractionCache(tmp_path / 'empty')
+    _extract(cache, repo, write_build_notes=True)
+    assert not (tmp_path / 'empty').exists()
@@ -0,0 +1,110 @@
+'''Tests for the binary columnar corpus format.'''
+
+
+from columnar import get_binary_path
+from columnar import write_binary_corpus_file
+from corpus import NoteWriter
+from corpus import get_corpus_file_paths
+from defines import CorpusFormat
+from reader import CccReader
+
+from xml.etree import ElementTree
+
+import pytest
+
+
+def _note(repo, tokens, pos, note_type='comment', raw=None, authors=('a1',), revs=('0000001',)):
+    '''Build an annotated note element, with the subelements in corpus file order.'''
+    note_elt = ElementTree.Element('note')
+    ElementTree.SubElement(note_elt, 'repo').text = repo
+    for author in authors:
+        ElementTree.SubElement(note_elt, 'author').text = author
+    for rev in revs:
+        ElementTree.SubElement(note_elt, 'revision').text = rev
+    ElementTree.SubElement(note_elt, 'note-type').text = note_type
+    if note_type == 'comment':
+        ElementTree.SubElement(note_elt, 'file').text = f'repos/{repo}/main.c'
+        ElementTree.SubElement(note_elt, 'first-line').text = '1'
+        ElementTree.SubElement(note_elt, 'last-line').text = '2'
+        ElementTree.SubElement(note_elt, 'language').text = 'c'
+    ElementTree.SubElement(note_elt, 'raw').text = raw if raw is not None else tokens
+    ElementTree.SubElement(note_elt, 'tokens').text = tokens
+    ElementTree.SubElement(note_elt, 'pos').text = pos
+    return note_elt
+
+
+_NOTES = [
+    _note('alpha', 'Compute the sum .\nThen return it .', 'VB DT NN .\nRB VB PRP .'),
+    # Empty comment, written as <tokens/> and <pos/>.
+    _note('alpha', None, None, raw='/* */'),
+    _note(
+        'alpha',
+        'Check a < b && c > d',
+        'VB DT SYM NN CC NN SYM NN',
+        raw='// Check a < b && c > d',
+        authors=('a1', 'a2'),
+        revs=('0000001', '0000002'),
+    ),
+    _note('alpha', 'Größe der Übersicht – 日本語 ✓', 'NN DT NN : NN NN', authors=()),
+    # A token holding a no-break space, which the XML reader splits into two words.
+    _note('alpha', 'width\u00a0px is fixed', 'NN VBZ JJ'),
+    _note('alpha', 'Fix the & escaping', 'VB DT CC NN', note_type='changelog'),
+]
+
+
+@pytest.fixture
+def corpus_paths(tmp_path, monkeypatch):
+    '''Write a small XML corpus (one plain file, one sharded file) and convert it.'''
+    monkeypatch.chdir(tmp_path)
+
+    plain_path = tmp_path / 'corpus' / 'comment.alpha.xml'
+    with NoteWriter(plain_path) as writer:
+        for note_elt in _NOTES:
+            writer.write_element(note_elt)
+
+    sharded_path = tmp_path / 'corpus' / 'comment.beta.xml'
+    with NoteWriter(sharded_path, max_shard_notes=2) as writer:
+        for note_elt in _NOTES:
+            note_elt = ElementTree.fromstring(ElementTree.tostring(note_elt))
+            note_elt.find('repo').text = 'beta'
+            writer.write_element(note_elt)
+
+    paths = get_corpus_file_paths(plain_path) + get_corpus_file_paths(sharded_path)
+    for path in paths:
+        write_binary_corpus_file(path)
+
+    return paths
+
+
+def test_sharded_file_converted_per_shard(corpus_paths):
+    assert len(corpus_paths) == 4
+    for path in corpus_paths:
+        assert get_binary_path(path).is_file()
+
+
+@pytest.mark.parametrize('method', ['words', 'sents', 'pos'])
+def test_binary_reader_matches_xml_reader(corpus_paths, method):
+    xml_reader = CccReader(corpus_format=CorpusFormat.XML)
+    binary_reader = CccReader(corpus_format=CorpusFormat.BINARY)
+
+    expected = getattr(xml_reader, method)()
+    assert expected
+    assert getattr(binary_reader, method)() == expected
+    assert getattr(binary_reader, method)(repos=['beta']) == getattr(xml_reader, method)(
+        repos=['beta']
+    )
+
+
+def test_binary_reader_xml_matches_xml_reader(corpus_paths):
+    xml_notes = CccReader(corpus_format=CorpusFormat.XML).xml()
+    binary_notes = CccReader(corpus_format=CorpusFormat.BINARY).xml()
+
+    assert len(binary_notes) == len(xml_notes) == 2 * len(_NOTES)
+    for binary_note, xml_note in zip(binary_notes, xml_notes):
+        assert ElementTree.tostring(binary_note) == ElementTree.tostring(xml_note)
+
+
+def test_non_simple_tokens_split_like_xml(corpus_paths):
+    words = CccReader(corpus_format=CorpusFormat.BINARY).words(repos=['alpha'])
+    assert 'width' in words and 'px' in words
+    assert 'width px' not in words
@@ -0,0 +1,181 @@
+'''Tests for writing corpus files.'''
+
+
+from corpus import NoteWriter
+from corpus import get_corpus_file_paths
+from corpus import read_manifest
+
+from xml.etree import ElementTree
+
+import corpus
+import multiprocessing as mp
+import os
+import pytest
+
+
+_NOTES = [f'<note><raw>Note number {i}.</raw></note>'.encode('utf-8') for i in range(10)]
+
+_SHARDINGS = {
+    'unsharded': {},
+    'shard-notes': {'max_shard_notes': 3},
+    'shard-bytes': {'max_shard_bytes': 150},
+}
+
+
+def _write_notes(writer, notes, checkpoint=True):
+    for note in notes:
+        writer.write(note)
+        if checkpoint:
+            writer.checkpoint(note.decode('utf-8'))
+
+
+def _read_dir(directory):
+    '''Map the name of every file in `directory` to its contents.'''
+    return {path.name: path.read_bytes() for path in directory.iterdir()}
+
+
+def _read_notes(path):
+    return [
+        ElementTree.tostring(note_elt)
+        for corpus_path in get_corpus_file_paths(path)
+        for note_elt in ElementTree.parse(corpus_path).getroot()
+    ]
+
+
+def _stale_corpus(directory):
+    '''Write a corpus file, sharded into 5 shards, as an earlier build might have left it.'''
+    path = directory / 'comment.repo.xml'
+    with NoteWriter(path, max_shard_notes=1) as writer:
+        _write_notes(writer, [b'<note><raw>Stale.</raw></note>'] * 5, checkpoint=False)
+
+    return path, _read_dir(directory)
+
+
+@pytest.fixture(params=list(_SHARDINGS))
+def sharding(request):
+    return _SHARDINGS[request.param]
+
+
+@pytest.fixture
+def expected(tmp_path, sharding):
+    '''Files written by an uninterrupted journaled write of every note.'''
+    directory = tmp_path / 'expected'
+    with NoteWriter(directory / 'comment.repo.xml', journal=True, **sharding) as writer:
+        _write_notes(writer, _NOTES)
+
+    return _read_dir(directory)
+
+
+def test_uninterrupted_write(tmp_path, sharding, expected):
+    path = tmp_path / 'expected' / 'comment.repo.xml'
+    assert _read_notes(path) == _NOTES
+
+    manifest = read_manifest(path)
+    if sharding:
+        assert manifest['notes'] == len(_NOTES)
+        assert len(manifest['shards']) > 1
+        assert sum(shard['notes'] for shard in manifest['shards']) == len(_NOTES)
+    else:
+        assert manifest is None
+        assert list(expected) == ['comment.repo.xml']
+
+
+def test_failed_write_leaves_old_file(tmp_path, sharding):
+    path, old_files = _stale_corpus(tmp_path)
+
+    with pytest.raises(RuntimeError):
+        with NoteWriter(path, **sharding) as writer:
+            _write_notes(writer, _NOTES, checkpoint=False)
+            raise RuntimeError("interrupted")
+
+    assert _read_dir(tmp_path) == old_files
+
+
+def test_resume_after_exception(tmp_path, sharding, expected):
+    directory = tmp_path / 'resumed'
+    directory.mkdir()
+    path, old_files = _stale_corpus(directory)
+
+    with pytest.raises(RuntimeError):
+        with NoteWriter(path, journal=True, **sharding) as writer:
+            _write_notes(writer, _NOTES[:6])
+            # Notes after the last checkpoint are not resumed.
+            _write_notes(writer, _NOTES[6:8], checkpoint=False)
+            raise RuntimeError("interrupted")
+
+    # Nothing has been moved into place, so the earlier build's files are untouched.
+    for name, contents in old_files.items():
+        assert (directory / name).read_bytes() == contents
+
+    checkpoints = NoteWriter.read_checkpoints(path, bool(sharding))
+    assert checkpoints == [note.decode('utf-8') for note in _NOTES[:6]]
+    assert NoteWriter.read_checkpoints(path, not sharding) == []
+
+    with NoteWriter(path, journal=True, resume_checkpoints=len(checkpoints), **sharding) as writer:
+        assert writer.notes_written == 6
+        _write_notes(writer, _NOTES[6:])
+
+    assert _read_dir(directory) == expected
+
+
+def _write_and_die(path, sharding, checkpointed, unchecked):
+    '''Write notes to a journaled writer, then exit without closing or discarding it.'''
+    corpus.CHECKPOINT_INTERVAL = 0
+    writer = NoteWriter(path, journal=True, **sharding)
+    _write_notes(writer, _NOTES[:checkpointed])
+    _write_notes(writer, _NOTES[checkpointed:checkpointed+unchecked], checkpoint=False)
+    os._exit(1)
+
+
+@pytest.mark.parametrize('checkpointed', [0, 1, 4, 9])
+def test_resume_after_kill(tmp_path, sharding, expected, checkpointed):
+    directory = tmp_path / 'resumed'
+    directory.mkdir()
+    path, old_files = _stale_corpus(directory)
+
+    process = mp.get_context('fork').Process(
+        target=_write_and_die,
+        args=(path, sharding, checkpointed, 1),
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    for name, contents in old_files.items():
+        assert (directory / name).read_bytes() == contents
+
+    checkpoints = NoteWriter.read_checkpoints(path, bool(sharding))
+    assert checkpoints == [note.decode('utf-8') for note in _NOTES[:checkpointed]]
+
+    with NoteWriter(path, journal=True, resume_checkpoints=len(checkpoints), **sharding) as writer:
+        _write_notes(writer, _NOTES[checkpointed:])
+
+    assert _read_dir(directory) == expected
+
+
+def test_resume_ignores_checkpoints_past_lost_notes(tmp_path):
+    path = tmp_path / 'comment.repo.xml'
+    with pytest.raises(RuntimeError):
+        with NoteWriter(path, journal=True) as writer:
+            _write_notes(writer, _NOTES[:5])
+            raise RuntimeError("interrupted")
+
+    # Lose the last two notes, as if the disk had not kept them.
+    temp_path = tmp_path / f'.{path.name}.tmp'
+    offset = temp_path.read_bytes().index(_NOTES[3])
+    os.truncate(temp_path, offset)
+
+    checkpoints = NoteWriter.read_checkpoints(path)
+    assert checkpoints == [note.decode('utf-8') for note in _NOTES[:3]]
+
+    with NoteWriter(path, journal=True, resume_checkpoints=len(checkpoints)) as writer:
+        _write_notes(writer, _NOTES[3:])
+
+    assert _read_notes(path) == _NOTES
+    assert sorted(os.listdir(tmp_path)) == [path.name]
+
+
+def test_resume_requires_checkpoints(tmp_path):
+    path = tmp_path / 'comment.repo.xml'
+    with pytest.raises(ValueError):
+        NoteWriter(path, journal=True, resume_checkpoints=1)
@@ -0,0 +1,90 @@
+'''Tests for the lightweight C and C++ comment lexer.'''
+
+
+from defines import Language
+from lexer import CommentToken
+from lexer import lex_comments
+from lexer import lex_file_comments
+
+import pytest
+
+
+def _texts(source, language=Language.C):
+    return [comment.text for comment in lex_comments(source, language)]
+
+
+@pytest.mark.parametrize('language', [Language.C, Language.CPP])
+@pytest.mark.parametrize('source, expected', [
+    (b'int x; // comment\n', [b'// comment']),
+    (b'/* one */ int x; /* two */\n', [b'/* one */', b'/* two */']),
+    # Comment delimiters inside string and character literals.
+    (b'char *s = "http://example.com"; // real\n', [b'// real']),
+    (b'char *s = "/* not a comment */"; /* real */\n', [b'/* real */']),
+    (b'char a = \'/\', b = \'*\'; /* real */\n', [b'/* real */']),
+    (b'char *s = "escaped \\" // quote"; // real\n', [b'// real']),
+    (b"char c = '\\''; // real\n", [b'// real']),
+    # An unterminated literal ends at the end of its line.
+    (b'char *s = "unterminated\n// real\n', [b'// real']),
+    # Block comments do not nest.
+    (b'/* outer /* inner */ x = 1; */\n', [b'/* outer /* inner */']),
+    (b'/* a */* b */\n', [b'/* a */']),
+    # Line comments inside block comments, and vice versa.
+    (b'/* // inside */ // after\n', [b'/* // inside */', b'// after']),
+    (b'// /* inside\nint x; */\n', [b'// /* inside']),
+    # Unterminated block comments run to the end of the file. (libclang reports an error
+    # and returns no comment token for them.)
+    (b'int x; /* never closed\nint y;\n', [b'/* never closed\nint y;\n']),
+    # Line splices continue a line comment, and are part of a comment that follows one.
+    (b'// first \\\n   second\nint x;\n', [b'// first \\\n   second']),
+    (b'// first \\  \r\n   second\r\nint x;\r\n', [b'// first \\  \r\n   second']),
+    (b'#define X 1 \\\n// comment\n', [b'\\\n// comment']),
+    (b'int x = a / b; // ratio\n', [b'// ratio']),
+    (b'', []),
+])
+def test_lex_comments(source, expected, language):
+    assert _texts(source, language) == expected
+
+
+def test_raw_strings():
+    source = b'auto s = R"(// not /* a comment)"; // real\n'
+    assert _texts(source, Language.CPP) == [b'// real']
+
+    # Raw strings with a delimiter end only at a closing parenthesis followed by it.
+    source = b'auto s = u8R"xy(")" // still inside)xy"; /* real */\n'
+    assert _texts(source, Language.CPP) == [b'/* real */']
+
+    # C has no raw strings: the prefix is an identifier, and the string ends at the
+    # next quote.
+    source = b'R"(a"//)"\n'
+    assert _texts(source, Language.C) == [b'//)"']
+    assert _texts(source, Language.CPP) == []
+
+
+def test_digit_separators():
+    source = b"int x = 1'000; // real\n"
+    assert _texts(source, Language.CPP) == [b'// real']
+
+    # In C, the quote starts a character literal that runs to the end of the line.
+    assert _texts(source, Language.C) == []
+
+
+def test_positions():
+    source = b'int x;\nchar *s = "\xc3\xa9"; /* a\nb */ // c\n'
+    assert lex_comments(source, Language.C) == [
+        CommentToken((2, 17), (3, 5), b'/* a\nb */'),
+        CommentToken((3, 6), (3, 10), b'// c'),
+    ]
+
+
+def test_lex_file_comments(tmp_path):
+    path = tmp_path / 'main.c'
+    path.write_bytes(b'/* file */\nint main(void) { return 0; } // end')
+    assert [comment.text for comment in lex_file_comments(path, Language.C)] == [
+        b'/* file */',
+        b'// end',
+    ]
+
+
+def test_unsupported_language():
+    with pytest.raises(ValueError):
+        lex_comments(b'# comment\n', Language.PYTHON)
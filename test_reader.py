@@ -0,0 +1,142 @@
+'''Tests for the NLTK corpus reader.'''
+
+
+from corpus import NoteWriter
+from reader import CccReader
+from reader import NoteStreamView
+from reader import ParsedFileCache
+from reader import _note_words
+
+from xml.etree import ElementTree
+
+import os
+import pytest
+
+
+def _note(repo, tokens, pos):
+    note_elt = ElementTree.Element('note')
+    ElementTree.SubElement(note_elt, 'repo').text = repo
+    ElementTree.SubElement(note_elt, 'note-type').text = 'comment'
+    ElementTree.SubElement(note_elt, 'raw').text = tokens
+    ElementTree.SubElement(note_elt, 'tokens').text = tokens
+    ElementTree.SubElement(note_elt, 'pos').text = pos
+    return note_elt
+
+
+def _write_corpus_file(path, notes, **kwargs):
+    with NoteWriter(path, **kwargs) as writer:
+        for tokens, pos in notes:
+            writer.write_element(_note(path.name.split('.')[1], tokens, pos))
+
+
+@pytest.fixture
+def corpus_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    corpus_dir = tmp_path / 'corpus'
+    _write_corpus_file(corpus_dir / 'comment.alpha.xml', [
+        ('Compute the sum .', 'VB DT NN .'),
+        ('Return it .', 'VB PRP .'),
+    ])
+    return corpus_dir
+
+
+def test_xml_returns_copies(corpus_dir):
+    reader = CccReader()
+    notes = reader.xml()
+    words = reader.words()
+
+    notes[0].find('tokens').text = 'Modified .'
+    notes[1].remove(notes[1].find('pos'))
+    notes.remove(notes[0])
+
+    assert reader.words() == words == ['Compute', 'the', 'sum', '.', 'Return', 'it', '.']
+    assert reader.pos()[-1] == ('.', '.')
+    assert [note.find('tokens').text for note in reader.xml()] == [
+        'Compute the sum .', 'Return it .'
+    ]
+    assert reader.cache.misses == 1
+
+
+def test_rewritten_file_parsed_again(corpus_dir):
+    reader = CccReader()
+    path = corpus_dir / 'comment.alpha.xml'
+    assert len(reader.words()) == 7
+
+    # A file of a different size.
+    _write_corpus_file(path, [('Return it .', 'VB PRP .')])
+    assert reader.words() == ['Return', 'it', '.']
+    assert reader.cache.invalidations == 1
+
+    # A file of the same size, written at a different time.
+    stat = os.stat(path)
+    _write_corpus_file(path, [('Return me .', 'VB PRP .')])
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert os.stat(path).st_size == stat.st_size
+    assert reader.words() == ['Return', 'me', '.']
+    assert reader.cache.invalidations == 2
+
+    assert reader.words() == ['Return', 'me', '.']
+    assert (reader.cache.hits, reader.cache.misses) == (1, 3)
+
+
+def test_parsed_file_cache_budget(tmp_path):
+    paths = []
+    for i, size in enumerate((40, 30, 30)):
+        path = tmp_path / f'{i}.xml'
+        path.write_bytes(b'x' * size)
+        paths.append(path)
+
+    cache = ParsedFileCache(max_file_bytes=80)
+    for path in paths:
+        cache.get(path.name, path, path.read_bytes)
+
+    # Adding the last file evicts the least recently used one.
+    assert len(cache) == 2
+    assert (cache.file_bytes, cache.evictions) == (60, 1)
+    cache.get(paths[1].name, paths[1], pytest.fail)
+    assert cache.hits == 1
+
+    # Files bigger than the whole budget are never cached.
+    big_path = tmp_path / 'big.xml'
+    big_path.write_bytes(b'x' * 81)
+    cache.get(big_path.name, big_path, big_path.read_bytes)
+    assert (len(cache), cache.file_bytes) == (2, 60)
+
+    cache = ParsedFileCache(max_file_bytes=0)
+    cache.get(paths[0].name, paths[0], paths[0].read_bytes)
+    assert len(cache) == 0
+
+
+_SHARDED_NOTES = [(f'Note {i} .\nSecond one .', 'NN CD .\nJJ NN .') for i in range(50)]
+
+
+@pytest.mark.parametrize('method', ['words', 'sents', 'pos'])
+def test_lazy_view_of_sharded_corpus(corpus_dir, method):
+    _write_corpus_file(corpus_dir / 'comment.beta.xml', _SHARDED_NOTES, max_shard_notes=7)
+
+    reader = CccReader()
+    shards = reader.shards('comment.beta.xml')
+    assert len(shards) == 8
+
+    read = getattr(reader, method)
+    view = read(fileids=shards, lazy=True)
+    expected = read(fileids=shards)
+    assert len(expected) >= 100
+    assert list(view) == expected
+    assert len(view) == len(expected)
+    assert view[len(expected) // 2] == expected[len(expected) // 2]
+    assert list(view[5:60]) == expected[5:60]
+    assert list(read(lazy=True)) == read()
+
+    # Views do not go through the reader's cache.
+    assert reader.cache.misses == len(shards) + 1
+
+
+@pytest.mark.parametrize('block_size', [1, 100, 2**16])
+def test_note_stream_view_blocks(corpus_dir, block_size):
+    path = corpus_dir / 'comment.beta.xml'
+    _write_corpus_file(path, _SHARDED_NOTES)
+
+    view = NoteStreamView(path, _note_words, block_size=block_size)
+    assert list(view) == CccReader().words(fileids=[path.name])
+    assert view[-1] == '.'
@@ -0,0 +1,181 @@
+'''Tests for repository management.'''
+
+
+from repo import BlameIndex
+from repo import CommitMetadataTable
+from repo import RepoManager
+
+import git
+import pytest
+
+
+_ALICE = 'a' * 40
+_BOB = 'b' * 40
+
+
+def _commit_header(author, summary):
+    return (
+        f'author {author}\n'
+        f'author-mail <{author.lower()}@example.com>\n'
+        'author-time 1700000000\n'
+        'author-tz +0000\n'
+        f'committer {author}\n'
+        f'committer-mail <{author.lower()}@example.com>\n'
+        'committer-time 1700000000\n'
+        'committer-tz +0000\n'
+        f'summary {summary}\n'
+    )
+
+
+# Blame of lines 1-2 and 4-7 of a file. Each commit is described only the first time it
+# appears. Alice's commit is the boundary (root) commit; Bob's has a previous commit.
+_PORCELAIN = (
+    f'{_ALICE} 1 1 1\n'
+    + _commit_header('Alice', 'First')
+    + 'boundary\n'
+    'filename f.c\n'
+    '\ta1\n'
+    f'{_BOB} 2 2 1\n'
+    + _commit_header('Bob', 'Second')
+    + f'previous {_ALICE} f.c\n'
+    'filename f.c\n'
+    '\tb2\n'
+    f'{_BOB} 4 4 1\n'
+    '\tb4\n'
+    f'{_ALICE} 5 5 2\n'
+    '\ta5\n'
+    f'{_ALICE} 6 6\n'
+    '\tauthor Mallory\n'
+    f'{_BOB} 6 7 1\n'
+    f'\t{_ALICE} 1 1 1\n'
+).encode('utf-8')
+
+
+class _FakeGitCmd:
+    '''Stand-in for git.cmd.Git that returns fixed `git blame` output.'''
+
+    def __init__(self, output):
+        self.output = output
+        self.calls = []
+
+    def blame(self, *args, **kwargs):
+        self.calls.append(args)
+        return self.output
+
+
+class _FakeRepo:
+    def __init__(self, output):
+        self.git_cmd = _FakeGitCmd(output)
+
+
+def _blame(output, line_ranges):
+    repo = _FakeRepo(output)
+    return BlameIndex(repo, 'HEAD', 'f.c', line_ranges=line_ranges), repo.git_cmd.calls
+
+
+def test_porcelain_parsing():
+    index, calls = _blame(_PORCELAIN, [(1, 2), (4, 7)])
+
+    assert calls == [('--porcelain', '-L1,2', '-L4,7', 'HEAD', '--', 'f.c')]
+    assert len(index) == 6
+    assert [(entry.commit.hexsha, entry.line) for entry in index[1:8]] == [
+        (_ALICE, 'a1'),
+        (_BOB, 'b2'),
+        (_BOB, 'b4'),
+        (_ALICE, 'a5'),
+        (_ALICE, 'author Mallory'),
+        (_BOB, f'{_ALICE} 1 1 1'),
+    ]
+    assert index[4].line == 'b4'
+    with pytest.raises(KeyError):
+        index[3]
+
+
+def test_porcelain_repeated_commits_share_metadata():
+    index, _ = _blame(_PORCELAIN, [(1, 2), (4, 7)])
+
+    # Later groups omit the commit's metadata, but get the same record.
+    assert index[1].commit is index[5].commit is index[6].commit
+    assert index[2].commit is index[4].commit is index[7].commit
+    assert index[1].commit.author.name == 'Alice'
+    assert index[7].commit.author.name == 'Bob'
+
+    # Consecutive lines blamed on the same commit are grouped, like git.Repo.blame().
+    assert [
+        (commit.hexsha, lines) for commit, lines in index.raw_blame
+    ] == [
+        (_ALICE, ['a1']),
+        (_BOB, ['b2', 'b4']),
+        (_ALICE, ['a5', 'author Mallory']),
+        (_BOB, [f'{_ALICE} 1 1 1']),
+    ]
+
+
+def test_porcelain_commit_metadata():
+    commit_metadata = CommitMetadataTable()
+    repo = _FakeRepo(_PORCELAIN)
+    index = BlameIndex(repo, 'HEAD', 'f.c', commit_metadata, line_ranges=[(1, 7)])
+
+    metadata = index.commit_metadata(1, 8)
+    assert [entry.rev for entry in metadata] == [
+        _ALICE[:7], _BOB[:7], _BOB[:7], _ALICE[:7], _ALICE[:7], _BOB[:7]
+    ]
+    assert metadata[0].author == metadata[3].author != metadata[1].author
+
+
+def test_porcelain_sha256_objects():
+    hexsha = 'c' * 64
+    output = f'{hexsha} 3 3 1\n' + _commit_header('Carol', 'Third') + '\tc3\n'
+    index, _ = _blame(output.encode('utf-8'), [(3, 3)])
+
+    assert index[3].commit.hexsha == hexsha
+    assert index[3].commit.author.name == 'Carol'
+
+
+@pytest.mark.parametrize('line_ranges, merged', [
+    ([], []),
+    ([(4, 7)], [[4, 7]]),
+    ([(4, 7), (1, 2)], [[1, 2], [4, 7]]),
+    ([(1, 2), (3, 5)], [[1, 5]]),
+    ([(1, 4), (2, 3)], [[1, 4]]),
+    ([(1, 4), (3, 9), (11, 11), (12, 12)], [[1, 9], [11, 12]]),
+])
+def test_merge_line_ranges(line_ranges, merged):
+    assert BlameIndex._merge_line_ranges(line_ranges) == merged
+
+
+def test_overlapping_ranges_blamed_once():
+    _, calls = _blame(_PORCELAIN, [(4, 6), (1, 1), (5, 7), (2, 2)])
+    assert calls == [('--porcelain', '-L1,2', '-L4,7', 'HEAD', '--', 'f.c')]
+
+
+def test_no_line_ranges():
+    index, calls = _blame(_PORCELAIN, [])
+    assert calls == []
+    assert len(index) == 0
+
+
+def _commit(repo, author, contents):
+    with open(f'{repo.working_tree_dir}/f.c', 'w') as source_file:
+        source_file.write(contents)
+    repo.index.add(['f.c'])
+    actor = git.Actor(author, f'{author.lower()}@example.com')
+    return repo.index.commit(f'Commit by {author}', author=actor, committer=actor)
+
+
+def test_ranged_blame_matches_full_blame(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    git_repo = git.Repo.init(tmp_path / 'repos' / 'blamed')
+    _commit(git_repo, 'Alice', 'a1\na2\na3\na4\na5\na6\n')
+    _commit(git_repo, 'Bob', 'a1\nb2\na3\nb4\na5\na6\nb7\n')
+    _commit(git_repo, 'Carol', 'c0\na1\nb2\na3\nb4\na5\nc6\nb7\n')
+
+    repo = RepoManager('https://example.com/blamed.git')
+    full = BlameIndex(repo, 'HEAD', 'f.c')
+    ranged = BlameIndex(repo, 'HEAD', 'f.c', line_ranges=[(2, 3), (5, 8), (3, 4)])
+
+    assert len(ranged) == 7
+    for line in range(2, 9):
+        assert ranged[line].line == full[line].line
+        assert ranged[line].commit.hexsha == full[line].commit.hexsha
+        assert ranged[line].commit.author.name == full[line].commit.author.name
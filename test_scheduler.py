@@ -0,0 +1,181 @@
+'''Tests for scheduling work onto a shared pool of workers.'''
+
+
+from scheduler import RestartingProcessPool
+from scheduler import Task
+from scheduler import WorkLostError
+from scheduler import recover_lost_work
+from scheduler import run_tasks
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+
+import os
+import pytest
+import time
+
+
+@contextmanager
+def _recording_output(events, name):
+    '''Output that records when it is opened and closed, and how.'''
+    events.append(('open', name))
+    written = []
+    try:
+        yield written
+    except BaseException as e:
+        events.append(('error', name, type(e)))
+        raise
+    else:
+        events.append(('close', name, written))
+
+
+def _write(value, result, output):
+    output.append((value, result))
+
+
+def _submit_values(values, executor):
+    for value in values:
+        yield None, partial(_write, value)
+
+
+def test_tasks_start_costliest_first():
+    events = []
+    tasks = [
+        Task(
+            name,
+            cost,
+            partial(_recording_output, events, name),
+            partial(_submit_values, range(3)),
+        )
+        for name, cost in (('small', 1.0), ('large', 30.0), ('medium', 2.5))
+    ]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        run_tasks(tasks, executor, max_in_flight=1)
+
+    opened = [event[1] for event in events if event[0] == 'open']
+    assert opened == ['large', 'medium', 'small']
+    for event in events:
+        if event[0] == 'close':
+            assert event[2] == [(0, None), (1, None), (2, None)]
+
+
+def _sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def test_results_written_in_submission_order():
+    events = []
+
+    def submit(executor):
+        # Later work finishes first.
+        for i, seconds in enumerate((0.2, 0.1, 0.0)):
+            yield executor.submit(_sleep_and_return, seconds, i), partial(_write, i)
+
+    task = Task('task', 0, partial(_recording_output, events, 'task'), submit)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        run_tasks([task], executor, max_in_flight=3)
+
+    assert events[-1] == ('close', 'task', [(0, 0), (1, 1), (2, 2)])
+
+
+def test_failing_submit_propagates_and_closes_outputs():
+    events = []
+
+    def submit(executor):
+        yield None, partial(_write, 0)
+        raise ValueError("enumeration failed")
+
+    tasks = [
+        Task('failing', 2, partial(_recording_output, events, 'failing'), submit),
+        Task(
+            'other',
+            1,
+            partial(_recording_output, events, 'other'),
+            partial(_submit_values, range(2)),
+        ),
+    ]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(ValueError, match="enumeration failed"):
+            run_tasks(tasks, executor, max_in_flight=4)
+
+    assert ('error', 'failing', ValueError) in events
+    assert not any(event[0] == 'close' for event in events)
+
+
+def _raise_value_error():
+    raise ValueError("work failed")
+
+
+def test_failing_work_propagates_from_pool():
+    events = []
+
+    def submit(executor):
+        yield executor.submit(_raise_value_error), partial(_write, 0)
+
+    task = Task('task', 0, partial(_recording_output, events, 'task'), submit)
+    with RestartingProcessPool(max_workers=2) as executor:
+        with pytest.raises(ValueError, match="work failed"):
+            run_tasks([task], executor, max_in_flight=2)
+
+        assert executor.restarts == 0
+
+    assert events[-1] == ('error', 'task', ValueError)
+
+
+def _record_attempt(log_path, value, kill_on_attempts=(), seconds=0.0):
+    '''Append a line to `log_path`, then die if this is one of `kill_on_attempts`.'''
+    with open(log_path, 'a') as log_file:
+        log_file.write(f'{value}\n')
+    attempt = Path(log_path).read_text().splitlines().count(str(value))
+    if attempt in kill_on_attempts:
+        os._exit(1)
+    time.sleep(seconds)
+    return value
+
+
+def _attempts(log_path, value):
+    return Path(log_path).read_text().splitlines().count(str(value))
+
+
+def test_killed_work_is_resubmitted_once(tmp_path):
+    log_path = tmp_path / 'attempts.log'
+    with RestartingProcessPool(max_workers=2) as executor:
+        killed = executor.submit(_record_attempt, log_path, 'killed', kill_on_attempts=(1,))
+        assert killed.result(timeout=30) == 'killed'
+        assert executor.restarts == 1
+
+    assert _attempts(log_path, 'killed') == 2
+
+
+def test_work_lost_alongside_killed_work_is_retried(tmp_path):
+    log_path = tmp_path / 'attempts.log'
+    with RestartingProcessPool(max_workers=2) as executor:
+        innocent = executor.submit(_record_attempt, log_path, 'innocent', seconds=1.0)
+        killer = executor.submit(
+            _record_attempt, log_path, 'killer', kill_on_attempts=(1, 2, 3), seconds=0.2
+        )
+
+        with pytest.raises(WorkLostError):
+            killer.result(timeout=30)
+        assert innocent.result(timeout=30) == 'innocent'
+
+    # Both were lost when the killer first died. Each was then retried once on its own;
+    # the killer died again, so was given up on.
+    assert _attempts(log_path, 'killer') == 2
+    assert _attempts(log_path, 'innocent') == 2
+
+
+def test_recover_lost_work(tmp_path):
+    log_path = tmp_path / 'attempts.log'
+    with RestartingProcessPool(max_workers=1) as executor:
+        killer = executor.submit(_record_attempt, log_path, 'killer', kill_on_attempts=(1, 2))
+        recovered = recover_lost_work(killer, lambda: 'fallback')
+        passed = recover_lost_work(executor.submit(_sleep_and_return, 0, 'ok'), lambda: None)
+
+        assert recovered.result(timeout=30) == 'fallback'
+        assert passed.result(timeout=30) == 'ok'